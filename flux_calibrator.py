@@ -13,23 +13,22 @@ DO NOT MAKE 'C++' CODE AGAIN!!!!!!! THIS IS PYTHON
 CAL_DICT_LIST --- [ [{ 'ARC' : arc, 'DATA' : aabb_data, 'S_DUTY' : arc.getValue( 'CAL_PHS' ) , 'DUTY' : arc.getValue( 'CAL_DCYC' ), 'BW' : arc.getBandwidth(), 'CTR_F' : arc.getCenterFrequency( weighted = True ) }, {  }, {  }], [{}{}{}] ]
 """
 
-# Imports
+# Imports (astropy.coordinates and scipy.interpolate are imported where they are used)
 import numpy as np
 import os
 import math
+import hashlib
 import pickle
-import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
-
-from pypulse.archive import Archive
 
 from astropy.io import fits
-from astropy.coordinates import SkyCoord
-import astropy.units as astu
 
 from utils.calculate_flux import find_source_params_f2, getFlux
-from utils.saving import save_psrfits, save_session
-from utils.loading import load_session as load
+from utils.saving import save_psrfits
+from utils.journal import SessionJournal
+from utils.header_index import HeaderIndex
+from utils.scanner import select_records
+from utils.prefetch import Prefetcher
+from utils.weights_store import WeightsStore, weights_store_path
 
 file_root = os.path.dirname( os.path.abspath( __file__ ) )
 
@@ -51,11 +50,19 @@ class FluxCalibrator:
         Directory containing all continuum source cal files you plan to use (must be one directory).
     saveddata_dir : str, os.Path, optional
         Location to save newly calibrated PSRFITS files (local to this file)
+    mask_dir      : str, os.Path, optional
+        Location of the pulsar's RFI weights store (local to the pulsar's directory, default is saveddata_dir)
+    files         : [str, ..., str], optional
+        Paths of the pulsar's PSR and CAL mode files (e.g. from a scanner Catalog), used instead of searching dirs
+    prefetch      : int, optional
+        Number of archives to read ahead while the current one is calibrated (0 to disable)
+    prefetch_bytes: int, optional
+        Memory budget in bytes for archives read ahead (default is no limit)
     verbose       : bool, optional
         Displays more information to the console
     """
 
-    def __init__( self, psr_name, cont_name, *dirs, cont_dir = None, saveddata_dir = "data", verbose = False ):
+    def __init__( self, psr_name, cont_name, *dirs, cont_dir = None, saveddata_dir = "data", mask_dir = None, files = None, prefetch = 1, prefetch_bytes = None, verbose = False ):
 
         self.psr_name = str( psr_name )
         self.cont_name = str( cont_name )
@@ -67,6 +74,7 @@ class FluxCalibrator:
             self.dirs = [os.path.join( file_root, self.saveddata_dir )]
         else:
             self.dirs = dirs
+        self.files = files
         if cont_dir is None:
             self.cont_dir = os.path.join( file_root, self.saveddata_dir )
         else:
@@ -75,6 +83,11 @@ class FluxCalibrator:
             self.cont_dir = cont_dir
 
         self.verbose = verbose
+        self.index = HeaderIndex()
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        mask_dir = self.saveddata_dir if mask_dir is None else os.path.join( self.psr_name, mask_dir )
+        self.weights_store = WeightsStore( weights_store_path( os.path.join( file_root, mask_dir ), self.psr_name ), verbose = verbose )
         self.pkl_dir = os.path.join( file_root, self.psr_name, 'pickle_dumps' )
         self.pklfile = os.path.join( self.pkl_dir, "{}_calibration_save.pkl".format( self.psr_name ) )
 
@@ -95,114 +108,204 @@ class FluxCalibrator:
             os.makedirs( os.path.join( file_root, self.psr_name, 'pickle_dumps', 'calibration' ) )
 
 
+    def journal( self, bin_file ):
+
+        """
+        Returns the calibration session journal kept next to bin_file, importing bin_file if it is an older session pickle.
+        """
+
+        return SessionJournal( os.path.splitext( bin_file )[0] + ".jnl", 'c', legacy = bin_file )
+
     def load_session( self, bin_file ):
-        return load( bin_file, mode = 'c' )
 
-    def save_position( self, bin_file, *ex ):
-        return save_session( bin_file, *ex, mode = 'c' )
+        """
+        Returns the object saved with save_position, or None if nothing has been saved yet.
+        """
+
+        journal = self.journal( bin_file )
+        journal.load()
+        journal.close()
+        return journal.session()
+
+    def save_position( self, bin_file, obj ):
+        journal = self.journal( bin_file )
+        saved = journal.save( obj )
+        journal.close()
+        return saved
 
     def hdul_setup( self, dir, file, is_cal = True ):
 
-        hdul = fits.open( os.path.join( dir, file ) )
+        """
+        Returns the indexed primary header record of a file along with its MJD, frontend, observation number and mode.
+        """
+
+        hdr = self.index.lookup( os.path.join( dir, file ) )
+        if hdr is None:
+            raise OSError( "Could not read PSRFITS header." )
 
         root, ext = os.path.splitext( file )
         obs_num = root[-4:]
 
-        mjd = hdul[0].header[ 'STT_IMJD' ]
-        fe = hdul[0].header[ 'FRONTEND' ]
-        obs_mode = hdul[0].header[ 'OBS_MODE' ]
+        mjd = hdr[ 'STT_IMJD' ]
+        fe = hdr[ 'FRONTEND' ]
+        obs_mode = hdr[ 'OBS_MODE' ]
         if (is_cal and obs_mode == "PSR") or (not is_cal and obs_mode == "CAL"):
-            hdul.close()
             raise OSError( "Incorrect observation mode." )
 
-        return hdul, mjd, fe, obs_num, obs_mode
+        return hdr, mjd, fe, obs_num, obs_mode
+
+    def load_archive( self, file ):
+
+        """
+        Loads a PSR mode archive with its original (unprepared) data and any zap mask from the pulsar's weights store applied.
+        """
+
+        from pypulse.archive import Archive
+        ar = Archive( file, prepare = False, lowmem = True, verbose = self.verbose )
+        return self.weights_store.apply_archive( file, ar )
+
+    def cont_records( self ):
+
+        """
+        Returns the indexed header records of the cal files in the continuum directory, sorted by path.
+        """
+
+        return [ hdr for hdr in self.index.query( self.cont_dir ) if hdr[ 'OBS_MODE' ] != "PSR" ]
 
     def get_onoff_list( self, tolerance = 1 ):
 
+        """
+        Pairs the ON and OFF source continuum scans in cont_dir that share an MJD, frontend and observation number.
+        The list is saved along with a digest of the directory's header index, and only remade when that changes.
+        """
+
         dict_file = "{}_onoff_list.pkl".format( self.cont_name )
         abs_dict_file = os.path.join( self.pkl_dir, "calibration", dict_file )
 
-        if os.path.isfile( abs_dict_file ):
+        records = self.cont_records()
+        h = hashlib.blake2b( digest_size = 16 )
+        h.update( repr( ( self.cont_name, tolerance ) ).encode() )
+        for hdr in records:
+            h.update( repr( ( hdr[ 'PATH' ], hdr[ 'MTIME' ], hdr[ 'SIZE' ] ) ).encode() )
+        digest = h.hexdigest()
+
+        saved = self.load_session( abs_dict_file )
+        # Older saves are a bare list with no digest, so they are always remade
+        if isinstance( saved, dict ) and saved.get( 'DIGEST' ) == digest:
             if self.verbose:
                 print( "Loading previously saved continuum data..." )
-            onoff_list = self.load_session( abs_dict_file )
-        else:
+            return saved[ 'LIST' ]
 
-            if self.verbose:
-                print( "Making new continuum data list..." )
+        if self.verbose:
+            print( "Making new continuum data list..." )
 
-            onoff_list = []
+        from astropy.coordinates import SkyCoord
+        import astropy.units as astu
 
-            pos, params = find_source_params_f2( self.cont_name )
-            m_coordinates = SkyCoord( "{0} {1}".format( pos[0], pos[1] ), unit = ( astu.hourangle, astu.degree ) )
+        pos, params = find_source_params_f2( self.cont_name )
+        m_coordinates = SkyCoord( "{0} {1}".format( pos[0], pos[1] ), unit = ( astu.hourangle, astu.degree ) )
 
-            for file in sorted( os.listdir( self.cont_dir ) ):
+        pairs = {}
+        if records:
+            coords = SkyCoord( [ hdr[ 'RA' ] for hdr in records ], [ hdr[ 'DEC' ] for hdr in records ], unit = ( astu.hourangle, astu.degree ) )
+            on_source = m_coordinates.separation( coords ) <= ( tolerance * astu.arcmin )
 
-                try:
-                    hdul, mjd, fe, obs_num, obs_mode = self.hdul_setup( self.cont_dir, file )
-                except OSError:
-                    continue
+            for hdr, is_on in zip( records, on_source ):
+                file = os.path.basename( hdr[ 'PATH' ] )
+                obs_num = os.path.splitext( file )[0][-4:]
+                key = ( hdr[ 'STT_IMJD' ], hdr[ 'FRONTEND' ], obs_num )
+                pair = pairs.setdefault( key, { 'MJD' : hdr[ 'STT_IMJD' ], 'ON' : None, 'OFF' : None, 'FE' : hdr[ 'FRONTEND' ], 'NUM' : obs_num } )
+                mode = 'ON' if is_on else 'OFF'
+                if pair[ mode ] is None:
+                    pair[ mode ] = file
 
-                coords = SkyCoord( "{0} {1}".format( hdul[0].header[ 'RA' ], hdul[0].header[ 'DEC' ] ), unit = ( astu.hourangle, astu.degree ) )
-                hdul.close()
+        onoff_list = [ pair for pair in pairs.values() if ( pair[ 'ON' ] is not None ) and ( pair[ 'OFF' ] is not None ) ]
 
-                onoff_list.append( { 'MJD' : mjd, 'ON' : None, 'OFF' : None, 'FE' : fe, 'NUM' : obs_num } )
+        if self.verbose:
+            print( "Saving as {}".format( dict_file ) )
 
-                if m_coordinates.separation( coords ) <= ( tolerance * astu.arcmin ):
-                    mode = 'ON'
-                else:
-                    mode = 'OFF'
+        self.save_position( abs_dict_file, { 'DIGEST' : digest, 'LIST' : onoff_list } )
 
-                for dict in onoff_list:
-                    if (dict[ 'MJD' ] == mjd) and (dict[ 'FE' ] == fe) and (dict[ 'NUM' ] == obs_num) and (dict[ mode ] is None):
-                        dict[ mode ] = file
+        return onoff_list
 
-            for dict in reversed( onoff_list ):
-                if (dict[ 'ON' ] is None) or (dict[ 'OFF' ] is None):
-                    onoff_list.remove( dict )
+    def cal_epochs( self, onoff_list ):
 
-            if self.verbose:
-                print( "Saving as {}".format( dict_file ) )
+        """
+        Groups on/off pairs by frontend. Returns a dictionary of ( sorted MJD array, pairs in the same order ) per frontend.
+        """
 
-            self.save_position( abs_dict_file, onoff_list )
+        epochs = {}
+        for pair in sorted( onoff_list, key = lambda d: d[ 'MJD' ] ):
+            epochs.setdefault( pair[ 'FE' ], [] ).append( pair )
 
-        return onoff_list
+        return { fe : ( np.array( [ pair[ 'MJD' ] for pair in pairs ] ), pairs ) for fe, pairs in epochs.items() }
 
-    def get_closest_contfile( self, mjd_tol = 50 ):
+    def find_contfiles( self, epochs, fe, mjd, policy = 'nearest', k = 1, mjd_tol = 50 ):
 
-        onoff_list = self.get_onoff_list( tolerance = 1 )
+        """
+        Returns the on/off pairs of a frontend selected for an MJD, each less than mjd_tol days away.
 
-        a = []
+        Policies
+        --------
+        'nearest' : the k closest pairs, closest first
+        'bracket' : the last pair at or before the MJD and the first pair after it (for interpolating gains between epochs)
+        """
 
-        for directory in self.dirs:
-            for psr_file in sorted( os.listdir( directory ) ):
+        if fe not in epochs:
+            return []
+        mjds, pairs = epochs[ fe ]
+
+        if policy == 'nearest':
+            lo = np.searchsorted( mjds, mjd ) - 1
+            hi = lo + 1
+            chosen = []
+            while len( chosen ) < k:
+                d_lo = mjd - mjds[ lo ] if lo >= 0 else np.inf
+                d_hi = mjds[ hi ] - mjd if hi < len( mjds ) else np.inf
+                if min( d_lo, d_hi ) >= mjd_tol:
+                    break
+                if d_hi <= d_lo:
+                    chosen.append( pairs[ hi ] )
+                    hi += 1
+                else:
+                    chosen.append( pairs[ lo ] )
+                    lo -= 1
+            return chosen
+        elif policy == 'bracket':
+            after = np.searchsorted( mjds, mjd, side = 'right' )
+            chosen = []
+            if after > 0 and mjd - mjds[ after - 1 ] < mjd_tol:
+                chosen.append( pairs[ after - 1 ] )
+            if after < len( mjds ) and mjds[ after ] - mjd < mjd_tol:
+                chosen.append( pairs[ after ] )
+            return chosen
+        else:
+            raise ValueError( "Unknown selection policy: {}".format( policy ) )
 
-                mjd_list = []
+    def get_closest_contfile( self, mjd_tol = 50, policy = 'nearest', k = 1 ):
 
-                try:
-                    hdul, psr_mjd, psr_fe, obs_num, obs_mode = self.hdul_setup( directory, psr_file )
-                    if self.verbose:
-                        print( "Opening {}".format( psr_file ) )
-                except OSError:
-                    if self.verbose:
-                        print( "Couldn't open {}".format( psr_file ) )
-                    continue
+        """
+        Returns a list of [ PSR_CAL, ON_CAL, OFF_CAL, CAL_MJD ] for each pulsar cal file, using the on/off pairs chosen by find_contfiles.
+        Files with more than one pair chosen (k > 1 or 'bracket') have one entry per pair; files with none have ON_CAL and OFF_CAL as None.
+        """
 
-                psr_file = os.path.join( directory, psr_file )
+        epochs = self.cal_epochs( self.get_onoff_list( tolerance = 1 ) )
 
-                if obs_mode == 'CAL':
+        a = []
+
+        for hdr in select_records( self.index, self.dirs, self.files, obs_mode = "CAL" ):
+
+            psr_file, psr_mjd, psr_fe = hdr[ 'PATH' ], hdr[ 'STT_IMJD' ], hdr[ 'FRONTEND' ]
+            if self.verbose:
+                print( "Opening {}".format( os.path.basename( psr_file ) ) )
 
-                    for dict in onoff_list:
-                        if dict[ 'FE' ] == psr_fe:
-                            delta_mjd = abs( dict[ 'MJD' ] - psr_mjd )
-                            if all( elem > delta_mjd for elem in mjd_list ):
-                                mjd_list.append( delta_mjd )
-                                if delta_mjd < mjd_tol:
-                                    on = os.path.join( self.cont_dir, dict[ 'ON' ] )
-                                    off = os.path.join( self.cont_dir, dict[ 'OFF' ] )
-                                else:
-                                    on, off = [None, None]
-                    a.append( [psr_file, on, off, psr_mjd] )
+            found = self.find_contfiles( epochs, psr_fe, psr_mjd, policy = policy, k = k, mjd_tol = mjd_tol )
+            if not found:
+                a.append( [psr_file, None, None, psr_mjd] )
+            for dict in found:
+                on = os.path.join( self.cont_dir, dict[ 'ON' ] )
+                off = os.path.join( self.cont_dir, dict[ 'OFF' ] )
+                a.append( [psr_file, on, off, psr_mjd] )
 
         return a
 
@@ -224,6 +327,8 @@ class FluxCalibrator:
         if cal_file_list.ndim != 1:
             raise ValueError( "Should be a vector" )
 
+        from pypulse.archive import Archive
+
         archives = []
         freqs = []
         for f in cal_file_list[:-1]:
@@ -252,6 +357,7 @@ class FluxCalibrator:
         F_cal = ( T_sys * F_OFF ) / G
 
 
+        from scipy.interpolate import interp1d
         Fa, Fb = interp1d( aabb_list[1][ 'FREQS' ], F_cal[0][0], kind='cubic', fill_value = 'extrapolate' ), interp1d( aabb_list[2][ 'FREQS' ], F_cal[0][1], kind='cubic', fill_value = 'extrapolate' )
 
         conversion_factor = [ np.array(Fa( aabb_list[0][ 'FREQS' ] ) / ( H[0][0] - L[0][0] )), np.array( Fb( aabb_list[0][ 'FREQS' ] ) / ( H[0][1] - L[0][1] ) ) ]
@@ -262,46 +368,30 @@ class FluxCalibrator:
 
     def _prepare_calibration( self, archive_list, r_err = 8 ):
 
+        """
+        Returns the on (high) and off (low) cal levels and the continuum flux of every channel of every polarization,
+        each as an array of shape (archive, pol, chan).
+        """
+
         H = []
         L = []
         T0 = []
 
         for dict in archive_list:
-            all_high_means = []
-            all_low_means = []
-            T0_pol = []
-
-            for pol in dict[ 'DATA' ]:
-                high_means = []
-                low_means = []
-                T0_chan = []
-
-                for i, channel in enumerate( pol ):
-
-                    flux = getFlux( float( dict[ 'FREQS' ][i]/1000 ), self.cont_name, False )
-
-                    start_bin = math.floor( len( channel ) * dict[ 'S_DUTY' ] )
-                    mid_bin = math.floor( len( channel ) * ( dict[ 'S_DUTY' ] + dict[ 'DUTY' ] ) )
-                    end_bin = mid_bin + ( math.floor( len( channel ) * dict[ 'DUTY' ] ) )
-                    bin_params = [ start_bin, mid_bin, end_bin ]
 
-                    low_mean = np.mean( channel[ bin_params[0] : bin_params[1] ] )
-                    high_mean = np.mean( channel[ bin_params[1] : bin_params[2] ] )
+            cube = np.asarray( dict[ 'DATA' ] )
+            nbin = cube.shape[-1]
 
-                    low_mean = round( low_mean, r_err )
-                    high_mean = round( high_mean, r_err )
+            # The cal duty cycle is the same for every channel, so the bin boundaries are found once per archive
+            start_bin = math.floor( nbin * dict[ 'S_DUTY' ] )
+            mid_bin = math.floor( nbin * ( dict[ 'S_DUTY' ] + dict[ 'DUTY' ] ) )
+            end_bin = mid_bin + ( math.floor( nbin * dict[ 'DUTY' ] ) )
 
-                    high_means.append( high_mean )
-                    low_means.append( low_mean )
-                    T0_chan.append( flux )
+            L.append( np.round( np.mean( cube[ ..., start_bin : mid_bin ], axis = -1 ), r_err ) )
+            H.append( np.round( np.mean( cube[ ..., mid_bin : end_bin ], axis = -1 ), r_err ) )
 
-                all_high_means.append( high_means )
-                all_low_means.append( low_means )
-                T0_pol.append( T0_chan )
-
-            H.append( all_high_means )
-            L.append( all_low_means )
-            T0.append( T0_pol )
+            flux = getFlux( np.asarray( dict[ 'FREQS' ], dtype = float )/1000, self.cont_name, False )
+            T0.append( np.broadcast_to( flux, cube.shape[:-1] ) )
 
         H = np.array(H)
         L = np.array(L)
@@ -320,11 +410,10 @@ class FluxCalibrator:
         cal_mjd_file = "{}_{}_fluxcalibration_cal_mjds.pkl".format( self.psr_name, self.cont_name )
         conv_abs_path, cal_abs_path = os.path.join( self.pkl_dir, 'calibration', conv_file ), os.path.join( self.pkl_dir, 'calibration', cal_mjd_file )
 
-        if os.path.isfile( conv_abs_path ):
+        conversion_factors, cal_mjds = self.load_session( conv_abs_path ), self.load_session( cal_abs_path )
+        if ( conversion_factors is not None ) and ( cal_mjds is not None ):
             if self.verbose:
                 print( "Loading previously saved conversion factor data..." )
-            conversion_factors = self.load_session( conv_abs_path )
-            cal_mjds = self.load_session( cal_abs_path )
         else:
             if self.verbose:
                 print( "Making new conversion factor list..." )
@@ -332,6 +421,11 @@ class FluxCalibrator:
             conversion_factors = []
             cal_mjds = []
             for e in self.get_closest_contfile():
+                # Cal files without a usable ON / OFF continuum pair cannot be converted
+                if e[1] is None or e[2] is None:
+                    if self.verbose:
+                        print( "No continuum ON / OFF pair found for {}. Skipping...".format( os.path.basename( e[0] ) ) )
+                    continue
                 conversion_factors.append( self.calculate_Jy_per_count( e ) )
                 cal_mjds.append( e[3] )
 
@@ -353,25 +447,17 @@ class FluxCalibrator:
 
         counter = 0
 
-        for directory in self.dirs:
-            for psr_file in sorted( os.listdir( directory ) ):
-                try:
-                    hdul, psr_mjd, psr_fe, obs_num, obs_mode = self.hdul_setup( directory, psr_file, False )
-                    if self.verbose:
-                        print( "Opening {}".format( psr_file ) )
-                except OSError:
-                    if self.verbose:
-                        try:
-                            print( "Couldn't open {}".format( psr_file ) )
-                        except UnicodeEncodeError:
-                            print( "Couldn't open {}".format( psr_file.encode( "utf-8" ) ) )
-                    continue
+        records = select_records( self.index, self.dirs, self.files, obs_mode = "PSR" )
+        mjds = { hdr[ 'PATH' ] : hdr[ 'STT_IMJD' ] for hdr in records }
 
-                if obs_mode != "PSR":
-                    continue
+        # The next archive is loaded while the current one is calibrated
+        with Prefetcher( [ hdr[ 'PATH' ] for hdr in records ], self.load_archive, depth = self.prefetch, max_bytes = self.prefetch_bytes ) as archives:
+            for file, ar in archives:
+
+                if self.verbose:
+                    print( "Opened {}".format( os.path.basename( file ) ) )
 
-                ar = Archive( os.path.join( directory, psr_file ), verbose = self.verbose )
-                ar.reset()
+                psr_mjd = mjds[ file ]
                 data = ar.getData( weight = False )
                 new_data = []
                 for sub in data:
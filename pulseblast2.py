@@ -5,14 +5,219 @@
 
 EXT = '.fits'
 
-from rfi_mitigation import SigmaClip_Mitigator, Bayesian_Mitigator, NN_Mitigator
-import template_builder as tb
-from flux_calibrator import FluxCalibrator
-from timing import Timer
-from utils.otherUtilities import count_files
+import time
+_start = time.perf_counter()
+
+import os
+import sys
+import argparse
+from utils.pipeline import Pipeline, summarize, OK
+
+# Stages are only imported (with their matplotlib / scipy / astropy / pypulse dependencies) when they are first used
+from utils.lazy import lazy_import, lazy_attr
+SigmaClip_Mitigator = lazy_attr( 'rfi_mitigation', 'SigmaClip_Mitigator' )
+Bayesian_Mitigator = lazy_attr( 'rfi_mitigation', 'Bayesian_Mitigator' )
+NN_Mitigator = lazy_attr( 'rfi_mitigation', 'NN_Mitigator' )
+tb = lazy_import( 'template_builder' )
+FluxCalibrator = lazy_attr( 'flux_calibrator', 'FluxCalibrator' )
+time_pulsars = lazy_attr( 'timing', 'time_pulsars' )
+count_files = lazy_attr( 'utils.otherUtilities', 'count_files' )
+Scanner = lazy_attr( 'utils.scanner', 'Scanner' )
+
+MITIGATORS = { 's' : SigmaClip_Mitigator, 'b' : Bayesian_Mitigator, 'n' : NN_Mitigator }
+
+
+def read_list( arg ):
+
+    """
+    Reads a list of directories or pulsar names given as a single name, a ["a","b"] list or a .txt file with one per line.
+    """
+
+    if arg.startswith( "[" ):
+        return [ item.strip().strip( '"' ).strip( "'" ) for item in arg.strip( "[]" ).split( "," ) if item.strip() ]
+    if arg.endswith( ".txt" ):
+        with open( arg, "r" ) as f:
+            return [ line.strip() for line in f if line.strip() ]
+    if arg == "None":
+        return []
+    return [ arg ]
+
+
+class _StageFlag( argparse.Action ):
+
+    """
+    Stores a stage flag and records the order the stage flags were given in.
+    """
+
+    def __call__( self, parser, namespace, values, option_string = None ):
+        setattr( namespace, self.dest, values if values else self.const )
+        order = [ stage for stage in getattr( namespace, 'order', [] ) if stage != self.dest ]
+        setattr( namespace, 'order', order + [ self.dest ] )
+
+
+def build_parser():
+
+    parser = argparse.ArgumentParser( formatter_class = argparse.RawDescriptionHelpFormatter,
+                    prog = 'pulseblast2.py', description = '''\
+                                 PulseBlast V2
+                   -------------------------------------------
+                     Runs the template builder, RFI mitigation,
+                   flux calibration and timing for every pulsar.
+                  Run without arguments for the interactive prompt.
+                        ''' )
+    parser.add_argument( '--startup-profile', dest = 'startup_profile', action = 'store_true', default = False, help = 'Prints the startup time and the import cost of every stage, then exits.' )
+    subparsers = parser.add_subparsers( dest = 'command' )
+
+    run = subparsers.add_parser( 'run', formatter_class = argparse.RawDescriptionHelpFormatter, help = 'Runs the requested stages for every pulsar without prompting.',
+                    description = "Stages run as -m first, then -r and -c in the order given, then -t. A stage is skipped if one it depends on fails.\n"
+                                  "The exit status is 0 only if every stage succeeded for every pulsar." )
+    run.add_argument( dest = 'directories', help = 'Directory, ["dir1","dir2"] list or .txt file of directories containing PSRFITS files (None for the default).' )
+    run.add_argument( dest = 'psr_names', help = 'Pulsar name, ["psr1","psr2"] list or .txt file of pulsar names as given in the PSRFITS files.' )
+    run.add_argument( '-v', dest = 'verbose', nargs = '?', const = 'mcrt', default = '', help = 'Verbose; optionally only for some stages (e.g. -v mc for templates and calibration).' )
+    run.add_argument( '-j', dest = 'workers', type = int, default = 1, help = 'Number of worker processes for RFI mitigation and timing.' )
+    run.add_argument( '-l', dest = 'log', nargs = '?', const = 'errors.log', default = None, help = 'Appends failed stages to a log file (errors.log if no file is given).' )
+    run.add_argument( '--flat', dest = 'flat', action = 'store_true', default = False, help = 'Only searches the given directories, not their subdirectories.' )
+    run.add_argument( '--dry-run', dest = 'dry_run', action = 'store_true', default = False, help = 'Prints the stage order without running anything.' )
+
+    templates = run.add_argument_group( 'template builder' )
+    templates.add_argument( '-m', dest = 'm', action = _StageFlag, nargs = 0, const = True, default = False, help = 'Template builder.' )
+    templates.add_argument( '-f', dest = 'frontend', default = None, help = 'Frontend to build templates for (required with -m).' )
+    templates.add_argument( '-s', dest = 'subbands', type = int, default = None, help = 'Number of subbands (required with -m, used by timing).' )
+    templates.add_argument( '-p', dest = 'template_dir', default = 'templates', help = 'Template directory.' )
+
+    rfi = run.add_argument_group( 'RFI mitigation' )
+    rfi.add_argument( '-r', dest = 'r', action = _StageFlag, nargs = '?', const = 's', default = None, choices = sorted( MITIGATORS ), help = 'RFI mitigation by sigma clipping (-r, -rs), Bayesian (-rb) or neural network (-rn) methods.' )
+    rfi.add_argument( '-i', dest = 'iterations', type = int, default = 1, help = 'Number of excision iterations.' )
+    rfi.add_argument( '-q', dest = 'temp_dir', default = None, help = 'Template directory used for mitigation and timing (defaults to -p).' )
+    rfi.add_argument( '-g', dest = 'saveddata_dir', default = 'data', help = 'Directory to save mitigated data to.' )
+    rfi.add_argument( '-e', dest = 'epoch_avg', action = 'store_true', default = False, help = 'Averages in time before excision.' )
+
+    cal = run.add_argument_group( 'flux calibration' )
+    cal.add_argument( '-c', dest = 'c', action = _StageFlag, nargs = 0, const = True, default = False, help = 'Flux calibration.' )
+    cal.add_argument( '-n', dest = 'cont_name', default = None, help = 'Continuum source name (required with -c).' )
+    cal.add_argument( '-w', dest = 'cont_dir', default = None, help = 'Continuum source cal file directory.' )
+    cal.add_argument( '-d', dest = 'saveddata_dir2', default = None, help = 'Directory to save calibrated data to (defaults to -g).' )
+
+    timing = run.add_argument_group( 'timing' )
+    timing.add_argument( '-t', dest = 't', action = _StageFlag, nargs = 0, const = True, default = False, help = 'Creates TOAs.' )
+    timing.add_argument( '--batch-fit', dest = 'batch_fit', action = 'store_true', default = False, help = 'Fits all archives of a frontend at once and writes one .tim file per frontend (default times each archive with pypulse).' )
+
+    return parser
+
+
+def build_pipeline( args, dirs, catalog = None ):
+
+    """
+    Returns the stage pipeline requested by the parsed run arguments.
+    Templates go first, RFI mitigation and calibration follow in the order their flags were given, and timing goes last.
+    If a scanner catalog is given, each stage gets the pulsar's files from it instead of searching the directories itself.
+    """
+
+    def files( psr ):
+        return catalog.files( psr_name = psr ) if catalog is not None else None
+
+    temp_dir = args.temp_dir if args.temp_dir is not None else args.template_dir
+    subbands = args.subbands if args.subbands is not None else 1
+    order = getattr( args, 'order', [] )
+    pipeline = Pipeline( verbose = bool( args.verbose ) )
+    done = []
+
+    if args.m:
+        def templates( psr ):
+            tb.FD_Template( psr, args.frontend, args.subbands, *dirs, template_dir = args.template_dir, files = files( psr ), verbose = 'm' in args.verbose ).make_template()
+        pipeline.add( 'templates', templates )
+        done.append( 'templates' )
+
+    # RFI mitigation stores its zap masks in the pulsar's weights store in saveddata_dir (-g), which calibration and
+    # timing apply to the same input files, so the stages after it see the excised data
+    def rfi( psr ):
+        MITIGATORS[ args.r ]( psr, *dirs, iterations = args.iterations, temp_dir = temp_dir, saveddata_dir = args.saveddata_dir, epoch_avg = args.epoch_avg,
+                              save_as_mask = True, files = files( psr ), workers = args.workers, verbose = 'r' in args.verbose ).mitigation_setup()
+
+    def calibration( psr ):
+        saveddata_dir = args.saveddata_dir2 if args.saveddata_dir2 is not None else args.saveddata_dir
+        FluxCalibrator( psr, args.cont_name, *dirs, cont_dir = args.cont_dir, saveddata_dir = saveddata_dir, mask_dir = args.saveddata_dir,
+                        files = files( psr ), verbose = 'c' in args.verbose ).calibrate()
+
+    main_block = { 'r' : ( 'rfi', rfi ), 'c' : ( 'calibration', calibration ) }
+    for flag in order:
+        if flag in main_block:
+            name, run = main_block[ flag ]
+            pipeline.add( name, run, requires = done[-1:] )
+            done.append( name )
+
+    if args.t:
+        def timing( psr ):
+            time_pulsars( [ psr ], *dirs, temp_dir = temp_dir, saveddata_dir = args.saveddata_dir, subbands = subbands, files = files( psr ), workers = args.workers,
+                          batch = args.batch_fit, verbose = 't' in args.verbose )
+        pipeline.add( 'timing', timing, requires = done[-1:] )
+
+    return pipeline
+
+
+def main( argv = None ):
+
+    """
+    Runs the command line interface and returns the exit status.
+    """
+
+    parser = build_parser()
+    args = parser.parse_args( argv )
+
+    if args.startup_profile:
+        from utils.startup import startup_profile
+        startup_profile( time.perf_counter() - _start )
+        return 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    if args.m and ( args.frontend is None or args.subbands is None ):
+        parser.error( "-m requires a frontend (-f) and a number of subbands (-s)" )
+    if args.m and args.subbands <= 0:
+        parser.error( "the number of subbands must be positive" )
+    if args.c and args.cont_name is None:
+        parser.error( "-c requires a continuum name (-n)" )
+
+    try:
+        dirs, psr_names = read_list( args.directories ), read_list( args.psr_names )
+    except FileNotFoundError as e:
+        parser.error( "list file not found: {}".format( e.filename ) )
+    if not psr_names:
+        parser.error( "no pulsar names given" )
+
+    if not ( args.m or args.r or args.c or args.t ):
+        parser.error( "no stages requested (use -m, -r, -c and/or -t)" )
+    if args.dry_run:
+        print( "Stages: {}".format( " -> ".join( stage.name for stage in build_pipeline( args, dirs ).order() ) ) )
+        return 0
+    if args.verbose:
+        count_files( "*" + EXT, *dirs, recursive = not args.flat, magic = True, verbose = True )
+
+    # Every directory is walked once and each pulsar's stages are given its share of the files
+    catalog = Scanner( recursive = not args.flat, verbose = bool( args.verbose ) ).scan( *dirs ) if dirs else None
+    pipeline = build_pipeline( args, dirs, catalog )
+    print( "Stages: {}".format( " -> ".join( stage.name for stage in pipeline.order() ) ) )
+
+    results = pipeline.run_all( psr_names )
+    bad = summarize( results )
+
+    if args.log is not None and bad:
+        with open( args.log, "a" ) as f:
+            for psr, status in results.items():
+                for name, state in status.items():
+                    if state != OK:
+                        f.write( "{} {} {}\n".format( psr, name, state ) )
+
+    return 1 if bad else 0
+
 
 if __name__ == "__main__":
 
+    # Any arguments run the batch interface; without them the interactive prompt below is used
+    if len( sys.argv ) > 1:
+        sys.exit( main() )
+
     print("""
     Welcome to PulseBlast V2
     """)
@@ -413,27 +618,33 @@ if __name__ == "__main__":
                                 # run sigma clip with iterations, temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with iterations, temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
 
                     elif temp_dir == None:
                         if saveddata_dir != None:
@@ -441,27 +652,33 @@ if __name__ == "__main__":
                                 # run sigma clip with iterations saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with iterations, epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                 elif iterations == None:
                     if temp_dir != None:
                         if saveddata_dir != None:
@@ -469,60 +686,70 @@ if __name__ == "__main__":
                                 # run sigma clip with temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                     elif temp_dir == None:
                         if saveddata_dir != None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
 
-                rfi.mitigation_setup()
 
             if t_index > r_index:
-                timer = Timer( name, jump_flags = "", epochs = 1, subbands = subbands, verbose = t_verbose )
-                timer.time()
+                time_pulsars( psr_names, jump_flags = "", epochs = 1, subbands = subbands, verbose = t_verbose )
                 pass
 
         elif r_index < c_index:
@@ -541,27 +768,33 @@ if __name__ == "__main__":
                                 # run sigma clip with iterations, temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with iterations, temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
 
                     elif temp_dir == None:
                         if saveddata_dir != None:
@@ -569,27 +802,33 @@ if __name__ == "__main__":
                                 # run sigma clip with iterations saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with iterations, epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with iterations, epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with iterations, epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, iterations = iterations, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                 elif iterations == None:
                     if temp_dir != None:
                         if saveddata_dir != None:
@@ -597,56 +836,67 @@ if __name__ == "__main__":
                                 # run sigma clip with temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with temp_dir, saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, temp_dir = temp_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, temp_dir = temp_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with temp_dir, epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, temp_dir = temp_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                     elif temp_dir == None:
                         if saveddata_dir != None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with saveddata_dir and epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, saveddata_dir = saveddata_dir, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                         elif saveddata_dir == None:
                             if ("-r" in commands) or ("-rs" in commands):
                                 # run sigma clip with epoch_avg=true
                                 for name in psr_names:
                                     rfi = SigmaClip_Mitigator( name, *dirs, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rb" in commands:
                                 # run bayesian with epoch_avg=true
                                 for name in psr_names:
                                     rfi = Bayesian_Mitigator( name, *dirs, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
                             elif "-rn" in commands:
                                 # run neural with epoch_avg=true
                                 for name in psr_names:
                                     rfi = NN_Mitigator( name, *dirs, epoch_avg = epoch_avg, verbose = r_verbose )
+                                    rfi.mitigation_setup()
 
-                rfi.mitigation_setup()
 
             if (t_index > r_index) and (t_index < c_index):
                 print("Timing should go last")
@@ -662,8 +912,7 @@ if __name__ == "__main__":
                     pass
 
             if t_index > c_index:
-                timer = Timer( name, jump_flags = "", epochs = 1, subbands = subbands, verbose = t_verbose )
-                timer.time()
+                time_pulsars( psr_names, jump_flags = "", epochs = 1, subbands = subbands, verbose = t_verbose )
 
     if ("-l" in commands) and (errors != []):
         # write to log file
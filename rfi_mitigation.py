@@ -16,25 +16,21 @@ FIT = True
 
 # Local imports
 import utils.pulsarUtilities as pu
-import utils.plotUtils as pltu
-import utils.otherUtilities as u
-import utils.mathUtils as mathu
-from utils.saving import save_psrfits, save_session
-from utils.loading import load_session as load
+from utils.saving import save_psrfits
+from utils.header_index import HeaderIndex
+from utils.scanner import select_records
+from utils.journal import SessionJournal
+from utils.ignore_index import IgnoreIndex
+from utils.weights_store import WeightsStore, weights_store_path
+from utils.prefetch import Prefetcher
+from utils.clipping import ClipEngine
+from utils.rfi_report import histogram_record, append_records, diagnostics_path
 from custom_exceptions import TemplateLoadError
-from template_builder import FD_Template
-
-import matplotlib.pyplot as plt
-import scipy.stats as spyst
 
 # Imports
-from pypulse.archive import Archive
 import numpy as np
-import pickle
-from astropy.io import fits
 import os
-
-TOL = 1e-7
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 file_root = os.path.dirname( os.path.abspath( __file__ ) )
 
@@ -45,9 +41,40 @@ class RFIBlaster:
     Base class for RFI mitigation in PulseBlast
 
     Initializing this base class and mitigating will return the data as input.
+
+    Parameters
+    ----------
+    psr_name      : str
+        Name of PSR as given in the PSRFITS files
+    *dirs         : str, os.Path, [str, ..., str], [os.Path, ..., os.Path], optional
+        Directories to look for files with which to mitigate RFI (default is saveddata_dir)
+    iterations    : int, optional
+        Number of mitigation iterations to conduct
+    temp_dir      : str, os.Path, optional
+        Location to save / load templates to / from (local to this file)
+    saveddata_dir : str, os.Path, optional
+        Location to save newly RFI excised PSRFITS files (local to this file)
+    epoch_avg     : bool, optional
+        Determines whether profiles should be day averaged before mitigation
+    save_as_np    : bool, optional
+        Saves the excised data and weights as .npy files instead of PSRFITS
+    workers       : int, optional
+        Number of processes to mitigate files with concurrently (default is 1)
+    prefetch      : int, optional
+        Number of files to read ahead while the current file is mitigated (0 to disable)
+    prefetch_bytes: int, optional
+        Memory budget in bytes for files read ahead (default is no limit)
+    save_as_mask  : bool, optional
+        Stores only the zap mask of each file in the pulsar's weights store in saveddata_dir instead of a copy of the file
+    whole_channels: bool, optional
+        Zaps every subintegration of a channel with any outlying profile (otherwise only the outlying profiles are zapped)
+    files         : [str, ..., str], optional
+        Paths of the files to mitigate (e.g. from a scanner Catalog), used instead of searching dirs
+    verbose       : bool, optional
+        Displays more information to the console
     """
 
-    def __init__( self, psr_name, *dirs, iterations = 1, temp_dir = "templates", saveddata_dir = "data", epoch_avg = False, save_as_np = False, verbose = False ):
+    def __init__( self, psr_name, *dirs, iterations = 1, temp_dir = "templates", saveddata_dir = "data", epoch_avg = False, save_as_np = False, save_as_mask = False, whole_channels = False, files = None, workers = 1, prefetch = 1, prefetch_bytes = None, verbose = False ):
 
         self.psr_name = str( psr_name )
         self.temp_dir = os.path.join( file_root, self.psr_name, temp_dir )
@@ -62,11 +89,25 @@ class RFIBlaster:
             self.dirs = [self.saveddata_dir]
         else:
             self.dirs = dirs
+        self.files = files
         self.pklfile = os.path.join( self.pkl_dir, "{}_rfimitigation_save.pkl".format( self.psr_name ) )
+        self.journal = SessionJournal( os.path.join( self.pkl_dir, "{}_rfimitigation_save.jnl".format( self.psr_name ) ), 'r', legacy = self.pklfile )
         self.iterations = iterations
         self.epoch_average = epoch_avg
         self.save_as_np = save_as_np
+        self.save_as_mask = save_as_mask
+        self.whole_channels = whole_channels
+        self.weights_store = WeightsStore( weights_store_path( self.saveddata_dir, self.psr_name ), verbose = verbose )
+        self.diagnostics_file = diagnostics_path( self.pkl_dir, self.psr_name )
+        self.store_outputs = True
+        self.pending_masks = []
+        self.pending_diagnostics = []
         self.method = self.get_method()
+        self.index = HeaderIndex()
+        self.workers = max( int( workers ), 1 )
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+        self.ignored = IgnoreIndex()
 
     def __repr__( self ):
         return "RFIBlaster( psr_name = {} )".format( self.psr_name )
@@ -99,11 +140,84 @@ class RFIBlaster:
 
         return template
 
+    def get_template( self, fe, do_fit = False ):
+
+        """
+        Loads the n = 1 template for a frontend, offering to build one if it does not exist.
+        """
+
+        tmp_fn = "{0}_{1}_nchan1_template.npy".format( self.psr_name, fe )
+        try:
+            template = self.load_template( self.temp_dir, tmp_fn )
+        except TemplateLoadError:
+            print( "Template not found" )
+            try:
+                reply = str( input( "Would you like to make a suitable one? ('y' for yes)" ) ).lower().strip()
+            except EOFError:
+                # No terminal to answer on (e.g. a batch job)
+                reply = 'n'
+            if reply[:1] == 'y':
+                from template_builder import FD_Template
+                temp = FD_Template( self.psr_name, fe, 1, template_dir = "templates", files = self.files, verbose = self.verbose, *self.dirs )
+                template = temp.make_template( gaussian_fit = do_fit )
+            else:
+                raise TemplateLoadError( "You can make a suitable template via the following command: python template_builder.py psr_name -b [frontend] -d [dirs]" )
+
+        return template
+
     def load_session( self ):
-        return load( self.pklfile, mode = 'r' )
+        self.journal.load()
+        self.ignored = IgnoreIndex( self.journal.state[ 'IG_LIST' ] )
+        return self.journal.session()
+
+    def is_mitigated( self, directory, f ):
+
+        """
+        Checks the ignore index for an unchanged copy of the file already excised with this method.
+        """
+
+        if self.ignored.contains( os.path.join( directory, f ), self.method ):
+            if self.verbose:
+                print( "{} has already been excised using method {}".format( f, self.method ) )
+            return True
+        return False
+
+    def save_position( self, file, data, position, *done ):
+
+        """
+        Records the current position in the session journal, adding any completed ignore list entries.
+        """
+
+        for entry in done:
+            self.ignored.add( entry )
+
+        return self.journal.record( add = done, FILE = file, DATA = data, POS = position )
+
+
+    def save_mask( self, file, weights ):
+
+        """
+        Stores the zap mask of a file. Worker processes keep it in pending_masks for the parent process to store.
+        """
+
+        record = self.weights_store.make_record( file, weights, self.method, ITERATIONS = int( self.iterations ), EPOCH_AVG = bool( self.epoch_average ) )
+        if self.store_outputs:
+            return self.weights_store.put( record )
+        self.pending_masks.append( record )
+        return record[0]
+
+    def save_diagnostics( self, record ):
 
-    def save_position( self, file, data, position, ignore_list ):
-        return save_session( self.pklfile, *[ file, data, position, ignore_list ], mode = 'r' )
+        """
+        Appends a diagnostics record to the pulsar's diagnostics file (rendered later by utils.rfi_report).
+        Worker processes keep it in pending_diagnostics for the parent process to write.
+        """
+
+        if self.store_outputs:
+            append_records( self.diagnostics_file, record )
+        else:
+            self.pending_diagnostics.append( record )
+        return record
 
 
     def prepare_file( self, file, do_fit = False ):
@@ -112,31 +226,19 @@ class RFIBlaster:
         Prepares the PSRFITS file in the correct format for the program.
         """
 
-        try:
-            hdul = fits.open( file )
-        except OSError:
+        hdr = self.index.lookup( file )
+        if hdr is None:
             return -1
 
-        name = hdul[0].header[ 'SRC_NAME' ]
-        fe = hdul[0].header[ 'FRONTEND' ]
-        mjd = hdul[0].header[ 'STT_IMJD' ]
-        if hdul[0].header[ 'OBS_MODE' ] != "PSR" or name != self.psr_name:
-            hdul.close()
+        name = hdr[ 'SRC_NAME' ]
+        fe = hdr[ 'FRONTEND' ]
+        mjd = hdr[ 'STT_IMJD' ]
+        if hdr[ 'OBS_MODE' ] != "PSR" or name != self.psr_name:
             return -1
-        hdul.close()
 
-        tmp_fn = "{0}_{1}_nchan1_template.npy".format( self.psr_name, fe )
-        try:
-            template = self.load_template( self.temp_dir, tmp_fn )
-        except TemplateLoadError:
-            print( "Template not found" )
-            reply = str( input( "Would you like to make a suitable one? ('y' for yes)" ) ).lower().strip()
-            if reply[0] == 'y':
-                temp = FD_Template( self.psr_name, fe, 1, template_dir = "templates", verbose = self.verbose, *self.dirs )
-                template = temp.make_template( gaussian_fit = do_fit )
-            else:
-                raise TemplateLoadError( "You can make a suitable template via the following command: python template_builder.py psr_name -b [frontend] -d [dirs]" )
+        template = self.get_template( fe, do_fit = do_fit )
 
+        from pypulse.archive import Archive
         ar = Archive( file, verbose = self.verbose )
         if self.epoch_average:
             ar.tscrunch( nsubint = 1 )
@@ -144,24 +246,34 @@ class RFIBlaster:
         return ar, template, fe, mjd
 
 
+    def zap_mask( self, archive, mask ):
+
+        """
+        Sets the weights of every profile where mask is True to zero in one operation.
+        mask must broadcast to the (nsubint, nchan) weights, so a mask of shape (1, nchan) zaps whole channels.
+        Returns the weighted data and the archive.
+        """
+
+        mask = np.broadcast_to( np.asarray( mask, dtype = bool ), np.shape( archive.weights ) )
+        archive.weights = np.where( mask, 0.0, archive.weights )
+
+        # Setting the data again makes pypulse recompute the weighted data with the new weights
+        archive.data = archive.data
+        if self.verbose:
+            print( "Zapped {} profiles".format( np.count_nonzero( mask ) ) )
+
+        return archive.getData(), archive
+
     def zap( self, file, archive, p, ignore_list, index ):
 
-        if isinstance( index, int ):
-            if self.verbose:
-                print( "Zapping channel {}".format( index ) )
-            archive.setWeights( 0.0, f = index )
-        elif isinstance( index, ( list, tuple, np.ndarray ) ):
-            for elem in index:
-                if p[1] > elem:
-                    print( p[1], elem )
-                    continue
-                save = self.save_position( file, archive.getData(), [0, elem], ignore_list )
-                if self.verbose:
-                    print( "Zapping channel {}".format( elem ) )
-                archive.setWeights( 0.0, f = elem )
-        data = archive.getData()
+        """
+        Zaps whole channels given a channel index or a list of them.
+        """
+
+        mask = np.zeros( archive.getNchan(), dtype = bool )
+        mask[ index ] = True
 
-        return data, archive
+        return self.zap_mask( archive, mask[ np.newaxis, : ] )
 
 
     def mitigate( self, file, p, template, archive, ignore_list ):
@@ -174,81 +286,169 @@ class RFIBlaster:
         return archive, mu, sigma, data
 
 
+    def mitigate_file( self, directory, f, p = None, ignore_list = None, prep = None ):
+
+        """
+        Runs every mitigation iteration on a single file and saves the result.
+        prep is the output of prepare_file if the file has already been loaded.
+        Returns the ignore list entry for the file, or None if the file could not be prepared.
+        """
+
+        if p is None:
+            p = [0, 0]
+        if ignore_list is None:
+            ignore_list = []
+
+        root, ext = os.path.splitext( f )
+        obs_num = root[-4:]
+
+        if prep is None:
+            prep = self.prepare_file( os.path.join( directory, f ), do_fit = FIT )
+        if prep == -1:
+            if self.verbose:
+                try:
+                    print( "Preparation of file {} failed. Skipping...".format( f ) )
+                except UnicodeEncodeError:
+                    print( "Preparation of file {} failed. Skipping...".format( f.encode( 'utf-8' ) ) )
+            return None
+
+        ar, template, fe, mjd = prep[0], prep[1], prep[2], prep[3]
+
+        # Start mitigation
+
+        ar, mu, sigma, data = self.mitigate( f, p, template, ar, ignore_list )
+
+        # End mitigation
+
+        save_fn = "{0}_{1}_{2}_{3}".format( self.psr_name, mjd, fe, obs_num )
+        if self.save_as_mask:
+            self.save_mask( os.path.join( directory, f ), ar.getWeights( squeeze = False ) )
+        elif self.save_as_np:
+            np.save( os.path.join( self.saveddata_dir, save_fn ), data )
+            save_fn += "_DATWTS"
+            np.save( os.path.join( self.saveddata_dir, save_fn ), ar.getWeights() )
+        else:
+            save_fn += ext
+            # Mitigation only zaps weights, so DAT_WTS is patched into a copy of the original file
+            save_psrfits( os.path.join( self.saveddata_dir, save_fn ), ar, mode = 'weights' )
+
+        if self.verbose:
+            print( "{0} fully mitigated using method {1}.".format( f, self.method ) )
+
+        return self.ignored.make_entry( os.path.join( directory, f ), self.method )
+
+
+    def archives( self ):
+
+        """
+        Returns the header records of the pulsar's PSR mode files, from self.files if given or else from the stored directories.
+        """
+
+        return select_records( self.index, self.dirs, self.files, psr_name = self.psr_name, obs_mode = "PSR" )
+
     def mitigation_setup( self ):
 
-        for directory in self.dirs:
+        if self.workers > 1:
+            return self.parallel_mitigation_setup()
+
+        last_file, data, p, ignore_list = self.load_session()
+
+        jobs, frontends = [], set()
+        for hdr in self.archives():
+
+            directory, f = os.path.split( hdr[ 'PATH' ] )
+            if self.is_mitigated( directory, f ):
+                continue
 
-            if not os.path.exists( directory ):
+            # Resume from the file the last session stopped in
+            if (last_file is not None) and (last_file not in ( hdr[ 'PATH' ], f )):
+                if self.verbose:
+                    print( "File {} does not match file in saved data. Skipping...".format( f ) )
                 continue
+            last_file = None
 
-            for f in sorted( os.listdir( directory ) ):
+            jobs.append( ( directory, f ) )
+            frontends.add( hdr[ 'FRONTEND' ] )
 
-                root, ext = os.path.splitext( f )
-                obs_num = root[-4:]
+        # Templates are made (interactively if need be) before files are loaded in the background
+        for fe in sorted( frontends ):
+            self.get_template( fe, do_fit = FIT )
 
-                last_file, data, p, ignore_list = self.load_session()
-                ig_dict = { 'FILE' : f, 'METHOD' : self.method }
+        # The next file is read while the current one is mitigated
+        with Prefetcher( jobs, lambda job: self.prepare_file( os.path.join( *job ), do_fit = FIT ), depth = self.prefetch, max_bytes = self.prefetch_bytes ) as files:
+            for ( directory, f ), prep in files:
 
-                ig = False
-                for dict in ignore_list:
-                    if (f == dict[ 'FILE' ]) and (dict[ 'METHOD' ] == self.method ):
-                        if self.verbose:
-                            print( "{} has already been excised using method {}".format( f, self.method ) )
-                        ig = True
-                        break
-                if ig:
+                p = self.journal.state[ 'POS' ]
+                ig_dict = self.mitigate_file( directory, f, p, ignore_list, prep = prep )
+                if ig_dict is None:
                     continue
 
-                if (last_file is not None) and (last_file != f):
-                    if self.verbose:
-                        print( "File {} does not match file in saved data. Skipping...".format( f ) )
-                    continue
+                self.save_position( None, None, [0, 0], ig_dict )
 
-                prep = self.prepare_file( os.path.join( directory, f ), do_fit = FIT )
-                if prep == -1:
-                    if self.verbose:
-                        try:
-                            print( "Preparation of file {} failed. Skipping...".format( f ) )
-                        except UnicodeEncodeError:
-                            print( "Preparation of file {} failed. Skipping...".format( f.encode( 'utf-8' ) ) )
-                    continue
+        self.journal.compact()
+        self.journal.close()
 
-                ar, template, fe, mjd = prep[0], prep[1], prep[2], prep[3]
-
-                # Start mitigation
-
-                for it in np.arange( self.iterations ):
-                    ar, mu, sigma, data = self.mitigate( f, p, template, ar, ignore_list )
-                    if self.verbose:
-                        print( "Data loaded for iteration {}".format( it + 1 ) )
-                    try:
-                        if (abs( old_mu - mu ) < TOL) and (abs( old_s - sigma ) < TOL):
-                            if self.verbose:
-                                print( "Stopping after iteration {} as data is fully excised.".format( it + 1 ) )
-                            break
-                    except NameError:
-                        pass
-                    old_mu, old_s = mu, sigma
-
-                # End mitigation
-
-                save_fn = "{0}_{1}_{2}_{3}".format( self.psr_name, mjd, fe, obs_num )
-                if self.save_as_np:
-                    np.save( os.join( self.saveddata_dir, save_fn ), data )
-                    save_fn += "_DATWTS"
-                    np.save( os.join( self.saveddata_dir, save_fn ), ar.getWeights() )
-                else:
-                    save_fn += ext
-                    save_psrfits( os.path.join( self.saveddata_dir, save_fn ), ar )
-                ignore_list.append( ig_dict )
-                save_dict = self.save_position( None, None, [0, 0], ignore_list )
+        return self
 
-                if self.verbose:
-                    print( "{0} fully mitigated using method {1}.".format( f, self.method ) )
+
+    def parallel_mitigation_setup( self ):
+
+        """
+        Mitigates files concurrently across self.workers processes.
+        Only the parent process touches the session journal, recording each file as its worker finishes.
+        """
+
+        last_file, data, p, ignore_list = self.load_session()
+
+        jobs, frontends = [], set()
+        for hdr in self.archives():
+            directory, f = os.path.split( hdr[ 'PATH' ] )
+            if self.is_mitigated( directory, f ):
+                continue
+            jobs.append( ( directory, f ) )
+            frontends.add( hdr[ 'FRONTEND' ] )
+
+        # Templates are made (interactively if need be) before any worker needs one
+        for fe in sorted( frontends ):
+            self.get_template( fe, do_fit = FIT )
+
+        with ProcessPoolExecutor( max_workers = self.workers, initializer = _init_worker, initargs = ( self, ) ) as pool:
+            futures = { pool.submit( _mitigate_in_worker, directory, f ) : f for directory, f in jobs }
+            for future in as_completed( futures ):
+                try:
+                    ig_dict, masks, diagnostics = future.result()
+                except Exception as e:
+                    print( "Mitigation of {0} failed: {1}".format( futures[ future ], e ) )
+                    continue
+                for record in masks:
+                    self.weights_store.put( record )
+                if diagnostics:
+                    append_records( self.diagnostics_file, *diagnostics )
+                if ig_dict is None:
+                    continue
+                self.save_position( None, None, [0, 0], ig_dict )
+
+        self.journal.compact()
+        self.journal.close()
 
         return self
 
 
+# Process pool helpers. Each worker keeps its own copy of the mitigator, which never writes the session file, weights store or diagnostics file.
+_worker_blaster = None
+
+def _init_worker( blaster ):
+    global _worker_blaster
+    _worker_blaster = blaster
+    _worker_blaster.store_outputs = False
+
+def _mitigate_in_worker( directory, f ):
+    ig_dict = _worker_blaster.mitigate_file( directory, f )
+    masks, _worker_blaster.pending_masks = _worker_blaster.pending_masks, []
+    diagnostics, _worker_blaster.pending_diagnostics = _worker_blaster.pending_diagnostics, []
+    return ig_dict, masks, diagnostics
+
+
 # Bayesian heirarchy class
 class Bayesian_Mitigator( RFIBlaster ):
 
@@ -354,22 +554,31 @@ class SigmaClip_Mitigator( RFIBlaster ):
 
     def mitigate( self, file, p, template, archive, ignore_list ):
 
-        data = archive.getData()
+        """
+        Clips profiles over up to self.iterations passes of a ClipEngine on the cached data, then zaps them all with one (nsubint, nchan) mask.
+        A diagnostics record of the final RMS histogram is saved instead of plotting it.
+        """
 
-        templateMask = pu.get_1D_OPW_mask( template, windowsize = (archive.getNbin() - 150) )
-        rmsArray, linearRmsArray, mu, sigma = u.getRMSArrayProperties( data, templateMask, 1.0 ) # Needs to input 2D array
+        data = archive.getData( squeeze = False )
+        data = np.reshape( data, ( -1, ) + data.shape[-2:] )
+        valid = np.reshape( archive.getWeights( squeeze = False ), data.shape[:-1] ) > 0
 
-        # Creates the histogram
-        pltu.histogram_and_curves( linearRmsArray, mean = mu, std_dev = sigma, bins = (archive.getNchan() // 4), x_axis = 'Root Mean Squared', y_axis = 'Frequency Density', title = r'$\mu={},\ \sigma={}$'.format( mu, sigma ), show = False, curve_list = [spyst.norm.pdf] )
+        templateMask = pu.get_1D_OPW_mask( template, windowsize = (archive.getNbin() - 150) )
+        engine = ClipEngine( data, templateMask, valid = valid, threshold = 2, out_tol = 1.0, whole_channels = self.whole_channels, verbose = self.verbose )
+        mask = engine.run( self.iterations )
+        mu, sigma = engine.mu, engine.sigma
+        self.clip_log = engine.log
 
-        rejectionCriterion = mathu.chauvenet( rmsArray, mu, sigma, 2 )
+        self.save_diagnostics( histogram_record( file, engine.surviving, mu, sigma, bins = (archive.getNchan() // 4), METHOD = self.method,
+                                                 SHAPE = list( mask.shape ), ZAPPED = engine.count, ITERATIONS = engine.log ) )
 
+        # Undoes any epoch averaging so the zapped profiles are saved at the file's full resolution
         archive.reset()
 
         if self.verbose:
             print( "Rejection criterion created." )
 
-        data, archive = self.zap( file, archive, p, ignore_list, np.asarray( rejectionCriterion ).nonzero()[ rejectionCriterion.ndim - 1 ] )
+        data, archive = self.zap_mask( archive, mask )
 
         return archive, mu, sigma, data
 
@@ -5,16 +5,82 @@
 import os
 import numpy as np
 import pickle
-from astropy.io import fits
-from pypulse.archive import Archive
-from utils.gaussian_fit import get_best_gaussian_fit
-from utils.saving import save_session
-from utils.loading import load_session as load
-
-import matplotlib.pyplot as plt
+from utils.header_index import HeaderIndex
+from utils.scanner import select_records
+from utils.journal import SessionJournal
+from utils.psrfits_loader import PSRFITSReader, scrunch_factor
+from utils.prefetch import Prefetcher
 
 file_root = os.path.dirname( os.path.abspath( __file__ ) )
 
+# Running template sum
+class TemplateAccumulator:
+
+    """
+    Keeps a running (weighted) sum of profiles in memory along with the set of files already added.
+
+    Parameters
+    ----------
+    template            : np.ndarray, optional
+        Template sum to continue from (e.g. loaded from a saved session)
+    ignore_list         : [str, str, ...], optional
+        Absolute paths of the files that have already been added to the template (file names in older sessions)
+    """
+
+    def __init__( self, template = None, ignore_list = None ):
+
+        self.template = template
+        self.files = list( ignore_list ) if ignore_list is not None else []
+        self.added = set( self.files )
+        self.count = len( self.files )
+
+        self.pending_files = 0
+        self.pending_bytes = 0
+
+    def __repr__( self ):
+        return "TemplateAccumulator( count = {} )".format( self.count )
+
+    # Older sessions recorded file names rather than paths
+    def __contains__( self, path ):
+        return path in self.added or os.path.basename( path ) in self.added
+
+    def add( self, f, data, weight = 1.0, nbytes = 0 ):
+
+        """
+        Adds a profile (or sub-banded profiles) to the running sum.
+        """
+
+        if self.template is None:
+            self.template = np.zeros( np.shape( data ), dtype = float )
+
+        self.template += weight * data
+        self.count += 1
+
+        self.files.append( f )
+        self.added.add( f )
+        self.pending_files += 1
+        self.pending_bytes += nbytes
+
+        return self
+
+    def needs_checkpoint( self, every = None, max_bytes = None ):
+
+        """
+        Returns True if enough files or bytes have been added since the last checkpoint.
+        """
+
+        if every is not None and self.pending_files >= every:
+            return True
+        if max_bytes is not None and self.pending_bytes >= max_bytes:
+            return True
+        return False
+
+    def checkpointed( self ):
+        self.pending_files = 0
+        self.pending_bytes = 0
+        return self
+
+
 # Master template class
 class Template:
 
@@ -22,7 +88,7 @@ class Template:
     Master class dedicated to creating high SNR profiles for use in pulsar timing.
     """
 
-    def __init__( self, psr_name, frontend, subbands, *dirs, template_dir = "templates", verbose = False ):
+    def __init__( self, psr_name, frontend, subbands, *dirs, template_dir = "templates", files = None, checkpoint_every = 50, checkpoint_bytes = None, prefetch = 1, prefetch_bytes = None, verbose = False ):
 
         """
         Template class
@@ -39,6 +105,16 @@ class Template:
             Directories to look for PSRFITS files
         template_dir        : str, optional
             Directory to save final template
+        files               : [str, str, ...], optional
+            Paths of the files to build the template from (e.g. from a scanner Catalog), used instead of searching dirs
+        checkpoint_every    : int, optional
+            Number of files to add between session saves (None to disable)
+        checkpoint_bytes    : int, optional
+            Number of bytes of PSRFITS data to add between session saves (None to disable)
+        prefetch            : int, optional
+            Number of files to read ahead while the current one is added (0 to disable)
+        prefetch_bytes      : int, optional
+            Memory budget in bytes for files read ahead (None for no limit)
         verbose             : bool, optional
             Prints information to the console
         """
@@ -52,13 +128,20 @@ class Template:
         self.pkl_dir = os.path.join( file_root, self.psr_name, 'pickle_dumps' )
 
         self.check_directories()
-        if len( dirs ) == 0:
+        if len( dirs ) == 0 and files is None:
             raise ValueError( "Must provide at least one directory to search through!" )
         else:
             self.dirs = dirs
+        self.files = files
         self.dirs = dirs
         self.verbose = verbose
+        self.index = HeaderIndex()
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_bytes = checkpoint_bytes
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
         self.pklfile = os.path.join( self.pkl_dir, "{0}_{1}_{2}.pkl".format( self.psr_name, self.frontend, self.subbands ) )
+        self.journal = SessionJournal( os.path.splitext( self.pklfile )[0] + ".jnl", 'm', legacy = self.pklfile )
         self.savefile = "{0}_{1}_{2}_template.npy".format( self.psr_name, self.frontend, self.subbands )
 
     def __repr__( self ):
@@ -81,10 +164,21 @@ class Template:
         """
         Attempts to load template from save. Otherwise, creates a new template with conventional name.
         """
-        return load( self.pklfile, mode = 'm' )
+        self.journal.load()
+        return self.journal.session()
 
     def save_position( self, *args ):
-        return save_session( self.pklfile, *args, mode = 'm' )
+        return self.journal.save( *args )
+
+    def checkpoint( self, acc ):
+
+        """
+        Appends the current template sum and the files added since the last checkpoint to the session journal.
+        """
+
+        if acc.pending_files > 0:
+            self.journal.record( add = acc.files[ -acc.pending_files: ], DATA = acc.template )
+        return acc.checkpointed()
 
 
     def prepare_file( self, file ):
@@ -93,26 +187,19 @@ class Template:
         Prepares the PSRFITS file in the correct format for the program.
         """
 
-        try:
-            hdul = fits.open( file )
-        except OSError:
+        hdr = self.index.lookup( file )
+        if hdr is None:
             return -1
 
-        name = hdul[0].header[ 'SRC_NAME' ]
-        fe = hdul[0].header[ 'FRONTEND' ]
-        if hdul[0].header[ 'OBS_MODE' ] != "PSR" or name != self.psr_name or fe != self.frontend:
-            hdul.close()
+        if hdr[ 'OBS_MODE' ] != "PSR" or hdr[ 'SRC_NAME' ] != self.psr_name or hdr[ 'FRONTEND' ] != self.frontend:
             return -1
-        hdul.close()
 
-        ar = Archive( file, verbose = self.verbose )
-        ar.tscrunch( nsubint = 1 )
-        ar.fscrunch( nchan = 1 )
-        n = 1
-        nbin = ar.getNbin()
-        data = ar.getData()
+        with PSRFITSReader( file, verbose = self.verbose ) as reader:
+            data = reader.prepare( nsubint = 1, nchan = 1 )
+            n = 1
+            nbin = reader.nbin
 
-        return np.copy( data ), n, nbin
+        return data, n, nbin
 
 
     def make_template( self, gaussian_fit = False ):
@@ -121,17 +208,26 @@ class Template:
         Script to create the template
         """
 
-        for directory in self.dirs:
-            for f in sorted( os.listdir( directory ) ):
-                template, ignore_list = self.load_session()
-                self.template = template
+        template, ignore_list = self.load_session()
+        acc = TemplateAccumulator( template, ignore_list )
+        if self.verbose and template is not None:
+            print( "Continuing template..." )
 
-                if f in ignore_list:
-                    if self.verbose:
-                        print( "{} has already been added to the template.".format( f ) )
-                    continue
+        files = []
+        for hdr in select_records( self.index, self.dirs, self.files, psr_name = self.psr_name, frontend = self.frontend, obs_mode = "PSR" ):
+
+            if hdr[ 'PATH' ] in acc:
+                if self.verbose:
+                    print( "{} has already been added to the template.".format( hdr[ 'PATH' ] ) )
+                continue
+
+            files.append( hdr[ 'PATH' ] )
+
+        # The next file is read and scrunched while the current one is added
+        with Prefetcher( files, self.prepare_file, depth = self.prefetch, max_bytes = self.prefetch_bytes ) as prepared:
+            for abs_f, prep in prepared:
 
-                prep = self.prepare_file( os.path.join( directory, f ) )
+                f = os.path.basename( abs_f )
                 if prep == -1:
                     if self.verbose:
                         print( "Preparation of file {} failed. Skipping file...".format( f ) )
@@ -139,37 +235,22 @@ class Template:
                 else:
                     d, c, b = prep[0], prep[1], prep[2]
 
-
-                if template is None and c > 1:
-                    if self.verbose:
-                        print( "First time pass for subband > 1" )
-                    self.template = np.zeros( (c, b), dtype = float )
-                elif template is None:
-                    if self.verbose:
-                        print( "First time pass for subband = 1" )
-                    self.template = np.zeros( b, dtype = float )
-                else:
-                    if self.verbose:
-                        print( "Continuing template..." )
-                    self.template = template
-
-                if c > 1:
-                    for i in range(c):
-                        self.template[i] += d[i]
-                else:
-                    self.template += d
-
+                acc.add( abs_f, d, nbytes = os.path.getsize( abs_f ) )
 
                 if self.verbose:
                     print( "Template appended with data from {}".format( f ) )
 
-                ignore_list.append( f )
-
-                self.save_position( *[self.template, ignore_list] )
+                if acc.needs_checkpoint( self.checkpoint_every, self.checkpoint_bytes ):
+                    self.checkpoint( acc )
 
+        self.checkpoint( acc )
+        self.journal.compact()
+        self.journal.close()
+        self.template = acc.template
 
         save_file = self.savefile
         if gaussian_fit:
+            from utils.gaussian_fit import get_best_gaussian_fit
             self.template, chis, ind_gaussians, msk = get_best_gaussian_fit( np.arange( len( self.template ) ), self.template, m_gauss = 7, plot_chisq = False, p_wid = 150 )
         np.save( os.path.join( self.temp_dir, save_file ), self.template )
         print( "Template creation finished." )
@@ -183,7 +264,7 @@ class FD_Template( Template ):
     Class dedicated to creating high SNR, frequency dependent, profiles for use in pulsar timing.
     """
 
-    def __init__( self, psr_name, frontend, subbands, *dirs, template_dir = "templates", verbose = False ):
+    def __init__( self, psr_name, frontend, subbands, *dirs, template_dir = "templates", files = None, checkpoint_every = 50, checkpoint_bytes = None, prefetch = 1, prefetch_bytes = None, verbose = False ):
 
         """
         FD_Template (Frequency-Dependent Template) class
@@ -213,12 +294,19 @@ class FD_Template( Template ):
 
         self.check_directories()
 
-        if len( dirs ) == 0:
+        if len( dirs ) == 0 and files is None:
             raise ValueError( "Must provide at least one directory to search through!" )
         else:
             self.dirs = dirs
+        self.files = files
         self.verbose = verbose
+        self.index = HeaderIndex()
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_bytes = checkpoint_bytes
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
         self.pklfile = os.path.join( self.pkl_dir, "{0}_{1}_nchan{2}.pkl".format( self.psr_name, self.frontend, self.subbands ) )
+        self.journal = SessionJournal( os.path.splitext( self.pklfile )[0] + ".jnl", 'm', legacy = self.pklfile )
         self.savefile = "{0}_{1}_nchan{2}_template.npy".format( self.psr_name, self.frontend, self.subbands )
 
 
@@ -228,26 +316,19 @@ class FD_Template( Template ):
         Prepares the PSRFITS file in the correct format for the program to use.
         """
 
-        try:
-            hdul = fits.open( file )
-        except OSError:
+        hdr = self.index.lookup( file )
+        if hdr is None:
             return -1
 
-        name = hdul[0].header[ 'SRC_NAME' ]
-        fe = hdul[0].header[ 'FRONTEND' ]
-        if hdul[0].header[ 'OBS_MODE' ] != "PSR" or name != self.psr_name or fe != self.frontend:
-            hdul.close()
+        if hdr[ 'OBS_MODE' ] != "PSR" or hdr[ 'SRC_NAME' ] != self.psr_name or hdr[ 'FRONTEND' ] != self.frontend:
             return -1
-        hdul.close()
 
-        ar = Archive( file, verbose = self.verbose )
-        ar.tscrunch( nsubint = 1 )
-        ar.fscrunch( nchan = self.subbands )
-        nchan = ar.getNchan()
-        nbin = ar.getNbin()
-        data = ar.getData()
+        with PSRFITSReader( file, verbose = self.verbose ) as reader:
+            data = reader.prepare( nsubint = 1, nchan = self.subbands )
+            nchan = len( range( 0, reader.nchan, scrunch_factor( reader.nchan, self.subbands ) ) )
+            nbin = reader.nbin
 
-        return np.copy( data ), nchan, nbin
+        return data, nchan, nbin
 
 
 # Epoch dependent template class
@@ -257,7 +338,7 @@ class TD_Template( Template ):
     Class dedicated to creating high SNR, time dependent, profiles for use in pulsar timing.
     """
 
-    def __init__( self, psr_name, frontend, subbands, *dirs, template_dir = "templates", verbose = False ):
+    def __init__( self, psr_name, frontend, subbands, *dirs, template_dir = "templates", files = None, checkpoint_every = 50, checkpoint_bytes = None, prefetch = 1, prefetch_bytes = None, verbose = False ):
 
         """
         TD_Template (Time-Dependent Template) class
@@ -286,12 +367,19 @@ class TD_Template( Template ):
         self.pkl_dir = os.path.join( file_root, self.psr_name, 'pickle_dumps' )
 
         self.check_directories()
-        if len( dirs ) == 0:
+        if len( dirs ) == 0 and files is None:
             raise ValueError( "Must provide at least one directory to search through!" )
         else:
             self.dirs = dirs
+        self.files = files
         self.verbose = verbose
+        self.index = HeaderIndex()
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_bytes = checkpoint_bytes
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
         self.pklfile = os.path.join( pkl_dir, "{0}_{1}_nsubint{2}.pkl".format( self.psr_name, self.frontend, self.subbands ) )
+        self.journal = SessionJournal( os.path.splitext( self.pklfile )[0] + ".jnl", 'm', legacy = self.pklfile )
         self.savefile = "{0}_{1}_nsubint{2}_template.npy".format( self.psr_name, self.frontend, self.subbands )
 
 
@@ -301,26 +389,19 @@ class TD_Template( Template ):
         Prepares the PSRFITS file in the correct format for the program.
         """
 
-        try:
-            hdul = fits.open( file )
-        except OSError:
+        hdr = self.index.lookup( file )
+        if hdr is None:
             return -1
 
-        name = hdul[0].header[ 'SRC_NAME' ]
-        fe = hdul[0].header[ 'FRONTEND' ]
-        if hdul[0].header[ 'OBS_MODE' ] != "PSR" or name != self.psr_name or fe != self.frontend:
-            hdul.close()
+        if hdr[ 'OBS_MODE' ] != "PSR" or hdr[ 'SRC_NAME' ] != self.psr_name or hdr[ 'FRONTEND' ] != self.frontend:
             return -1
-        hdul.close()
 
-        ar = Archive( file, verbose = self.verbose )
-        ar.tscrunch( nsubint = self.subbands )
-        ar.fscrunch( nchan = 1 )
-        nsubint = ar.getNsubint()
-        nbin = ar.getNbin()
-        data = ar.getData()
+        with PSRFITSReader( file, verbose = self.verbose ) as reader:
+            data = reader.prepare( nsubint = self.subbands, nchan = 1 )
+            nsubint = len( range( 0, reader.nsubint, scrunch_factor( reader.nsubint, self.subbands ) ) )
+            nbin = reader.nbin
 
-        return np.copy( data ), nsubint, nbin
+        return data, nsubint, nbin
 
 
 
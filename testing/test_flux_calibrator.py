@@ -0,0 +1,52 @@
+# Flux calibration tests: archives are loaded with the pulsar's stored zap mask applied, and sessions are journaled
+
+import os
+import sys
+import pickle
+import numpy as np
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, file_root )
+
+import flux_calibrator
+from test_pipeline import make_archive, PSR, HOT
+
+
+def test_calibration_honours_stored_zap_mask( tmp_path, monkeypatch ):
+
+    monkeypatch.setattr( flux_calibrator, 'file_root', str( tmp_path ) )
+    file = make_archive( str( tmp_path / "obs.fits" ) )
+    cal = flux_calibrator.FluxCalibrator( PSR, "3C48" )
+
+    weights = np.ones( ( 4, 16 ) )
+    weights[ :, HOT ] = 0
+    cal.weights_store.put( cal.weights_store.make_record( file, weights, 'S' ) )
+
+    ar = cal.load_archive( file )
+
+    # calibrate reads the unweighted data, so the zapped channel must be zeroed there too
+    data = ar.getData( weight = False, squeeze = False )
+    assert data.shape[1] == 4
+    assert np.all( ar.getWeights()[:, HOT] == 0 )
+    assert np.all( data[:, :, HOT, :] == 0 )
+    assert np.any( data[:, :, np.arange( 16 ) != HOT, :] != 0 )
+
+
+def test_session_is_journaled( tmp_path, monkeypatch ):
+
+    monkeypatch.setattr( flux_calibrator, 'file_root', str( tmp_path ) )
+    cal = flux_calibrator.FluxCalibrator( PSR, "3C48" )
+    path = os.path.join( cal.pkl_dir, "calibration", "factors.pkl" )
+
+    assert cal.load_session( path ) is None
+    cal.save_position( path, [ 1.0, 2.0 ] )
+    assert cal.load_session( path ) == [ 1.0, 2.0 ]
+    assert not os.path.exists( path )
+
+    # Sessions saved as a pickle by older versions are imported into the journal
+    legacy = os.path.join( cal.pkl_dir, "calibration", "onoff.pkl" )
+    with open( legacy, 'wb' ) as f:
+        pickle.dump( { 'LIST' : [ 3 ] }, f )
+    assert cal.load_session( legacy ) == { 'LIST' : [ 3 ] }
+    os.remove( legacy )
+    assert cal.load_session( legacy ) == { 'LIST' : [ 3 ] }
@@ -0,0 +1,34 @@
+# Ignore list tests: a file only counts as done while its content is unchanged
+
+import os
+import sys
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, file_root )
+
+from utils.ignore_index import IgnoreIndex, DIGEST_CHUNK
+
+SIZE = 3 * DIGEST_CHUNK
+
+
+def test_change_to_middle_of_file_is_seen( tmp_path ):
+
+    path = str( tmp_path / "obs.fits" )
+    with open( path, 'wb' ) as f:
+        f.write( os.urandom( SIZE ) )
+    ignored = IgnoreIndex( [ IgnoreIndex().make_entry( path, 'S' ) ] )
+    st = os.stat( path )
+
+    # Touching the file alone keeps it done
+    os.utime( path, ns = ( st.st_atime_ns, st.st_mtime_ns + 10**9 ) )
+    assert ignored.contains( path, 'S' )
+
+    # Rewriting bytes in the middle, away from the first and last chunk, does not
+    with open( path, 'r+b' ) as f:
+        f.seek( SIZE // 2 )
+        byte = f.read( 1 )
+        f.seek( SIZE // 2 )
+        f.write( bytes( [ byte[0] ^ 0xFF ] ) )
+    os.utime( path, ns = ( st.st_atime_ns, st.st_mtime_ns + 2 * 10**9 ) )
+    assert os.path.getsize( path ) == SIZE
+    assert not ignored.contains( path, 'S' )
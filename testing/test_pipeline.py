@@ -0,0 +1,93 @@
+# Batch pipeline test: channels zapped by the RFI stage are seen by timing
+
+import os
+import sys
+import numpy as np
+from astropy.io import fits
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, file_root )
+
+import pulseblast2
+import timing
+import rfi_mitigation
+import template_builder
+import flux_calibrator
+import utils.header_index
+from utils.psrfits_loader import PSRFITSReader
+
+PSR = "J0000+0000"
+FE = "L-wide"
+HOT = 5
+
+
+def make_archive( path, nsub = 4, npol = 4, nchan = 16, nbin = 512, seed = 0 ):
+
+    """
+    Writes a small PSRFITS file with a Gaussian pulse in every channel and strong noise in channel HOT.
+    """
+
+    rng = np.random.default_rng( seed )
+    hdr = fits.Header()
+    for key, value in dict( SRC_NAME = PSR, FRONTEND = FE, BACKEND = "PUPPI", OBS_MODE = "PSR", STT_IMJD = 58000, STT_SMJD = 100, STT_OFFS = 0.5,
+                            TELESCOP = "Arecibo", OBSFREQ = 1400.0, OBSBW = 800.0, RA = "01:00:00", DEC = "+10:00:00", FD_POLN = "LIN" ).items():
+        hdr[ key ] = value
+
+    x = np.arange( nbin )
+    data = rng.normal( 0, 50, ( nsub, npol, nchan, nbin ) ) + 3000 * np.exp( -0.5 * ( ( x - 160 ) / 8 )**2 )
+    data[:, :, HOT, :] += rng.normal( 0, 5000, ( nsub, npol, nbin ) )
+    data = np.clip( data, -32000, 32000 ).astype( '>i2' )
+
+    cols = [ fits.Column( 'TSUBINT', '1D', array = np.full( nsub, 10.0 ) ), fits.Column( 'OFFS_SUB', '1D', array = 5 + 10.0 * np.arange( nsub ) ),
+             fits.Column( 'PERIOD', '1D', array = np.full( nsub, 0.01 ) ),
+             fits.Column( 'DAT_FREQ', '{}D'.format( nchan ), array = np.tile( np.linspace( 1000, 1800, nchan ), ( nsub, 1 ) ) ),
+             fits.Column( 'DAT_WTS', '{}E'.format( nchan ), array = np.ones( ( nsub, nchan ) ) ),
+             fits.Column( 'DAT_OFFS', '{}E'.format( npol * nchan ), array = np.zeros( ( nsub, npol * nchan ) ) ),
+             fits.Column( 'DAT_SCL', '{}E'.format( npol * nchan ), array = np.ones( ( nsub, npol * nchan ) ) ),
+             fits.Column( 'DATA', '{}I'.format( nbin * nchan * npol ), dim = '({},{},{},1)'.format( nbin, nchan, npol ), array = data.reshape( nsub, -1 ) ) ]
+    sub = fits.BinTableHDU.from_columns( cols, name = 'SUBINT' )
+    for key, value in dict( POL_TYPE = 'AABBCRCI', DM = 30.0, NBIN = nbin, CHAN_BW = 800.0 / nchan, NCHAN = nchan, NPOL = npol, NSBLK = 1 ).items():
+        sub.header[ key ] = value
+    par = fits.BinTableHDU.from_columns( [ fits.Column( 'PARAM', '128A', array = np.array( [ "PSRJ " + PSR, "F0 100.0", "DM 30.0" ] ) ) ], name = 'PSRPARAM' )
+
+    fits.HDUList( [ fits.PrimaryHDU( header = hdr ), par, sub ] ).writeto( path, overwrite = True )
+    return path
+
+
+def sandbox( root, monkeypatch ):
+
+    """
+    Points every stage's output directories and the header index at root, so a run leaves the repository untouched.
+    """
+
+    monkeypatch.chdir( root )
+    for module in ( timing, rfi_mitigation, template_builder, flux_calibrator ):
+        monkeypatch.setattr( module, 'file_root', root )
+    monkeypatch.setattr( utils.header_index, 'default_index', os.path.join( root, 'header_index.db' ) )
+
+
+def test_timing_sees_rfi_masks( tmp_path, monkeypatch ):
+
+    root, data = str( tmp_path / "root" ), tmp_path / "data"
+    os.makedirs( root )
+    os.makedirs( data )
+    sandbox( root, monkeypatch )
+    files = [ make_archive( str( data / "obs{}.fits".format( i ) ), seed = i ) for i in range( 2 ) ]
+
+    status = pulseblast2.main( [ 'run', str( data ), PSR, '-m', '-f', FE, '-s', '1', '-rs', '-i', '2', '-t', '--batch-fit', '--flat' ] )
+    assert status == 0
+    assert os.path.isdir( os.path.join( root, PSR ) )
+    assert os.path.isfile( os.path.join( root, 'header_index.db' ) )
+
+    timer = timing.Timer( PSR, str( data ) )
+    for file in files:
+        with PSRFITSReader( file ) as reader:
+            mask = timer.weights_store.mask( file, ( reader.nsubint, reader.nchan ) )
+            assert mask is not None
+            assert mask[:, HOT].all()
+
+            # Timing reads the file with the mask applied, so the hot channel has no weight
+            reader.mask = mask
+            profiles, weights = reader.scrunch( nsubint = reader.nsubint, nchan = reader.nchan, pscrunch = True, dedisperse = False )
+            assert np.all( weights[:, HOT] == 0 )
+            assert np.any( weights[:, np.arange( reader.nchan ) != HOT] > 0 )
@@ -0,0 +1,24 @@
+# Timing tests: .tim files are appended to, not overwritten
+
+import os
+import sys
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, file_root )
+
+import timing
+
+PSR = "J0000+0000"
+
+
+def test_write_tim_appends( tmp_path, monkeypatch ):
+
+    monkeypatch.setattr( timing, 'file_root', str( tmp_path ) )
+    timer = timing.Timer( PSR )
+
+    first = timer.write_tim( "L-wide", [ ( 2, "b.fits", [ "b 1\n" ] ), ( 1, "a.fits", [ "a 1\n", "a 2\n" ] ) ] )
+    second = timer.write_tim( "L-wide", [ ( 3, "c.fits", [ "c 1\n" ] ) ] )
+
+    assert first == second
+    with open( first ) as tim:
+        assert tim.read() == "FORMAT 1\na 1\na 2\nb 1\nc 1\n"
@@ -0,0 +1,35 @@
+# TOA fit tests: the noise is measured off the pulse wherever the pulse is in the profile
+
+import os
+import sys
+import numpy as np
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, file_root )
+
+from utils.toa_fit import fit_toas
+
+NBIN = 512
+
+
+def gaussian( centre, width = 8 ):
+    x = np.arange( NBIN ) - centre
+    x = np.mod( x + NBIN // 2, NBIN ) - NBIN // 2
+    return np.exp( -0.5 * ( x / width )**2 )
+
+
+def test_noise_excludes_pulse_offset_from_template():
+
+    rng = np.random.default_rng( 0 )
+    template = gaussian( NBIN // 2 )
+
+    # One profile at the template's phase and one with the pulse moved into the template's off-pulse window (around bin 0)
+    profiles = 20 * np.array( [ gaussian( NBIN // 2 ), gaussian( 8 ) ] ) + rng.normal( 0, 1, ( 2, 500, NBIN ) ).transpose( 1, 0, 2 )
+    tauhat, bhat, sigma_tau, sigma_b, snr = fit_toas( template, profiles )
+
+    assert np.allclose( np.median( tauhat, axis = 0 ), [ 0, 8 - NBIN // 2 ], atol = 0.1 )
+    assert np.allclose( np.median( snr, axis = 0 ), 20, rtol = 0.05 )
+    assert np.allclose( np.median( sigma_tau[:, 1] ) / np.median( sigma_tau[:, 0] ), 1, rtol = 0.05 )
+
+    # The error estimate matches the scatter of the fitted lags
+    assert np.allclose( np.std( tauhat, axis = 0 ), np.median( sigma_tau, axis = 0 ), rtol = 0.15 )
@@ -0,0 +1,78 @@
+# Zap mask store tests: storing a mask does not get slower as the store grows, and replacing one is atomic
+
+import os
+import sys
+import time
+import numpy as np
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, file_root )
+
+from utils.weights_store import WeightsStore
+
+SHAPE = ( 64, 512 )
+
+
+def make_files( directory, n ):
+    paths = []
+    for i in range( n ):
+        path = os.path.join( str( directory ), "obs{}.fits".format( i ) )
+        with open( path, 'wb' ) as f:
+            f.write( os.urandom( 2048 ) )
+        paths.append( path )
+    return paths
+
+def random_weights( rng ):
+    return ( rng.random( SHAPE ) > 0.5 ).astype( float )
+
+
+def test_put_cost_does_not_grow_with_store_size( tmp_path ):
+
+    rng = np.random.default_rng( 0 )
+    files = make_files( tmp_path, 400 )
+    store = WeightsStore( tmp_path / "store" )
+    records = [ store.make_record( file, random_weights( rng ), 'S' ) for file in files ]
+
+    def put_all( batch ):
+        start = time.perf_counter()
+        for record in batch:
+            store.put( record )
+        return time.perf_counter() - start
+
+    first = put_all( records[:100] )
+    put_all( records[100:300] )
+    last = put_all( records[300:] )
+
+    # Rewriting a single store on every put made the last 100 puts about 7 times slower than the first 100
+    assert last < 3 * first
+    assert len( WeightsStore( tmp_path / "store" ) ) == 400
+
+
+def test_replaced_mask_is_swapped_in_atomically( tmp_path, monkeypatch ):
+
+    rng = np.random.default_rng( 1 )
+    file, other = make_files( tmp_path, 2 )
+    path = tmp_path / "store"
+    old, new = random_weights( rng ), random_weights( rng )
+
+    store = WeightsStore( path )
+    store.put( store.make_record( file, old, 'S' ) )
+    store.put( store.make_record( other, old, 'S' ) )
+
+    # A crash before the new mask is swapped in leaves the stored masks intact
+    def crash( *args ):
+        raise KeyboardInterrupt
+    monkeypatch.setattr( os, 'replace', crash )
+    try:
+        store.put( store.make_record( file, new, 'S' ) )
+    except KeyboardInterrupt:
+        pass
+    monkeypatch.undo()
+    assert np.array_equal( WeightsStore( path ).mask( file ), old == 0 )
+
+    store.put( store.make_record( file, new, 'S' ) )
+    reread = WeightsStore( path )
+    assert len( reread ) == 2
+    assert len( [ name for name in os.listdir( path ) if name.endswith( ".npz" ) ] ) == 2
+    assert np.array_equal( reread.mask( file ), new == 0 )
+    assert np.array_equal( reread.mask( other ), old == 0 )
@@ -7,22 +7,20 @@ Integrate with app frontend
 """
 
 # Local imports
-import utils.pulsarUtilities as pu
-import utils.plotUtils as pltu
-import utils.otherUtilities as u
-import utils.mathUtils as mathu
+from utils.header_index import HeaderIndex
+from utils.scanner import select_records
+from utils.toa_fit import fit_toas
+from utils.psrfits_loader import PSRFITSReader
+from utils.prefetch import Prefetcher
+from utils.weights_store import WeightsStore, weights_store_path
 from custom_exceptions import TemplateLoadError
-from template_builder import FD_Template
 
-import matplotlib.pyplot as plt
-import scipy.stats as spyst
-
-# Imports
-from pypulse.archive import Archive
+# Imports (pypulse and the template builder are imported where they are used, as a batch timing run needs neither)
 import numpy as np
 import pickle
-from astropy.io import fits
 import os
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 TOL = 1e-7
 
@@ -33,9 +31,40 @@ class Timer:
 
     """
     Base class for timing in PulseBlast
+
+    Parameters
+    ----------
+    psr_name      : str
+        Name of PSR as given in the PSRFITS files
+    *dirs         : str, os.Path, [str, ..., str], [os.Path, ..., os.Path], optional
+        Directories to look for files to time (default is saveddata_dir)
+    temp_dir      : str, os.Path, optional
+        Location to load templates from (local to this file)
+    saveddata_dir : str, os.Path, optional
+        Location of the data to time if no directories are given (local to this file)
+    toa_dir       : str, os.Path, optional
+        Location to save .tim files to (local to this file)
+    tim_ext       : str, optional
+        Extension of the .tim files
+    jump_flags    : str, optional
+        Flags appended to every TOA line
+    epochs        : int, optional
+        Number of subintegrations to time per file
+    subbands      : int, optional
+        Number of frequency channels to time per file
+    files         : [str, ..., str], optional
+        Paths of the files to time (e.g. from a scanner Catalog), used instead of searching dirs
+    workers       : int, optional
+        Number of processes to time archives with concurrently (default is 1)
+    prefetch      : int, optional
+        Number of archives to read ahead while the current one is timed (0 to disable)
+    prefetch_bytes: int, optional
+        Memory budget in bytes for archives read ahead (default is no limit)
+    verbose       : bool, optional
+        Displays more information to the console
     """
 
-    def __init__( self, psr_name, *dirs, temp_dir = "templates", saveddata_dir = "data", toa_dir = 'toas', tim_ext = 'tim', jump_flags = "", epochs = 1, subbands = 1, verbose = False ):
+    def __init__( self, psr_name, *dirs, temp_dir = "templates", saveddata_dir = "data", toa_dir = 'toas', tim_ext = 'tim', jump_flags = "", epochs = 1, subbands = 1, files = None, workers = 1, prefetch = 1, prefetch_bytes = None, verbose = False ):
 
         self.psr_name = str( psr_name )
         self.temp_dir = os.path.join( file_root, self.psr_name, temp_dir )
@@ -51,11 +80,18 @@ class Timer:
             self.dirs = [self.saveddata_dir]
         else:
             self.dirs = dirs
+        self.files = files
         self.pklfile = os.path.join( self.pkl_dir, "{}_timing_save.pkl".format( self.psr_name ) )
         self.epochs = epochs
         self.subbands = subbands
         self.tim_ext = tim_ext
         self.jump_flags = str( jump_flags )
+        self.index = HeaderIndex()
+        self.templates = {}
+        self.weights_store = WeightsStore( weights_store_path( self.saveddata_dir, self.psr_name ), verbose = verbose )
+        self.workers = max( int( workers ), 1 )
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
         if self.verbose:
             print( "Timer initialized" )
 
@@ -89,57 +125,277 @@ class Timer:
 
         return template
 
+    def template_name( self, fe ):
+        return "{0}_{1}_nchan{2}_template.npy".format( self.psr_name, fe, self.subbands )
 
-    def prepare_file( self, file ):
+    def get_template( self, fe ):
 
         """
-        Prepares the PSRFITS file in the correct format for the program.
+        Returns the template for a frontend, loading it from disk only the first time it is needed.
         """
 
-        try:
-            hdul = fits.open( file )
-        except:
-            return -1
-
-        name = hdul[0].header[ 'SRC_NAME' ]
-        fe = hdul[0].header[ 'FRONTEND' ]
-        mjd = hdul[0].header[ 'STT_IMJD' ]
-        if hdul[0].header[ 'OBS_MODE' ] != "PSR" or name != self.psr_name:
-            hdul.close()
-            return -1
-        hdul.close()
+        key = ( self.psr_name, fe, self.subbands )
+        if key in self.templates:
+            return self.templates[ key ]
 
-        tmp_fn = "{0}_{1}_nchan{2}_template.npy".format( self.psr_name, fe, self.subbands )
         try:
-            template = self.load_template( self.temp_dir, tmp_fn )
+            template = self.load_template( self.temp_dir, self.template_name( fe ) )
         except TemplateLoadError:
             print( "Template not found" )
-            reply = str( input( "Would you like to make a suitable one? (y / n)" ) ).lower().strip()
-            if reply[0] == 'y':
-                temp = FD_Template( self.psr_name, fe, self.subbands, template_dir = "templates", verbose = self.verbose, *self.dirs )
+            try:
+                reply = str( input( "Would you like to make a suitable one? (y / n)" ) ).lower().strip()
+            except EOFError:
+                # No terminal to answer on (e.g. a batch job)
+                reply = 'n'
+            if reply[:1] == 'y':
+                from template_builder import FD_Template
+                temp = FD_Template( self.psr_name, fe, self.subbands, template_dir = "templates", files = self.files, verbose = self.verbose, *self.dirs )
                 template = temp.make_template()
             else:
                 raise TemplateLoadError( "You can make a suitable template via the following command: python template_builder.py psr_name -b [frontend] -d [dirs]" )
 
-        ar = Archive( file, verbose = self.verbose )
+        self.templates[ key ] = template
+        return template
+
+
+    def prepare_file( self, file ):
+
+        """
+        Prepares the PSRFITS file in the correct format for the program.
+        """
+
+        hdr = self.index.lookup( file )
+        if hdr is None:
+            return -1
+
+        name = hdr[ 'SRC_NAME' ]
+        fe = hdr[ 'FRONTEND' ]
+        mjd = hdr[ 'STT_IMJD' ]
+        if hdr[ 'OBS_MODE' ] != "PSR" or name != self.psr_name:
+            return -1
+
+        template = self.get_template( fe )
+
+        from pypulse.archive import Archive
+        ar = self.weights_store.apply_archive( file, Archive( file, lowmem = True, verbose = self.verbose ) )
         ar.tscrunch( nsubint = self.epochs )
         ar.fscrunch( nchan = self.subbands )
 
         return ar, template, fe, mjd
 
-    def time( self ):
+    def read_file( self, file ):
 
         """
+        Streams a PSRFITS file through the scrunch (dedispersed, total intensity) with a memory-mapped reader.
+        Channels zapped in the pulsar's weights store are given zero weight.
+        Returns what is needed to write the TOA lines and the profiles, of shape (epochs, subbands, nbin),
+        or None if the file has no folding period (so its bin time is unknown too).
         """
 
-        for directory in self.dirs:
-        # Cycle through each file in the stored directory
-            for f in sorted( os.listdir( directory ) ):
+        with PSRFITSReader( file, verbose = self.verbose ) as reader:
 
+            period, tbin = reader.getPeriod(), reader.getTbin()
+            if period is None or tbin is None:
                 if self.verbose:
-                    print( f"Preparing {f}..." )
+                    print( "{} has no folding period. Skipping...".format( os.path.basename( file ) ) )
+                return None
+
+            reader.mask = self.weights_store.mask( file, ( reader.nsubint, reader.nchan ) )
+            profiles, weights = reader.scrunch( nsubint = self.epochs, nchan = self.subbands, pscrunch = True, dedisperse = True )
+
+            nchan = profiles.shape[1]
+            start = reader.getMJD( full = True, numwrap = Decimal )
+
+            # The profiles are not centred, so the channel delays are zero, which pypulse moves up by one period
+            info = { 'FILE' : file, 'FREQS' : reader.scrunched_freqs( self.subbands ), 'STARTS' : [ start + s / Decimal( 86400 ) for s in reader.scrunched_starts( self.epochs ) ],
+                     'TOBS' : reader.scrunched_durations( self.epochs ), 'DELAYS' : [ Decimal( period ) ] * nchan, 'TBIN' : tbin,
+                     'TELESCOPE' : reader.header[ 'TELESCOP' ], 'FE' : reader.header[ 'FRONTEND' ], 'BE' : reader.header[ 'BACKEND' ],
+                     'CHANBW' : np.abs( reader.header[ 'OBSBW' ] ) / nchan, 'NBIN' : reader.nbin, 'NCHAN' : nchan }
+
+        return info, profiles
+
+    def toa_lines( self, info, fit, tempname ):
+
+        """
+        Formats the fitted TOAs of one archive as tempo2 FORMAT 1 lines (the same lines pypulse's Archive.time writes).
+        """
+
+        tauhat, bhat, sigma_tau, sigma_b, snrs = fit
+        dt = info[ 'TBIN' ]
+        lines = []
+
+        for i, t0 in enumerate( info[ 'STARTS' ] ):
+            for j, F in enumerate( info[ 'FREQS' ] ):
+                if np.isnan( tauhat[i, j] ):
+                    continue
+                toa = '{0:0.15f}'.format( Decimal( tauhat[i, j] * dt ) / Decimal( 86400 ) + t0 + info[ 'DELAYS' ][j] / Decimal( 86400 ) )
+                lines.append( "%s %f %s   %0.3f  %s   -fe %s -be %s -bw %f -tobs %f -tmplt %s -nbin %i -nch %i -chan %i -subint %i -snr %0.2f -flux %0.2f -fluxerr %0.2f %s\n"
+                              % ( info[ 'FILE' ], F, toa, sigma_tau[i, j] * dt * 1e6, info[ 'TELESCOPE' ], info[ 'FE' ], info[ 'BE' ], info[ 'CHANBW' ], info[ 'TOBS' ][i],
+                                  tempname, info[ 'NBIN' ], info[ 'NCHAN' ], j, i, snrs[i, j], bhat[i, j], sigma_b[i, j], self.jump_flags ) )
+
+        return lines
+
+    def archives( self ):
+
+        """
+        Returns the paths of the pulsar's archives (self.files if given, or else those in the stored directories), grouped by frontend.
+        """
+
+        groups = {}
+        for hdr in select_records( self.index, self.dirs, self.files, psr_name = self.psr_name, obs_mode = "PSR" ):
+            groups.setdefault( hdr[ 'FRONTEND' ], [] ).append( hdr[ 'PATH' ] )
+
+        return groups
+
+    def write_tim( self, fe, entries ):
+
+        """
+        Appends the TOA lines of one frontend to its .tim file in a single write, ordered by archive start MJD,
+        as pypulse does when archives are timed one at a time. The FORMAT line is only written to a new file.
+        entries is a list of ( start MJD, file, lines ) tuples.
+        """
+
+        abs_save = os.path.join( self.toa_dir, "{0}_{1}.{2}".format( self.psr_name, fe, self.tim_ext ) )
+
+        lines = [] if os.path.isfile( abs_save ) and os.path.getsize( abs_save ) > 0 else [ "FORMAT 1\n" ]
+        for start, file, toas in sorted( entries ):
+            lines.extend( toas )
+
+        with open( abs_save, 'a' ) as tim:
+            tim.write( "".join( lines ) )
+
+        if self.verbose:
+            print( "{} TOAs written to {}".format( sum( len( toas ) for start, file, toas in entries ), abs_save ) )
+
+        return abs_save
+
+    def time_file( self, file ):
+
+        """
+        Times a single archive with a vectorized template fit.
+        Returns ( frontend, ( start MJD, file, lines ) ), or None if the file could not be timed.
+        """
+
+        hdr = self.index.lookup( file )
+        if hdr is None or hdr[ 'OBS_MODE' ] != "PSR" or hdr[ 'SRC_NAME' ] != self.psr_name:
+            return None
 
-                prep = self.prepare_file( os.path.join( directory, f ) )
+        fe = hdr[ 'FRONTEND' ]
+        temp = self.get_template( fe )
+        result = self.read_file( file )
+        if result is None:
+            return None
+        info, profiles = result
+
+        if info[ 'NBIN' ] != np.shape( temp )[-1]:
+            if self.verbose:
+                print( "{} has {} bins but the template has {}. Skipping...".format( os.path.basename( file ), info[ 'NBIN' ], np.shape( temp )[-1] ) )
+            return None
+
+        fit = fit_toas( temp, profiles )
+
+        return fe, ( info[ 'STARTS' ][0], file, self.toa_lines( info, fit, self.template_name( fe ) ) )
+
+    def batch_time( self ):
+
+        """
+        Times every archive of each frontend in one vectorized template fit and writes one .tim file per frontend.
+        """
+
+        tim_files = []
+        for fe, files in self.archives().items():
+
+            template = self.get_template( fe )
+            nbin = np.shape( template )[-1]
+            infos, profiles = [], []
+
+            # The next archive is read while the current one is checked and stored
+            with Prefetcher( files, self.read_file, depth = self.prefetch, max_bytes = self.prefetch_bytes ) as archives:
+                for file, result in archives:
+
+                    if result is None:
+                        continue
+                    info, data = result
+
+                    if self.verbose:
+                        print( f"Prepared {os.path.basename( file )}" )
+
+                    if info[ 'NBIN' ] != nbin:
+                        if self.verbose:
+                            print( "{} has {} bins but the template has {}. Skipping...".format( os.path.basename( file ), info[ 'NBIN' ], nbin ) )
+                        continue
+
+                    infos.append( info )
+                    profiles.append( data )
+
+            if not infos:
+                continue
+
+            # Fit every profile of this frontend at once
+            split = np.cumsum( [ len( p ) for p in profiles ] )[:-1]
+            fits = zip( *[ np.split( arr, split ) for arr in fit_toas( template, np.concatenate( profiles ) ) ] )
+
+            entries = [ ( info[ 'STARTS' ][0], info[ 'FILE' ], self.toa_lines( info, fit, self.template_name( fe ) ) ) for info, fit in zip( infos, fits ) ]
+            tim_files.append( self.write_tim( fe, entries ) )
+
+        return tim_files
+
+    def parallel_time( self ):
+
+        """
+        Times archives concurrently across self.workers processes and writes one .tim file per frontend.
+        TOAs are written in start MJD order regardless of the order the workers finish in.
+        """
+
+        groups = self.archives()
+
+        # Templates are loaded (or made interactively) before any worker needs one
+        for fe in sorted( groups ):
+            self.get_template( fe )
+
+        entries = {}
+        with ProcessPoolExecutor( max_workers = self.workers, initializer = _init_worker, initargs = ( self, ) ) as pool:
+            futures = { pool.submit( _time_in_worker, file ) : file for files in groups.values() for file in files }
+            for future in as_completed( futures ):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print( "Timing of {0} failed: {1}".format( os.path.basename( futures[ future ] ), e ) )
+                    continue
+                if result is None:
+                    continue
+                fe, entry = result
+                entries.setdefault( fe, [] ).append( entry )
+
+        return [ self.write_tim( fe, entries[ fe ] ) for fe in sorted( entries ) ]
+
+    def time( self, batch = False ):
+
+        """
+        Times every archive of the pulsar in the stored directories.
+        If batch is True, archives are grouped by frontend and fit together, and one .tim file is written per frontend.
+        If self.workers is more than 1, archives are timed concurrently and also written to one .tim file per frontend.
+        Otherwise each archive is timed separately with pypulse and the TOAs are printed.
+        """
+
+        if self.workers > 1:
+            return self.parallel_time()
+        if batch:
+            return self.batch_time()
+
+        # Templates are loaded (or made interactively) before archives are read in the background
+        files = []
+        for fe, paths in sorted( self.archives().items() ):
+            self.get_template( fe )
+            files.extend( paths )
+
+        # The next archive is loaded while the current one is timed
+        with Prefetcher( files, self.prepare_file, depth = self.prefetch, max_bytes = self.prefetch_bytes ) as archives:
+            for file, prep in archives:
+
+                f = os.path.basename( file )
+                if self.verbose:
+                    print( f"Prepared {f}" )
 
                 if prep == -1:
                     if self.verbose:
@@ -157,6 +413,54 @@ class Timer:
                 ar.time( temp, filename = None, MJD = True, flags = self.jump_flags, appendto = True )
 
 
+
+# Process pool helpers. Each worker keeps its own copy of the timer (with its templates already loaded).
+_worker_timer = None
+
+def _init_worker( timer ):
+    global _worker_timer
+    _worker_timer = timer
+
+def _time_in_worker( file ):
+    return _worker_timer.time_file( file )
+
+def _time_pulsar( timer, batch ):
+    return timer.time( batch = batch )
+
+
+def time_pulsars( psr_names, *dirs, workers = 1, batch = False, **kwargs ):
+
+    """
+    Times several pulsars, returning a dictionary of the .tim files written for each.
+    With more pulsars than workers, whole pulsars are timed concurrently (one process each);
+    otherwise pulsars are timed one at a time with their archives spread across the workers.
+    batch is passed on to Timer.time and the other keyword arguments to Timer.
+    """
+
+    workers = max( int( workers ), 1 )
+    per_pulsar = workers > 1 and len( psr_names ) >= workers
+    timers = [ Timer( name, *dirs, workers = 1 if per_pulsar else workers, **kwargs ) for name in psr_names ]
+
+    if not per_pulsar:
+        return { str( timer ) : timer.time( batch = batch ) for timer in timers }
+
+    # Templates are loaded (or made interactively) in this process before the timers are sent to workers
+    for timer in timers:
+        for fe in sorted( timer.archives() ):
+            timer.get_template( fe )
+
+    tim_files = {}
+    with ProcessPoolExecutor( max_workers = workers ) as pool:
+        futures = { pool.submit( _time_pulsar, timer, batch ) : str( timer ) for timer in timers }
+        for future in as_completed( futures ):
+            try:
+                tim_files[ futures[ future ] ] = future.result()
+            except Exception as e:
+                print( "Timing of {0} failed: {1}".format( futures[ future ], e ) )
+
+    return { str( name ) : tim_files[ str( name ) ] for name in psr_names if str( name ) in tim_files }
+
+
 # TESTING
 if __name__ == "__main__":
 
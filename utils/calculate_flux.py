@@ -1,124 +1,168 @@
 # Calculates flux from a known continuum based on one of two formats
 
+import os
 import os.path as osp
-import mmap
-import math
 import argparse
+import numpy as np
 
 config_file = 'fluxcal.cfg'
 config_abs = osp.join( osp.dirname( osp.abspath( __file__ ) ), config_file )
 
 
-def find_flux_f1( frequency, source ):
+class FluxCatalogue:
 
     """
-    Returns the Format 1 (see .cfg file) flux as a float from a given source.
+    Continuum sources from a fluxcal.cfg file, parsed once and indexed by name and alias
+
+    Format 1 sources are stored as [ freq (GHz), flux (Jy), spectral index ] and Format 2 sources as their
+    log-polynomial coefficients. The file is re-parsed automatically if it changes on disk.
+
+    Parameters
+    ----------
+    config        : str, os.Path, optional
+        Location of the catalogue (default is fluxcal.cfg in this directory)
     """
 
-    if not isinstance( source, str ):
-        raise TypeError( "Source parsed in must be a string" )
+    def __init__( self, config = config_abs ):
 
-    new_f = float( frequency )
+        self.config = config
+        self.entries = []
+        self.aliases = { 1 : {}, 2 : {} }
+        self._stamp = None
 
-    src = source.encode()
-    amp_line = b""
+    def __repr__( self ):
+        return "FluxCatalogue( config = {} )".format( self.config )
 
+    def __len__( self ):
+        self.refresh()
+        return len( self.entries )
 
-    # Opens cfg file and creates read-only mmap. Then, searches for '%' (start of new source), before then searching for aliases.
-    # Once the alias is found, the last recorded '%' line is parsed into memory and the file closes.
 
-    with open( config_abs, 'rb', 0 ) as file, mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ ) as s:
-        for lin_num, line in enumerate( iter(s.readline, b"") ):
-            if line.find( b'%' ) != -1:
-                amp_line = line
+    def refresh( self ):
 
-            if src in line and not line.startswith( b"#" ):
-                file.close()
-                break
+        """
+        Re-parses the catalogue if the file has changed since it was last read.
+        """
 
-            if line.find( b'Format 2' ) != -1:
-                file.close()
-                break
+        st = os.stat( self.config )
+        if ( st.st_mtime, st.st_size ) != self._stamp:
+            self._parse()
+            self._stamp = ( st.st_mtime, st.st_size )
 
-    amp_line = amp_line.decode()
-    if amp_line == "":
-        raise ValueError( "No source matching name given was found" )
-    name, ra, dec, freq, flux, spec = amp_line.split()
+        return self
 
-    freq, flux, spec = float( freq ), float( flux ), float( spec )
-    freq /= 1000
+    def _parse( self ):
 
-    # Use spectral index to calculate flux at a different frequency
+        entries, aliases = [], { 1 : {}, 2 : {} }
+        entry = None
 
-    new_flux = flux * (( new_f / freq )**spec)
-    return new_flux
+        with open( self.config, 'r' ) as file:
+            for line in file:
+                line = line.strip()
+                if line == "" or line.startswith( "#" ):
+                    continue
 
+                if line[0] in ( "%", "&" ):
+                    fields = line[1:].split()
+                    fmt = 1 if line[0] == "%" else 2
+                    coeffs = np.array( fields[3:], dtype = float )
+                    if fmt == 1:
+                        coeffs[0] /= 1000 # MHz to GHz
+                    entry = { 'NAME' : fields[0], 'ALIASES' : [ fields[0] ], 'FORMAT' : fmt, 'POS' : fields[1:3], 'COEFFS' : coeffs }
+                    entries.append( entry )
+                    aliases[ fmt ].setdefault( fields[0], entry )
+                elif line.startswith( "aka" ) and entry is not None:
+                    alias = line.split()[1]
+                    entry[ 'ALIASES' ].append( alias )
+                    aliases[ entry[ 'FORMAT' ] ].setdefault( alias, entry )
 
-def find_source_params_f2( source ):
+        self.entries, self.aliases = entries, aliases
 
-    """
-    Returns a list of Format 2 (see .cfg file) flux parameters for a given continuum source as strings.
-    """
+    def source( self, source, format1 = False ):
 
-    if not isinstance( source, str ):
-        raise TypeError( "Source parsed in must be a string" )
+        """
+        Returns the catalogue entry of a source in the given format.
+        Names are matched exactly against the source name and its aliases first, then as a substring of them.
+        """
+
+        if not isinstance( source, str ):
+            raise TypeError( "Source parsed in must be a string" )
+
+        self.refresh()
+        fmt = 1 if format1 else 2
 
-    src = source.encode()
-    amp_line = b""
+        entry = self.aliases[ fmt ].get( source )
+        if entry is None:
+            entry = next( ( e for e in self.entries if e[ 'FORMAT' ] == fmt and any( source in alias for alias in e[ 'ALIASES' ] ) ), None )
+        if entry is None:
+            raise ValueError( "No source matching name given was found" )
 
+        return entry
 
-    # Opens cfg file and creates read-only mmap. Then, searches for '&' (start of new source), before then searching for aliases.
-    # Once the alias is found, the last recorded '&' line is parsed into memory and the file closes.
+    def flux( self, frequency, source, format1 = False ):
 
-    with open( config_abs, 'rb', 0 ) as file, mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ ) as s:
-        for lin_num, line in enumerate( iter(s.readline, b"") ):
-            if line.find( b'&' ) != -1:
-                amp_line = line
+        """
+        Returns the flux (Jy) of a source at a frequency (GHz), or an array of fluxes for an array of frequencies.
+        """
 
-            if src in line and not line.startswith( b"#" ):
-                file.close()
-                break
+        entry = self.source( source, format1 )
 
-    amp_line = amp_line.decode()
-    if amp_line == "":
-        raise ValueError( "No source matching name given was found" )
-    params = amp_line.split()
-    return params[1:3], params[3:]
+        if format1:
+            freq, flux, spec = entry[ 'COEFFS' ][:3]
+            new_flux = flux * ( ( np.asarray( frequency, dtype = float ) / freq )**spec )
+            return new_flux if new_flux.ndim else float( new_flux )
+
+        return calculate_flux_f2( frequency, entry[ 'COEFFS' ] )
+
+
+def find_flux_f1( frequency, source ):
+
+    """
+    Returns the Format 1 (see .cfg file) flux as a float from a given source.
+    If frequency is an array, an array of fluxes is returned.
+    """
+
+    return catalogue.flux( frequency, source, format1 = True )
+
+
+def find_source_params_f2( source ):
+
+    """
+    Returns the position and list of Format 2 (see .cfg file) flux parameters for a given continuum source.
+    """
+
+    entry = catalogue.source( source, format1 = False )
+    return list( entry[ 'POS' ] ), entry[ 'COEFFS' ].tolist()
 
 
 def calculate_flux_f2( frequency, params ):
 
     """
     Returns the Format 2 (see .cfg file) flux at a given frequency for a set of coefficients.
+    If frequency is an array, an array of fluxes is returned.
     """
 
     # Turn all inputs to floats if not already
-    f = float( frequency )
-    p = list( map( float, params ) )
+    f = np.asarray( frequency, dtype = float )
+    p = np.asarray( params, dtype = float )
 
-    LogS = p[0]
-
-    for i, elem in enumerate( p[1:] ):
-        corr = elem*((math.log10(f))**(i+1))
-        LogS += corr
+    # log10( S ) = p0 + p1 * log10( f ) + p2 * log10( f )^2 + ...
+    LogS = np.polyval( p[::-1], np.log10( f ) )
 
     flux = 10**LogS
-    return flux
+    return flux if flux.ndim else float( flux )
 
 
 def getFlux( frequency, source, format1 = False ):
 
     """
-    Master method. Returns the flux of a given frequency, source and format.
+    Master method. Returns the flux of a given frequency (or array of frequencies), source and format.
     """
 
-    if format1:
-        flux = find_flux_f1( frequency, str( source ) )
-    else:
-        position, params = find_source_params_f2( str( source ) )
-        flux = calculate_flux_f2( frequency, params )
+    return catalogue.flux( frequency, str( source ), format1 )
+
 
-    return flux
+catalogue = FluxCatalogue()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+# Iterative sigma clipping engine
+
+"""
+Iterative clipping on the off-pulse RMS of every profile in an archive.
+The RMS of each profile is computed once from the cached data cube. Each pass only recomputes the statistics over the
+profiles that have survived so far and adds any new outliers to a boolean (nsubint, nchan) zap mask, so no pass needs the
+archive to be reset or its data rebuilt. Outlying profiles are zapped on their own, or their whole channel is zapped if
+whole_channels is set. Clipping stops when a pass zaps nothing new (the statistics can then no longer change) or after
+the maximum number of passes.
+
+Zapping only rescales the weighted data of the surviving profiles by a common factor (pypulse normalizes by the total
+weight), and the Chauvenet criterion is scale free, so this gives the same mask as recomputing the weighted data after every pass.
+"""
+
+# Imports
+import time
+import numpy as np
+from utils.mathUtils import calculate_array_rms, chauvenet
+from utils.otherUtilities import getRMSStatistics
+
+
+class ClipEngine:
+
+    """
+    Iterative profile (or channel) clipping over a cached data cube
+
+    Parameters
+    ----------
+    data          : np.ndarray
+        Data cube of shape (..., nchan, nbin)
+    opw_mask      : np.ndarray
+        Profile mask that is False in the off-pulse window (only those bins are used for the RMS)
+    valid         : np.ndarray, optional
+        Boolean array of shape data.shape[:-1] that is False for profiles to leave out (e.g. already zero-weighted)
+    threshold     : float, optional
+        Number of standard deviations from the mean RMS beyond which a profile is an outlier
+    out_tol       : float, optional
+        Number of IQRs above the upper quartile beyond which RMS values are left out of the statistics
+    whole_channels: bool, optional
+        Zaps every subintegration of a channel in which any profile is an outlier
+    verbose       : bool, optional
+        Prints the timing and number of channels zapped in each pass
+    """
+
+    def __init__( self, data, opw_mask, valid = None, threshold = 2.0, out_tol = 1.0, whole_channels = False, verbose = False ):
+
+        data = np.asarray( data )
+        self.shape = data.shape[:-1]
+        self.nchan = data.shape[-2]
+
+        rms = np.array( calculate_array_rms( data, opw_mask ), dtype = np.float64 )
+        if valid is not None:
+            rms[ np.logical_not( np.broadcast_to( valid, rms.shape ) ) ] = np.nan
+        self.rms = rms.reshape( -1, self.nchan )
+
+        self.threshold = threshold
+        self.out_tol = out_tol
+        self.whole_channels = whole_channels
+        self.verbose = verbose
+
+        self.zapped = np.zeros( self.rms.shape, dtype = bool )
+        self.mu, self.sigma = np.nan, np.nan
+        self.log = []
+
+    def __repr__( self ):
+        return "ClipEngine( shape = {}, zapped = {} )".format( self.shape, self.count )
+
+    @property
+    def count( self ):
+        return int( np.count_nonzero( self.zapped ) )
+
+    @property
+    def mask( self ):
+
+        """
+        Boolean zap mask with the shape of the data cube without its bin axis (True where a profile is zapped).
+        """
+
+        return self.zapped.reshape( self.shape )
+
+    @property
+    def channels( self ):
+
+        """
+        Indices of the channels zapped in every subintegration.
+        """
+
+        return np.flatnonzero( np.all( self.zapped, axis = 0 ) )
+
+    @property
+    def surviving( self ):
+
+        """
+        Linear array of the (valid) RMS values of the profiles not yet zapped.
+        """
+
+        live = self.rms[ np.logical_not( self.zapped ) ]
+        return live[ np.isfinite( live ) ]
+
+
+    def step( self ):
+
+        """
+        Runs one clipping pass and returns the number of profiles it newly zapped.
+        """
+
+        start = time.perf_counter()
+
+        alive = np.logical_not( self.zapped )
+        self.mu, self.sigma = getRMSStatistics( self.rms[ alive ], self.out_tol )
+        with np.errstate( invalid = 'ignore' ):
+            outliers = chauvenet( self.rms, self.mu, self.sigma, self.threshold )
+        if self.whole_channels:
+            outliers = np.broadcast_to( np.any( outliers & alive, axis = 0 ), outliers.shape )
+
+        new = outliers & alive
+        self.zapped |= new
+
+        self.log.append( { 'ITERATION' : len( self.log ) + 1, 'ZAPPED' : int( np.count_nonzero( new ) ), 'TOTAL' : self.count, 'CHANNELS' : len( self.channels ),
+                           'MU' : float( self.mu ), 'SIGMA' : float( self.sigma ), 'TIME' : time.perf_counter() - start } )
+        if self.verbose:
+            entry = self.log[-1]
+            print( "Iteration {ITERATION}: zapped {ZAPPED} profiles ({TOTAL} in total, {CHANNELS} whole channels) in {TIME:.4f} s, mu = {MU:.4g}, sigma = {SIGMA:.4g}".format( **entry ) )
+
+        return self.log[-1][ 'ZAPPED' ]
+
+    def run( self, iterations = 1 ):
+
+        """
+        Runs up to the given number of passes, stopping early once a pass zaps nothing new.
+        Returns the boolean zap mask.
+        """
+
+        for it in range( int( iterations ) ):
+            if self.step() == 0:
+                if self.verbose:
+                    print( "Stopping after iteration {} as data is fully excised.".format( it + 1 ) )
+                break
+
+        return self.mask
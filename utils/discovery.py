@@ -0,0 +1,185 @@
+# Concurrent directory discovery
+
+"""
+Finds PSRFITS files across many directory trees. Directories are listed concurrently by a pool of threads (each
+os.scandir call is one task and every subdirectory found becomes a new task), which hides the latency of network
+filesystems where every listing and stat is a round trip. Files can be filtered by glob patterns on their names and by
+the FITS magic bytes at the start of the file (checked in the worker threads), and results are streamed as soon as
+each directory has been listed, so work can start before the scan has finished.
+
+Every directory is keyed by its ( st_dev, st_ino ) and listed at most once, so symlink loops cannot recurse forever.
+"""
+
+# Imports
+import os
+import queue
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+FITS_MAGIC = b"SIMPLE  ="
+WORKERS = 8
+
+
+def is_fits( path ):
+
+    """
+    Returns True if the file starts with the FITS magic bytes.
+    """
+
+    try:
+        with open( path, 'rb' ) as f:
+            return f.read( len( FITS_MAGIC ) ) == FITS_MAGIC
+    except OSError:
+        return False
+
+def name_matcher( patterns ):
+
+    """
+    Returns a function that checks a file name against glob patterns (a single pattern or a list of them; None matches everything).
+    """
+
+    if patterns is None:
+        return lambda name: True
+    if isinstance( patterns, str ):
+        patterns = [ patterns ]
+
+    return lambda name: any( fnmatch.fnmatch( name, pattern ) for pattern in patterns )
+
+
+def _list_directory( directory, keep, magic, recursive, follow_symlinks ):
+
+    """
+    Lists one directory, returning ( entries, subdirs, total ): the ( path, os.stat_result ) pairs of the files that pass
+    the filters, the subdirectories to walk next and the number of files in the directory.
+    """
+
+    entries, subdirs, total = [], [], 0
+    try:
+        with os.scandir( directory ) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir( follow_symlinks = follow_symlinks ):
+                        if recursive:
+                            subdirs.append( entry.path )
+                        continue
+                    if not entry.is_file():
+                        continue
+                    total += 1
+                    if keep( entry.name ) and ( not magic or is_fits( entry.path ) ):
+                        entries.append( ( entry.path, entry.stat() ) )
+                except OSError:
+                    continue
+    except OSError:
+        pass
+
+    return sorted( entries ), sorted( subdirs ), total
+
+
+def walk( *dirs, patterns = None, magic = False, recursive = True, follow_symlinks = True, workers = WORKERS ):
+
+    """
+    Yields ( directory, entries, total ) for every directory under the given ones as soon as it has been listed, where
+    entries is a list of the ( path, os.stat_result ) pairs of the files directly inside it that match the glob patterns
+    (and start with the FITS magic bytes if magic is set), and total is the number of files in it before filtering.
+    With more than one worker the directories are listed concurrently, so they come out in no particular order.
+    Directories that cannot be read are skipped.
+
+    Parameters
+    ----------
+    *dirs         : str, os.Path
+        Directories to walk
+    patterns      : str, [str, ..., str], optional
+        Glob patterns file names must match (default is every file)
+    magic         : bool, optional
+        Only keeps files starting with the FITS magic bytes
+    recursive     : bool, optional
+        Also walks subdirectories
+    follow_symlinks: bool, optional
+        Walks into symlinked directories (each directory is still listed only once)
+    workers       : int, optional
+        Number of threads listing directories
+    """
+
+    keep = name_matcher( patterns )
+    seen, lock = set(), threading.Lock()
+
+    def claim( directory ):
+        # The same directory reached twice (through a symlink or a repeated argument) is only listed once
+        try:
+            st = os.stat( directory )
+        except OSError:
+            return False
+        with lock:
+            if ( st.st_dev, st.st_ino ) in seen:
+                return False
+            seen.add( ( st.st_dev, st.st_ino ) )
+        return True
+
+    roots = [ os.path.abspath( d ) for d in dirs ]
+
+    if workers <= 1:
+        stack = roots[::-1]
+        while stack:
+            directory = stack.pop()
+            if not claim( directory ):
+                continue
+            entries, subdirs, total = _list_directory( directory, keep, magic, recursive, follow_symlinks )
+            yield directory, entries, total
+            stack.extend( subdirs[::-1] )
+        return
+
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def visit( directory ):
+        try:
+            if stop.is_set() or not claim( directory ):
+                results.put( ( None, None, 0, 0, None ) )
+                return
+            entries, subdirs, total = _list_directory( directory, keep, magic, recursive, follow_symlinks )
+        except Exception as e:
+            results.put( ( None, None, 0, 0, e ) )
+            return
+
+        # The subdirectories are counted (by putting this result) before any of them can finish
+        results.put( ( directory, entries, total, len( subdirs ), None ) )
+        for sub in subdirs:
+            if stop.is_set():
+                results.put( ( None, None, 0, 0, None ) )
+                continue
+            try:
+                pool.submit( visit, sub )
+            except RuntimeError:
+                # The pool has been shut down by a consumer that stopped early
+                results.put( ( None, None, 0, 0, None ) )
+
+    pool = ThreadPoolExecutor( max_workers = workers )
+    try:
+        for root in roots:
+            pool.submit( visit, root )
+
+        # Each finished directory replaces itself with the subdirectories it submitted
+        outstanding = len( roots )
+        while outstanding > 0:
+            directory, entries, total, nsub, error = results.get()
+            outstanding += nsub - 1
+            if error is not None:
+                raise error
+            if directory is not None:
+                yield directory, entries, total
+    finally:
+        stop.set()
+        pool.shutdown( wait = True, cancel_futures = True )
+
+
+def discover( *dirs, patterns = None, magic = False, recursive = True, follow_symlinks = True, workers = WORKERS ):
+
+    """
+    Yields the paths of the files under the given directories that match the filters, as soon as they are found.
+    Parameters are as for walk.
+    """
+
+    for directory, entries, total in walk( *dirs, patterns = patterns, magic = magic, recursive = recursive, follow_symlinks = follow_symlinks, workers = workers ):
+        for path, st in entries:
+            yield path
@@ -7,7 +7,7 @@ import scipy.stats
 import scipy.optimize
 from numpy import exp, pi, sqrt
 from utils.pulsarUtilities import get_1D_OPW_mask, get_data_from_asc, removeBase
-from utils.mathUtils import multi_norm, norm
+from utils.mathUtils import multi_norm, multi_norm_jac, norm
 from custom_exceptions import DimensionError
 
 def print_parameters( p0, p1, n ):
@@ -37,34 +37,30 @@ def get_best_gaussian_fit( x, y, remove_base = True, m_gauss = 15, bp = 15, p_wi
 
     n_gauss = 0
     params, c = [], []
+    start = []
     while ( len(c) < m_gauss ) and ( n_gauss < bp ):
 
         if len( guess_shape ) == 1:
-            params.extend( guess )
+            component = list( guess )
         elif len( guess_shape ) == 2:
             try:
-                params.extend( guess[ n_gauss ] )
+                component = list( guess[ n_gauss ] )
             except IndexError:
-                params.extend( guess[0] )
+                component = list( guess[0] )
         else:
             raise DimensionError( "Initial guess parameters must be a Nx3 array. Current shape of array is: {}".format( guess_shape ) )
 
+        # Each larger model starts from the previous fit with one new component
+        params = list( start ) + component
         n_gauss = len( params )//3
 
         try:
-            fitted_params,_ = scipy.optimize.curve_fit( multi_norm, x, y, p0 = params )
+            fitted_params,_ = scipy.optimize.curve_fit( multi_norm, x, y, p0 = params, jac = multi_norm_jac )
             if ( n_gauss == bp ) and verbose:
                 print( "Maximum number of tries reached ({})".format( n_gauss ) )
         except RuntimeError:
-            if len( guess_shape ) == 1:
-                fitted_params = np.append( fitted_params, guess )
-            elif len( guess_shape ) == 2:
-                try:
-                    fitted_params = np.append( fitted_params, guess[ n_gauss ] )
-                except IndexError:
-                    fitted_params = np.append( fitted_params, guess[0] )
-            else:
-                raise DimensionError( "You definitely shouldn't be able to see this error message." )
+            fitted_params = np.array( params, dtype = np.float64 )
+            start = params
 
             if verbose:
                 print("No fit for {} gaussians".format( n_gauss ))
@@ -72,13 +68,13 @@ def get_best_gaussian_fit( x, y, remove_base = True, m_gauss = 15, bp = 15, p_wi
                     print( "Maximum number of tries reached ({})".format( n_gauss ) )
             continue
 
+        start = list( fitted_params )
         m = multi_norm( x, *fitted_params )
         mask = get_1D_OPW_mask( m, windowsize = ( len(m) - p_wid )  )
-        for i, elem in enumerate( m ):
-            if mask[i] == False:
-                m[i] = 0
+        m[ mask == False ] = 0
 
-        chi2, p = scipy.stats.chisquare( y[mask == 1], f_exp = m[mask == 1] )
+        # Pearson's chi-squared statistic (scipy.stats.chisquare now refuses models whose sum differs from the data's)
+        chi2 = np.sum( ( y[mask == 1] - m[mask == 1] )**2 / m[mask == 1] )
         if verbose:
             print( "Chi-sq for {} gaussians: ".format( n_gauss ), chi2 )
         c.append( chi2 )
@@ -0,0 +1,232 @@
+# Persistent PSRFITS header index
+
+"""
+Stores the primary header fields every PulseBlast stage filters on (SRC_NAME, FRONTEND, OBS_MODE, STT_IMJD, RA, DEC)
+in a SQLite database keyed by absolute path, modification time and size. Files are only re-opened by astropy when
+they are new or have changed since they were last indexed.
+"""
+
+# Imports
+import os
+import sqlite3
+import threading
+from astropy.io import fits
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+default_index = os.path.join( file_root, 'header_index.db' )
+
+FIELDS = ( 'SRC_NAME', 'FRONTEND', 'OBS_MODE', 'STT_IMJD', 'RA', 'DEC' )
+COLUMNS = ( 'PATH', 'DIR', 'MTIME', 'SIZE', 'VALID' ) + FIELDS
+
+
+class HeaderIndex:
+
+    """
+    On-disk index of PSRFITS primary headers shared by every pipeline stage
+
+    Parameters
+    ----------
+    db_file       : str, os.Path, optional
+        Location of the SQLite database (default is header_index.db in the PulseBlast root)
+    verbose       : bool, optional
+        Displays more information to the console
+    """
+
+    def __init__( self, db_file = None, verbose = False ):
+
+        self.db_file = default_index if db_file is None else db_file
+        self.verbose = verbose
+        self._local = threading.local()
+
+    def __repr__( self ):
+        return "HeaderIndex( db_file = {} )".format( self.db_file )
+
+    def __str__( self ):
+        return self.db_file
+
+    # sqlite3 connections cannot be pickled or shared between threads, so each process and thread connects lazily
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        del state[ '_local' ]
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        self._local = threading.local()
+
+    @property
+    def _conn( self ):
+        return getattr( self._local, 'conn', None )
+
+    @_conn.setter
+    def _conn( self, conn ):
+        self._local.conn = conn
+
+    @property
+    def conn( self ):
+
+        if self._conn is None:
+            self._conn = sqlite3.connect( self.db_file, timeout = 60 )
+            self._conn.execute( "PRAGMA journal_mode = WAL" )
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS headers ( PATH TEXT PRIMARY KEY, DIR TEXT, MTIME REAL, SIZE INTEGER, VALID INTEGER,
+                                   SRC_NAME TEXT, FRONTEND TEXT, OBS_MODE TEXT, STT_IMJD INTEGER, RA TEXT, DEC TEXT )""" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS headers_dir ON headers ( DIR )" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS headers_psr ON headers ( SRC_NAME, FRONTEND, OBS_MODE )" )
+            self._conn.commit()
+
+        return self._conn
+
+    def close( self ):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        return self
+
+
+    def read_header( self, path ):
+
+        """
+        Opens a file with astropy and returns its primary header fields as a dictionary, or None if it is not a readable PSRFITS file.
+        """
+
+        try:
+            with fits.open( path ) as hdul:
+                header = hdul[0].header
+                record = { key : header.get( key ) for key in FIELDS }
+        except ( OSError, IndexError, ValueError ):
+            return None
+
+        if record[ 'SRC_NAME' ] is None or record[ 'OBS_MODE' ] is None:
+            return None
+
+        return record
+
+    def _row_to_record( self, row ):
+        record = dict( zip( COLUMNS, row ) )
+        if not record[ 'VALID' ]:
+            return None
+        return record
+
+    def _upsert( self, path, st ):
+
+        record = self.read_header( path )
+        if self.verbose:
+            print( "Indexing {}".format( path ) )
+
+        if record is None:
+            values = ( path, os.path.dirname( path ), st.st_mtime, st.st_size, 0 ) + ( None, ) * len( FIELDS )
+        else:
+            values = ( path, os.path.dirname( path ), st.st_mtime, st.st_size, 1 ) + tuple( record[ key ] for key in FIELDS )
+
+        self.conn.execute( "INSERT OR REPLACE INTO headers VALUES ( {} )".format( ", ".join( "?" * len( COLUMNS ) ) ), values )
+
+        return self._row_to_record( values )
+
+
+    def lookup( self, path ):
+
+        """
+        Returns the indexed header record of a single file, re-reading the file only if it is new or has changed.
+        Returns None if the file does not exist or is not a readable PSRFITS file.
+        """
+
+        path = os.path.abspath( path )
+
+        try:
+            st = os.stat( path )
+        except OSError:
+            return None
+
+        row = self.conn.execute( "SELECT * FROM headers WHERE PATH = ?", ( path, ) ).fetchone()
+        if row is not None and row[2] == st.st_mtime and row[3] == st.st_size:
+            return self._row_to_record( row )
+
+        record = self._upsert( path, st )
+        self.conn.commit()
+
+        return record
+
+    def sync( self, directory, entries ):
+
+        """
+        Brings the index of one directory up to date from a listing of it, given as ( path, os.stat_result ) pairs of its files.
+        Only new or modified files are opened and entries for files missing from the listing are dropped.
+        Returns the records of the valid PSRFITS files in the listing.
+        """
+
+        directory = os.path.abspath( directory )
+        known = { row[0] : row for row in self.conn.execute( "SELECT * FROM headers WHERE DIR = ?", ( directory, ) ) }
+
+        records = []
+        for path, st in entries:
+            row = known.pop( path, None )
+            if row is not None and row[2] == st.st_mtime and row[3] == st.st_size:
+                record = self._row_to_record( row )
+            else:
+                record = self._upsert( path, st )
+            if record is not None:
+                records.append( record )
+
+        # Anything left over has been removed since the last refresh
+        self.conn.executemany( "DELETE FROM headers WHERE PATH = ?", ( ( path, ) for path in known ) )
+        self.conn.commit()
+
+        return records
+
+    def refresh( self, *dirs ):
+
+        """
+        Incrementally brings the index up to date for each directory given (not including subdirectories).
+        """
+
+        for directory in dirs:
+
+            directory = os.path.abspath( directory )
+            if not os.path.isdir( directory ):
+                continue
+
+            entries = []
+            with os.scandir( directory ) as it:
+                for entry in it:
+                    try:
+                        if not entry.is_file():
+                            continue
+                        entries.append( ( os.path.join( directory, entry.name ), entry.stat() ) )
+                    except OSError:
+                        continue
+
+            self.sync( directory, entries )
+
+        return self
+
+    def query( self, *dirs, psr_name = None, frontend = None, obs_mode = None, refresh = True ):
+
+        """
+        Returns the header records matching the given pulsar, frontend and observation mode, sorted by path.
+        If directories are given, only files directly inside them are returned.
+        """
+
+        dirs = [ os.path.abspath( d ) for d in dirs ]
+        if refresh:
+            self.refresh( *dirs )
+
+        conditions, values = [ "VALID = 1" ], []
+        for column, value in ( ( 'SRC_NAME', psr_name ), ( 'FRONTEND', frontend ), ( 'OBS_MODE', obs_mode ) ):
+            if value is not None:
+                conditions.append( "{} = ?".format( column ) )
+                values.append( value )
+        if dirs:
+            conditions.append( "DIR IN ( {} )".format( ", ".join( "?" * len( dirs ) ) ) )
+            values.extend( dirs )
+
+        rows = self.conn.execute( "SELECT * FROM headers WHERE {} ORDER BY PATH".format( " AND ".join( conditions ) ), values )
+
+        return [ dict( zip( COLUMNS, row ) ) for row in rows ]
+
+    def files( self, directory, **kwargs ):
+
+        """
+        Returns the sorted file names in a directory whose headers match the query parameters.
+        """
+
+        return [ os.path.basename( record[ 'PATH' ] ) for record in self.query( directory, **kwargs ) ]
@@ -0,0 +1,92 @@
+# Indexed ignore list for resuming runs
+
+"""
+Ignore list entries are dictionaries of the form { 'FILE' : path, 'METHOD' : method, 'HASH' : digest, 'SIZE' : bytes, 'MTIME' : time }.
+Entries are indexed by (FILE, METHOD) so membership checks are O(1). FILE is the absolute path of the file, as a
+recursive scan can find files with the same name in different directories. A file only counts as done if its content
+digest (of the whole file) still matches, so a re-reduced file at the same path is processed again. The size and modification
+time are kept so unchanged files can be skipped from a stat alone, without reading them.
+"""
+
+import os
+import hashlib
+
+DIGEST_CHUNK = 1 << 20
+
+
+def file_digest( path, chunk_size = DIGEST_CHUNK ):
+
+    """
+    Returns a content fingerprint of a file: a BLAKE2 hash of its size and its whole content, read chunk_size bytes at a time.
+    Only files whose size or modification time changed are hashed again, so a sampled hash would buy little and miss edits
+    to the middle of a file (e.g. rewritten DAT_WTS or data).
+    """
+
+    h = hashlib.blake2b( digest_size = 16 )
+    h.update( str( os.path.getsize( path ) ).encode() )
+
+    with open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( chunk_size ), b'' ):
+            h.update( chunk )
+
+    return h.hexdigest()
+
+
+class IgnoreIndex:
+
+    """
+    Hash-indexed view of an ignore list
+
+    Parameters
+    ----------
+    entries       : [dict, dict, ...], optional
+        Existing ignore list entries. Entries from older sessions, keyed by file name rather than path, match any file of that name.
+    """
+
+    def __init__( self, entries = () ):
+
+        self._entries = {}
+        for entry in entries:
+            self.add( entry )
+
+    def __repr__( self ):
+        return "IgnoreIndex( entries = {} )".format( len( self ) )
+
+    def __len__( self ):
+        return len( self._entries )
+
+    def add( self, entry ):
+        self._entries[ ( entry[ 'FILE' ], entry[ 'METHOD' ] ) ] = entry
+        return self
+
+    def make_entry( self, path, method ):
+
+        """
+        Returns a new ignore list entry for a file.
+        """
+
+        st = os.stat( path )
+        return { 'FILE' : os.path.abspath( path ), 'METHOD' : method, 'HASH' : file_digest( path ), 'SIZE' : st.st_size, 'MTIME' : st.st_mtime }
+
+    def contains( self, path, method ):
+
+        """
+        Returns True if the file at path has already been processed with the given method and has not changed since.
+        """
+
+        entry = self._entries.get( ( os.path.abspath( path ), method ) )
+        if entry is None:
+            entry = self._entries.get( ( os.path.basename( path ), method ) )
+        if entry is None:
+            return False
+        if entry.get( 'HASH' ) is None:
+            return True
+
+        try:
+            st = os.stat( path )
+        except OSError:
+            return False
+        if ( entry.get( 'SIZE' ), entry.get( 'MTIME' ) ) == ( st.st_size, st.st_mtime ):
+            return True
+
+        return file_digest( path ) == entry[ 'HASH' ]
@@ -0,0 +1,240 @@
+# Append-only session journal
+
+"""
+Crash-safe replacement for rewriting a whole session pickle after every file.
+
+Each record is a length-prefixed, CRC-checked pickle appended to the journal. A record either updates
+some session fields and appends entries to the ignore list, or is a full snapshot of the session. Loading replays
+the records in order; a torn or corrupt record at the end of the file (e.g. from a crash mid-write) is discarded.
+The journal is periodically compacted into a single snapshot by writing a new file and atomically replacing the old one.
+"""
+
+import os
+import copy
+import pickle
+import struct
+import zlib
+
+RECORD_HEADER = struct.Struct( '>II' ) # Payload length, CRC32 of payload
+
+# Session contents for template ('m'), RFI ('r') and calibration ('c') modes
+DEFAULT_STATE = {
+    'm' : { 'DATA' : None, 'IG_LIST' : [] },
+    'r' : { 'FILE' : None, 'DATA' : None, 'POS' : [0, 0], 'IG_LIST' : [] },
+    'c' : { 'DICT' : None }
+}
+
+
+class SessionJournal:
+
+    """
+    Append-only session store
+
+    Parameters
+    ----------
+    bin_file      : str, os.Path
+        Location of the journal
+    mode          : str
+        Session type: 'm' (template), 'r' (RFI mitigation) or 'c' (calibration)
+    compact_every : int, optional
+        Number of records after which the journal is compacted into one snapshot (None to disable)
+    fsync         : bool, optional
+        Forces every record to disk before returning
+    legacy        : str, os.Path, optional
+        Session pickle to import from if the journal does not exist yet
+    """
+
+    def __init__( self, bin_file, mode, compact_every = 1000, fsync = True, legacy = None ):
+
+        if mode not in DEFAULT_STATE:
+            raise ValueError( "Unknown session mode: {}".format( mode ) )
+
+        self.bin_file = bin_file
+        self.mode = mode
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.legacy = legacy
+
+        self.state = None
+        self.records = 0
+        self._fh = None
+
+    def __repr__( self ):
+        return "SessionJournal( bin_file = {}, mode = {} )".format( self.bin_file, self.mode )
+
+    # Open file handles cannot be pickled, so copies (e.g. in worker processes) reopen lazily
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state[ '_fh' ] = None
+        return state
+
+
+    def _apply( self, state, record ):
+
+        if 'SNAPSHOT' in record:
+            return record[ 'SNAPSHOT' ]
+
+        state.update( record.get( 'SET', {} ) )
+        if record.get( 'ADD' ):
+            state[ 'IG_LIST' ].extend( record[ 'ADD' ] )
+
+        return state
+
+    def _encode( self, record ):
+        payload = pickle.dumps( record, protocol = pickle.HIGHEST_PROTOCOL )
+        return RECORD_HEADER.pack( len( payload ), zlib.crc32( payload ) ) + payload
+
+    def _read_legacy( self ):
+
+        state = copy.deepcopy( DEFAULT_STATE[ self.mode ] )
+        try:
+            with open( self.legacy, "rb" ) as pickle_in:
+                saved = pickle.load( pickle_in )
+        except ( OSError, EOFError, pickle.UnpicklingError ):
+            return state
+
+        if self.mode == 'c':
+            state[ 'DICT' ] = saved
+        else:
+            state.update( saved )
+
+        return state
+
+
+    def load( self ):
+
+        """
+        Replays the journal and returns the session state as a dictionary.
+        """
+
+        self.close()
+        state = copy.deepcopy( DEFAULT_STATE[ self.mode ] )
+        self.records = 0
+
+        if not os.path.isfile( self.bin_file ):
+            if self.legacy is not None and os.path.isfile( self.legacy ):
+                state = self._read_legacy()
+            self.state = state
+            self.compact()
+            return self.state
+
+        good = 0
+        with open( self.bin_file, "rb" ) as jnl:
+            while True:
+                header = jnl.read( RECORD_HEADER.size )
+                if len( header ) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack( header )
+                payload = jnl.read( length )
+                if len( payload ) < length or zlib.crc32( payload ) != crc:
+                    break
+                state = self._apply( state, pickle.loads( payload ) )
+                self.records += 1
+                good = jnl.tell()
+
+        # Drop any partially written record so new records follow the last good one
+        if good != os.path.getsize( self.bin_file ):
+            with open( self.bin_file, "r+b" ) as jnl:
+                jnl.truncate( good )
+
+        self.state = state
+        return self.state
+
+    def record( self, add = None, **fields ):
+
+        """
+        Appends one record that updates the given session fields and adds entries to the ignore list.
+        This is O(1) in the size of the session.
+        """
+
+        if self.state is None:
+            self.load()
+
+        rec = {}
+        if fields:
+            rec[ 'SET' ] = fields
+        if add:
+            rec[ 'ADD' ] = list( add )
+
+        if self._fh is None:
+            self._fh = open( self.bin_file, "ab" )
+        self._fh.write( self._encode( rec ) )
+        self._fh.flush()
+        if self.fsync:
+            os.fsync( self._fh.fileno() )
+
+        self.state = self._apply( self.state, rec )
+        self.records += 1
+
+        if self.compact_every is not None and self.records >= self.compact_every:
+            self.compact()
+
+        return self.state
+
+    def compact( self, state = None ):
+
+        """
+        Rewrites the journal as a single snapshot record. The old journal is only replaced once the new one is on disk.
+        """
+
+        if state is not None:
+            self.state = state
+        if self.state is None:
+            self.load()
+
+        self.close()
+        tmp_file = self.bin_file + ".tmp"
+        with open( tmp_file, "wb" ) as jnl:
+            jnl.write( self._encode( { 'SNAPSHOT' : self.state } ) )
+            jnl.flush()
+            os.fsync( jnl.fileno() )
+        os.replace( tmp_file, self.bin_file )
+        self.records = 1
+
+        return self.state
+
+    def close( self ):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        return self
+
+
+    def session( self ):
+
+        """
+        Returns the session in the same form as utils.loading.load_session does for this mode.
+        """
+
+        if self.state is None:
+            self.load()
+
+        if self.mode == 'm':
+            return self.state[ 'DATA' ], self.state[ 'IG_LIST' ]
+        elif self.mode == 'r':
+            return self.state[ 'FILE' ], self.state[ 'DATA' ], self.state[ 'POS' ], self.state[ 'IG_LIST' ]
+        else:
+            return self.state[ 'DICT' ]
+
+    def save( self, *args ):
+
+        """
+        Replaces the whole session, taking the same arguments as utils.saving.save_session does for this mode.
+        """
+
+        if self.mode == 'm':
+            temp_data, ignore_list = args
+            state = { 'DATA' : temp_data, 'IG_LIST' : list( ignore_list ) }
+        elif self.mode == 'r':
+            file, data, position, ignore_list = args
+            if len( position ) != 2:
+                raise ValueError( f"Position data corrupted. Should be length 2. Actual length: {len( position )}" )
+            state = { 'FILE' : file, 'DATA' : data, 'POS' : position, 'IG_LIST' : list( ignore_list ) }
+        else:
+            state = { 'DICT' : args[0] }
+
+        self.compact( state )
+
+        if self.mode == 'c':
+            return self.state[ 'DICT' ]
+        return self.state
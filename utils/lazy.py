@@ -0,0 +1,82 @@
+# Lazy imports
+
+"""
+Stand-ins for modules and module attributes that are only imported the first time they are used, so that scripts
+can name every pipeline stage up front while only paying for the imports of the stages that actually run.
+"""
+
+# Imports
+import importlib
+
+
+class LazyModule:
+
+    """
+    Module stand-in that imports the module on first attribute access
+
+    Parameters
+    ----------
+    name          : str
+        Absolute name of the module
+    """
+
+    def __init__( self, name ):
+        self.__dict__[ '_name' ] = name
+        self.__dict__[ '_module' ] = None
+
+    def __repr__( self ):
+        state = "loaded" if self.__dict__[ '_module' ] is not None else "not loaded"
+        return "LazyModule( {}, {} )".format( self.__dict__[ '_name' ], state )
+
+    def _load( self ):
+        if self.__dict__[ '_module' ] is None:
+            self.__dict__[ '_module' ] = importlib.import_module( self.__dict__[ '_name' ] )
+        return self.__dict__[ '_module' ]
+
+    def __getattr__( self, attr ):
+        return getattr( self._load(), attr )
+
+    def __dir__( self ):
+        return dir( self._load() )
+
+
+class LazyAttribute:
+
+    """
+    Stand-in for an attribute of a module (e.g. a class), imported when it is first called or accessed
+
+    Parameters
+    ----------
+    module        : str
+        Absolute name of the module
+    attr          : str
+        Name of the attribute within the module
+    """
+
+    def __init__( self, module, attr ):
+        self._module = module
+        self._attr = attr
+        self._value = None
+
+    def __repr__( self ):
+        return "LazyAttribute( {}.{} )".format( self._module, self._attr )
+
+    def resolve( self ):
+        if self._value is None:
+            self._value = getattr( importlib.import_module( self._module ), self._attr )
+        return self._value
+
+    def __call__( self, *args, **kwargs ):
+        return self.resolve()( *args, **kwargs )
+
+    def __getattr__( self, attr ):
+        if attr.startswith( '_' ):
+            raise AttributeError( attr )
+        return getattr( self.resolve(), attr )
+
+
+def lazy_import( name ):
+    return LazyModule( name )
+
+def lazy_attr( module, attr ):
+    return LazyAttribute( module, attr )
@@ -3,6 +3,7 @@
 import os
 import pickle
 import numpy as np
+from utils.journal import SessionJournal
 
 
 def load_session( bin_file, mode = None ):
@@ -21,11 +22,24 @@ def load_session( bin_file, mode = None ):
             return load_session_calibration_pickle( bin_file )
         else:
             return 0
+    elif ext == '.jnl':
+        return load_session_journal( bin_file, mode )
     elif ext == '.json':
         raise TypeError( "Need to figure out how JSON works..." )
     else:
         return 0
 
+def load_session_journal( bin_file, mode ):
+
+    if mode not in ( 'm', 'r', 'c' ):
+        return 0
+
+    journal = SessionJournal( bin_file, mode )
+    journal.load()
+    journal.close()
+
+    return journal.session()
+
 def load_session_template_pickle( bin_file ):
 
     try:
@@ -20,17 +20,50 @@ class FFT_dist( rv_continuous ):
         return (b/(np.sqrt(1 + a*((k-x)**2))))
 
 # Functions
+def _norm_components( x, args ):
+
+    '''
+    Returns ( z, amplitude * pdf, pdf, sigma ) of every component given as ( mu, sig, amp ) triples,
+    with the components along a new last axis of x. Like scipy.stats.norm.pdf, the pdf is nan where sig <= 0.
+    '''
+
+    p = np.reshape( np.asarray( args, dtype = np.float64 ), ( -1, 3 ) )
+    mu, sig, amp = p[:, 0], p[:, 1], p[:, 2]
+    sig = np.where( sig > 0, sig, np.nan )
+
+    z = ( np.asarray( x, dtype = np.float64 )[..., np.newaxis] - mu ) / sig
+    pdf = np.exp( -0.5 * z**2 ) / ( math.sqrt( 2 * math.pi ) * sig )
+
+    return z, amp * pdf, pdf, sig
+
 def multi_norm( x, *args ):
-    ret = None
-    n_gauss = len( args )//3
+
+    '''
+    Sum of Gaussians given as ( mu, sig, amp ) triples, evaluated for every component at once.
+    '''
 
     if len( args ) % 3 != 0:
         print( "Args supplied must be a multiple of 3 of form: mu, sig, amp" )
-    else:
-        ret = 0
-        for i in np.arange( 0, 3*n_gauss, 3 ):
-            ret += args[i + 2]*scipy.stats.norm.pdf( x, loc = args[i], scale = args[i + 1] )
-    return ret
+        return None
+
+    z, g, pdf, sig = _norm_components( x, args )
+    return np.sum( g, axis = -1 )
+
+def multi_norm_jac( x, *args ):
+
+    '''
+    Jacobian of multi_norm with respect to its parameters, of shape ( len( x ), len( args ) ),
+    for use as the jac of scipy.optimize.curve_fit.
+    '''
+
+    z, g, pdf, sig = _norm_components( np.ravel( x ), args )
+
+    jac = np.empty( g.shape[:1] + ( g.shape[1], 3 ) )
+    jac[..., 0] = g * z / sig
+    jac[..., 1] = g * ( z**2 - 1 ) / sig
+    jac[..., 2] = pdf
+
+    return jac.reshape( len( z ), -1 )
 
 
 def norm( x, m, s, k ):
@@ -47,36 +80,24 @@ def rootMeanSquare( array ):
     return np.sqrt( np.mean( np.power( array, 2 ) ) )
 
 
-def calculate_array_rms( array, mask = None, nan_mask = False ):
+def calculate_array_rms( array, mask = None, nan_mask = False, out = None ):
+
+    '''
+    Returns the RMS of every profile (last axis) of an array of any dimension.
+    Only bins where mask == 0 are used. The result can be written into a preallocated out array
+    of shape array.shape[:-1].
+    '''
+
+    array = np.asarray( array )
 
     if mask is None:
-        m = np.zeros( array.shape[-1] )
+        sel = array
     else:
-        m = mask
-
-    if array.ndim == 1:
-        rms = rootMeanSquare( array[m == 0] )
-    elif array.ndim == 2:
-        rms = []
-        for prof in array:
-            rms.append( rootMeanSquare( prof[m == 0] ) )
-    elif array.ndim == 3:
-        rms = []
-        for subint in array:
-            sub = []
-            for prof in subint :
-                sub.append( rootMeanSquare( prof[m == 0] ) )
-            rms.append( sub )
-    elif array.ndim == 4:
-        rms = []
-        for subint in array:
-            sub = []
-            for pol in subint:
-                sub2 = []
-                for prof in pol:
-                    sub2.append( rootMeanSquare( prof[m == 0] ) )
-                sub.append( sub2 )
-            rms.append( sub )
+        sel = array[..., np.asarray( mask ) == 0]
+
+    # Sum of squares over the last axis for every profile at once
+    rms = np.einsum( '...i,...i->...', sel, sel )
+    rms = np.sqrt( np.divide( rms, sel.shape[-1] ), out = out )
 
     if nan_mask:
         rms = np.ma.array( rms, mask = np.isnan( rms ) )
@@ -7,11 +7,11 @@ import platform
 import numpy as np
 import inspect
 from collections import namedtuple
-import matplotlib.pyplot as plt
 import scipy.stats as spyst
 
 from numpy import loadtxt
 from utils.mathUtils import calculate_array_rms
+from utils.discovery import walk as discovery_walk
 
 def get_data_from_asc( asc_file ):
     data = loadtxt( asc_file )
@@ -19,29 +19,36 @@ def get_data_from_asc( asc_file ):
     y = data[:, 1]
     return x, y
 
-def getRMSArrayProperties( array, mask, out_tol = 1.5 ):
+def getRMSArrayProperties( array, mask, out_tol = 1.5, out = None ):
 
     '''
     Returns the RMS array, a linearized RMS array, the mean and standard deviation
     '''
 
     # Return the array of RMS values for each profile
-    r = calculate_array_rms( array, mask, True )
-    l_shape = 1
-    for s in array.shape[:-1]:
-        l_shape *= s
+    r = calculate_array_rms( array, mask, True, out = out )
 
     # Reshape RMS array to be linear and store in a new RMS array
-    l = np.reshape( r, l_shape )
+    l = np.reshape( r, -1 )
 
     # Mean and standard deviation
+    mu, s = getRMSStatistics( l, out_tol )
+
+    return r, l, mu, s
+
+def getRMSStatistics( l, out_tol = 1.5 ):
+
+    '''
+    Returns the mean and standard deviation of a linear RMS array, ignoring NaNs and values more than out_tol IQRs above the upper quartile
+    '''
+
     m, excess = np.nanmedian( l ), out_tol * spyst.iqr( l, nan_policy = 'omit' )
     outlier_bounds = [ 0, np.nanpercentile( l, 75 ) ]
     outlier_bounds = [ outlier_bounds[0], outlier_bounds[1] + excess ]
     array_to_do_calculations = l[ (l >= outlier_bounds[0]) & (l <= outlier_bounds[1]) ]
     mu, s = np.nanmean( array_to_do_calculations ), np.nanstd( array_to_do_calculations )
 
-    return r, l, mu, s
+    return mu, s
 
 # Delete and flush the current line on the console
 def restart_line():
@@ -178,22 +185,31 @@ def addExtension( file, ext, save = False, overwrite = False ):
     return fileout
 
 
-def count_files( search_string, *dirs, verbose = True ):
+def count_files( search_string, *dirs, recursive = False, magic = False, workers = 8, verbose = True ):
+
+    """
+    Counts the files in each directory whose names match search_string: a glob pattern (e.g. "*.fits"),
+    or any name containing it if it has no wildcards. With magic set only files starting with the FITS magic bytes are counted.
+    Directories are listed concurrently (see utils.discovery), including subdirectories if recursive is set.
+    Returns [ [ directory, total files, matching files ], ... ] and the total number of matching files.
+    """
+
+    if not any( c in search_string for c in "*?[" ):
+        search_string = "*{}*".format( search_string )
+
     total = []
     final_count = 0
     for d in dirs:
-        count = 0
-        f_list = os.listdir( d )
-        total_count = len( f_list )
-        for f in f_list:
-            if search_string in f:
-                count += 1
+        total_count, count = 0, 0
+        for directory, entries, n in discovery_walk( d, patterns = search_string, magic = magic, recursive = recursive, workers = workers ):
+            total_count += n
+            count += len( entries )
         total.append( [ d, total_count, count ] )
         final_count += count
     if verbose:
         for e in total:
-            print( "Directory: {}".format( e[0] ), "\t", "Total files: {}".format( e[1] ), "\t", "Files found containing '{}': {}".format( search_string, e[2] ) )
-        print( "Total files found containing '{}': {}".format( search_string, final_count ) )
+            print( "Directory: {}".format( e[0] ), "\t", "Total files: {}".format( e[1] ), "\t", "Files found matching '{}': {}".format( search_string, e[2] ) )
+        print( "Total files found matching '{}': {}".format( search_string, final_count ) )
     return total, final_count
 
 
@@ -0,0 +1,144 @@
+# Stage pipeline
+
+"""
+Runs the PulseBlast stages (templates, RFI mitigation, calibration, timing) for a pulsar as a small dependency graph.
+A stage only runs once every stage it requires has succeeded; if a stage fails its dependants are skipped for that
+pulsar, and the remaining pulsars are still processed.
+"""
+
+# Imports
+import time
+import traceback
+
+OK, FAILED, SKIPPED = "OK", "FAILED", "SKIPPED"
+
+
+class Stage:
+
+    """
+    A single step of the pipeline
+
+    Parameters
+    ----------
+    name          : str
+        Name of the stage
+    run           : callable
+        Called with the pulsar name to run the stage
+    requires      : tuple, optional
+        Names of the stages that must succeed before this one
+    """
+
+    def __init__( self, name, run, requires = () ):
+        self.name = name
+        self.run = run
+        self.requires = tuple( requires )
+
+    def __repr__( self ):
+        return "Stage( {}, requires = {} )".format( self.name, list( self.requires ) )
+
+
+class Pipeline:
+
+    """
+    Dependency graph of stages, run for one pulsar at a time
+
+    Parameters
+    ----------
+    verbose       : bool, optional
+        Prints the traceback of a failed stage
+    """
+
+    def __init__( self, verbose = False ):
+        self.stages = {}
+        self.verbose = verbose
+
+    def __repr__( self ):
+        return "Pipeline( {} )".format( " -> ".join( stage.name for stage in self.order() ) )
+
+    def __len__( self ):
+        return len( self.stages )
+
+    def add( self, name, run, requires = () ):
+
+        """
+        Adds a stage, returning the pipeline so that calls can be chained.
+        """
+
+        if name in self.stages:
+            raise ValueError( "Stage {} is already in the pipeline".format( name ) )
+        self.stages[ name ] = Stage( name, run, requires )
+        return self
+
+    def order( self ):
+
+        """
+        Returns the stages in an order that respects their requirements (stages that are free to run go in the order they were added).
+        """
+
+        for stage in self.stages.values():
+            for req in stage.requires:
+                if req not in self.stages:
+                    raise ValueError( "Stage {} requires {}, which is not in the pipeline".format( stage.name, req ) )
+
+        done, order = set(), []
+        while len( order ) < len( self.stages ):
+            ready = [ stage for name, stage in self.stages.items() if name not in done and all( req in done for req in stage.requires ) ]
+            if not ready:
+                raise ValueError( "Stage requirements are circular: {}".format( ", ".join( name for name in self.stages if name not in done ) ) )
+            order.append( ready[0] )
+            done.add( ready[0].name )
+
+        return order
+
+
+    def run( self, psr_name ):
+
+        """
+        Runs every stage for one pulsar and returns the status of each stage (OK, FAILED or SKIPPED).
+        """
+
+        status = {}
+        for stage in self.order():
+
+            blocked = [ req for req in stage.requires if status[ req ] != OK ]
+            if blocked:
+                status[ stage.name ] = SKIPPED
+                print( "{}: skipping {} as {} did not succeed".format( psr_name, stage.name, ", ".join( blocked ) ) )
+                continue
+
+            start = time.perf_counter()
+            print( "{}: running {}".format( psr_name, stage.name ) )
+            try:
+                stage.run( psr_name )
+            except Exception as e:
+                status[ stage.name ] = FAILED
+                print( "{}: {} failed: {}".format( psr_name, stage.name, repr( e ) ) )
+                if self.verbose:
+                    traceback.print_exc()
+            else:
+                status[ stage.name ] = OK
+                print( "{}: {} finished in {:.1f} s".format( psr_name, stage.name, time.perf_counter() - start ) )
+
+        return status
+
+    def run_all( self, psr_names ):
+
+        """
+        Runs the pipeline for every pulsar, returning a dictionary of the stage statuses for each.
+        """
+
+        return { psr : self.run( psr ) for psr in psr_names }
+
+
+def summarize( results ):
+
+    """
+    Prints a table of the stage statuses of every pulsar and returns the number of stages that failed or were skipped.
+    """
+
+    bad = 0
+    for psr, status in results.items():
+        print( "{:<16}{}".format( psr, "  ".join( "{} {}".format( name, state ) for name, state in status.items() ) ) )
+        bad += sum( 1 for state in status.values() if state != OK )
+
+    return bad
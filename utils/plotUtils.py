@@ -24,10 +24,7 @@ def plot_flux( source, ctr_freq, bandwidth, nchan, format1 = False, show = False
     """
 
     freqs = psr_u.chan_to_freq( ctr_freq, bandwidth, nchan )
-    fluxes = []
-    for f in freqs:
-        flux = getFlux( f, source, format1 )
-        fluxes.append( flux )
+    fluxes = getFlux( freqs, source, format1 )
 
     if show:
         # Set up figure and axes
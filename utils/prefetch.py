@@ -0,0 +1,148 @@
+# Background archive prefetching
+
+"""
+Loads the next items of a file loop in a background thread while the current one is being processed, so that
+reading from disk overlaps with computation. The number of loaded items waiting to be used is bounded both by a
+queue depth and (optionally) by an estimate of the memory they hold.
+"""
+
+# Imports
+import threading
+from collections import deque
+import numpy as np
+
+
+def estimate_size( obj ):
+
+    """
+    Returns a rough estimate of the bytes held by the arrays in a loaded item (arrays, containers of them, or objects such as Archives with array attributes).
+    """
+
+    if isinstance( obj, np.ndarray ):
+        return obj.nbytes
+    if isinstance( obj, ( list, tuple ) ):
+        return sum( estimate_size( elem ) for elem in obj )
+    if isinstance( obj, dict ):
+        return sum( estimate_size( elem ) for elem in obj.values() )
+    if hasattr( obj, '__dict__' ):
+        return sum( elem.nbytes for elem in vars( obj ).values() if isinstance( elem, np.ndarray ) )
+    return 0
+
+
+class Prefetcher:
+
+    """
+    Iterates over ( item, loader( item ) ) with up to depth items loaded ahead in a background thread
+
+    Parameters
+    ----------
+    items         : iterable
+        Items to load (e.g. file paths)
+    loader        : callable
+        Function that loads one item. Exceptions it raises are re-raised when that item is reached.
+    depth         : int, optional
+        Maximum number of items loaded ahead of the one being processed (0 loads each item when it is reached)
+    max_bytes     : int, optional
+        Maximum estimated memory of the items loaded ahead (None for no limit). One item is always allowed.
+    sizeof        : callable, optional
+        Function returning the size in bytes of a loaded item (default is estimate_size)
+    """
+
+    def __init__( self, items, loader, depth = 1, max_bytes = None, sizeof = estimate_size ):
+
+        self.items = list( items )
+        self.loader = loader
+        self.depth = max( int( depth ), 0 )
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._buffer = deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def __repr__( self ):
+        return "Prefetcher( items = {}, depth = {}, max_bytes = {} )".format( len( self.items ), self.depth, self.max_bytes )
+
+    def __len__( self ):
+        return len( self.items )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.close()
+
+
+    def _has_room( self ):
+        if len( self._buffer ) == 0:
+            return True
+        if len( self._buffer ) >= self.depth:
+            return False
+        return self.max_bytes is None or self._bytes < self.max_bytes
+
+    def _run( self ):
+
+        for item in self.items:
+
+            with self._cond:
+                while not self._stop and not self._has_room():
+                    self._cond.wait()
+                if self._stop:
+                    return
+
+            try:
+                result, error = self.loader( item ), None
+            except Exception as e:
+                result, error = None, e
+            nbytes = self.sizeof( result ) if error is None else 0
+
+            with self._cond:
+                self._buffer.append( ( item, result, error, nbytes ) )
+                self._bytes += nbytes
+                self._cond.notify_all()
+
+    def __iter__( self ):
+
+        if self.depth == 0:
+            for item in self.items:
+                yield item, self.loader( item )
+            return
+
+        self._stop = False
+        self._thread = threading.Thread( target = self._run, daemon = True )
+        self._thread.start()
+
+        try:
+            for _ in range( len( self.items ) ):
+                with self._cond:
+                    while not self._buffer:
+                        self._cond.wait()
+                    item, result, error, nbytes = self._buffer.popleft()
+                    self._bytes -= nbytes
+                    self._cond.notify_all()
+
+                if error is not None:
+                    raise error
+                yield item, result
+        finally:
+            self.close()
+
+    def close( self ):
+
+        """
+        Stops loading ahead and drops any items that have not been used.
+        """
+
+        with self._cond:
+            self._stop = True
+            self._buffer.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+        return self
@@ -0,0 +1,283 @@
+# Streaming PSRFITS reader
+
+"""
+Reads fold-mode PSRFITS files one subintegration at a time from a memory-mapped SUBINT table.
+DAT_SCL, DAT_OFFS and DAT_WTS are only applied to the row being read, so scrunching a file needs memory for one
+subintegration and the scrunched output, rather than the whole decoded data cube pypulse's Archive builds.
+"""
+
+# Imports
+import numpy as np
+from decimal import Decimal
+from astropy.io import fits
+import utils.pulsarUtilities as pu
+
+# Dispersion constant used by pypulse (for consistency with PSRCHIVE)
+KCONST = 1.0/2.41e-4
+
+
+def scrunch_factor( n, new_n ):
+
+    """
+    Returns the number of elements averaged together to reduce n to new_n (as pypulse does).
+    """
+
+    factor = n // new_n
+    if n % new_n != 0:
+        factor += 1
+    return max( factor, 1 )
+
+
+class PSRFITSReader:
+
+    """
+    Memory-mapped, row-at-a-time reader for fold-mode PSRFITS files
+
+    Parameters
+    ----------
+    file          : str, os.Path
+        PSRFITS file to read
+    weight        : bool, optional
+        Applies DAT_WTS when scrunching (otherwise every channel has unit weight)
+    mask          : np.ndarray, optional
+        Boolean zap mask of shape (nsubint, nchan); channels where it is True get zero weight
+    verbose       : bool, optional
+        Displays more information to the console
+    """
+
+    def __init__( self, file, weight = True, mask = None, verbose = False ):
+
+        self.file = str( file )
+        self.weight = weight
+        self.mask = mask
+        self.verbose = verbose
+        self.hdul = None
+        self.open()
+
+    def __repr__( self ):
+        return "PSRFITSReader( file = {} )".format( self.file )
+
+    def __str__( self ):
+        return self.file
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.close()
+
+    def open( self ):
+
+        if self.hdul is not None:
+            return self
+
+        self.hdul = fits.open( self.file, memmap = True, ignore_missing_end = True )
+        self.header = self.hdul[0].header
+        self.subint = self.hdul[ 'SUBINT' ]
+        self.subintheader = self.subint.header
+
+        self.nsubint = self.subintheader[ 'NAXIS2' ]
+        self.nbin, self.nchan, self.npol, self.nsblk = map( int, self.subint.columns[ 'DATA' ].dim[1:-1].split( "," ) )
+
+        return self
+
+    def close( self ):
+        if self.hdul is not None:
+            self.hdul.close()
+            self.hdul = None
+        return self
+
+
+    def column( self, name ):
+        return self.subint.data.field( name )
+
+    @property
+    def freqs( self ):
+        return np.asarray( self.column( 'DAT_FREQ' ), dtype = np.float64 ).reshape( self.nsubint, -1 )[0]
+
+    @property
+    def durations( self ):
+        return np.asarray( self.column( 'TSUBINT' ), dtype = np.float64 )
+
+    @property
+    def subint_starts( self ):
+        return [ Decimal( float( s ) ) for s in self.column( 'OFFS_SUB' ) ]
+
+    def getMJD( self, full = False, numwrap = float ):
+        if full:
+            return numwrap( self.header[ 'STT_IMJD' ] ) + ( numwrap( self.header[ 'STT_SMJD' ] ) + numwrap( self.header[ 'STT_OFFS' ] ) ) / numwrap( 86400 )
+        return numwrap( self.header[ 'STT_IMJD' ] ) + numwrap( self.header[ 'STT_OFFS' ] )
+
+    def getDM( self ):
+        for hdr, key in ( ( self.subintheader, 'DM' ), ( self.header, 'DM' ), ( self.header, 'CHAN_DM' ) ):
+            if key in hdr:
+                return float( hdr[ key ] )
+        return None
+
+    def getPeriod( self ):
+
+        """
+        Returns the folding period from the SUBINT PERIOD column, the POLYCO reference frequency or the HISTORY bin time (in that order).
+        """
+
+        names = [ hdu.name for hdu in self.hdul ]
+        if 'PERIOD' in self.subint.columns.names:
+            return float( np.mean( self.column( 'PERIOD' ) ) )
+        if 'POLYCO' in names:
+            return 1.0 / float( self.hdul[ 'POLYCO' ].data[ 'REF_F0' ][-1] )
+        if 'HISTORY' in names:
+            return float( self.hdul[ 'HISTORY' ].data[ 'TBIN' ][-1] ) * self.nbin
+        return None
+
+    def getCenterFrequency( self, weighted = False ):
+        if weighted:
+            freqs = np.asarray( self.column( 'DAT_FREQ' ), dtype = np.float64 ).reshape( self.nsubint, -1 )
+            weights = np.asarray( self.column( 'DAT_WTS' ), dtype = np.float64 ).reshape( self.nsubint, -1 )
+            if self.mask is not None:
+                weights = np.where( self.mask, 0.0, weights )
+            return np.nansum( freqs * weights ) / np.nansum( weights )
+        return float( self.header[ 'OBSFREQ' ] )
+
+    def getTbin( self ):
+        period = self.getPeriod()
+        return None if period is None else period / self.nbin
+
+
+    def read_subint( self, i ):
+
+        """
+        Returns the scaled data of subintegration i as an array of shape (npol, nchan, nbin) and its channel weights.
+        """
+
+        data = np.asarray( self.column( 'DATA' )[i], dtype = np.float64 ).reshape( self.nsblk, self.npol, self.nchan, self.nbin )[0]
+        scl = np.asarray( self.column( 'DAT_SCL' )[i], dtype = np.float64 ).reshape( self.npol, self.nchan, 1 )
+        offs = np.asarray( self.column( 'DAT_OFFS' )[i], dtype = np.float64 ).reshape( self.npol, self.nchan, 1 )
+
+        if self.weight:
+            weights = np.asarray( self.column( 'DAT_WTS' )[i], dtype = np.float64 ).reshape( self.nchan )
+        else:
+            weights = np.ones( self.nchan )
+        if self.mask is not None:
+            weights = np.where( self.mask[i], 0.0, weights )
+
+        return data * scl + offs, weights
+
+    def iter_subints( self ):
+
+        """
+        Yields ( index, data, weights ) for each subintegration in turn.
+        """
+
+        for i in range( self.nsubint ):
+            data, weights = self.read_subint( i )
+            yield i, data, weights
+
+    def total_intensity( self, data ):
+
+        """
+        Reduces one subintegration to total intensity, as pypulse's pscrunch does.
+        """
+
+        if self.npol == 1:
+            return data[0]
+        if self.subintheader.get( 'POL_TYPE' ) == "AABBCRCI":
+            return data[0] + data[1]
+        return data[0]
+
+    def dispersion_phases( self, wcfreq = True ):
+
+        """
+        Returns the Fourier phase ramp that dedisperses each channel to the (weighted, if wcfreq) centre frequency.
+        This is the shift pypulse's dedisperse applies when an Archive is loaded.
+        """
+
+        dm, tbin = self.getDM(), self.getTbin()
+        if dm is None or tbin is None or self.nchan == 1:
+            return None
+
+        bin_delay = ( KCONST * dm * ( self.getCenterFrequency( weighted = wcfreq )**(-2) - self.freqs**(-2) ) / tbin ) % self.nbin
+        return np.exp( -2j * np.pi * np.outer( bin_delay, np.fft.rfftfreq( self.nbin ) ) )
+
+    def scrunch( self, nsubint = 1, nchan = 1, pscrunch = True, dedisperse = False, wcfreq = True ):
+
+        """
+        Streams every subintegration through a weighted time and frequency average, returning ( data, weights ).
+        data has shape (nsubint, nchan, nbin) if pscrunch is True and (nsubint, npol, nchan, nbin) otherwise.
+        Averages are weighted by DAT_WTS in the same way as pypulse's tscrunch followed by fscrunch
+        (the data match Archive.getData( weight = False ) after the same operations).
+        """
+
+        t_factor = scrunch_factor( self.nsubint, nsubint )
+        f_factor = scrunch_factor( self.nchan, nchan )
+        new_nsub = len( range( 0, self.nsubint, t_factor ) )
+        chan_starts = np.arange( 0, self.nchan, f_factor )
+
+        pol_shape = () if pscrunch else ( self.npol, )
+        acc = np.zeros( ( new_nsub, ) + pol_shape + ( len( chan_starts ), self.nbin ) )
+        wsum = np.zeros( ( new_nsub, len( chan_starts ) ) )
+
+        phases = self.dispersion_phases( wcfreq ) if dedisperse else None
+
+        for i, data, weights in self.iter_subints():
+
+            if pscrunch:
+                data = self.total_intensity( data )
+            if phases is not None:
+                data = np.fft.irfft( np.fft.rfft( data, axis = -1 ) * phases, n = self.nbin, axis = -1 )
+
+            data = np.nan_to_num( data )
+            weights = np.nan_to_num( weights )
+
+            t = i // t_factor
+            acc[t] += np.add.reduceat( data * weights[:, np.newaxis], chan_starts, axis = -2 )
+            wsum[t] += np.add.reduceat( weights, chan_starts )
+
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            if pscrunch:
+                acc /= wsum[..., np.newaxis]
+            else:
+                acc /= wsum[:, np.newaxis, :, np.newaxis]
+
+        # Weights are left as pypulse leaves them: summed over time and averaged over frequency
+        wsum /= np.diff( np.append( chan_starts, self.nchan ) )
+
+        return acc, wsum
+
+    def prepare( self, nsubint = 1, nchan = 1 ):
+
+        """
+        Returns what Archive( file ).tscrunch( nsubint ).fscrunch( nchan ).getData() would, without ever holding the full data cube:
+        total intensity, dedispersed, with the pulse centred and the off-pulse baseline removed, multiplied by the normalized weights and squeezed.
+        Zero-weighted profiles are returned as zeros rather than NaN.
+        """
+
+        data, weights = self.scrunch( nsubint = nsubint, nchan = nchan, pscrunch = True, dedisperse = True )
+        data = np.nan_to_num( data )
+
+        # Centring and baseline removal are linear, so they are done on the scrunched data
+        total = np.sum( data * weights[..., np.newaxis], axis = ( 0, 1 ) )
+        diff = int( self.nbin * 0.5 ) - np.argmax( total )
+        data = np.roll( data, diff, axis = -1 )
+
+        opw = np.logical_not( pu.get_1D_OPW_mask( np.roll( total, diff ), windowsize = int( self.nbin // 8 ) ) )
+        data -= np.mean( data[..., opw], axis = -1, keepdims = True )
+        data *= weights[..., np.newaxis] / np.sum( weights )
+
+        return np.squeeze( data )
+
+    def scrunched_freqs( self, nchan = 1 ):
+
+        """
+        Returns the (unweighted) centre frequencies of the channels after scrunching to nchan.
+        """
+
+        chan_starts = np.arange( 0, self.nchan, scrunch_factor( self.nchan, nchan ) )
+        counts = np.diff( np.append( chan_starts, self.nchan ) )
+        return np.add.reduceat( self.freqs, chan_starts ) / counts
+
+    def scrunched_durations( self, nsubint = 1 ):
+        return np.add.reduceat( np.nan_to_num( self.durations ), np.arange( 0, self.nsubint, scrunch_factor( self.nsubint, nsubint ) ) )
+
+    def scrunched_starts( self, nsubint = 1 ):
+        starts = self.subint_starts
+        return [ starts[i] for i in range( 0, self.nsubint, scrunch_factor( self.nsubint, nsubint ) ) ]
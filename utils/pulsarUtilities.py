@@ -3,12 +3,11 @@
 # Imports
 import numpy as np
 import math
+from collections import OrderedDict
 import utils.otherUtilities as u
 import utils.mathUtils as mu
 from custom_exceptions import DimensionError
 
-from pypulse.singlepulse import SinglePulse
-
 # Functions
 
 def get_data_from_asc( asc_file, duty = None ):
@@ -49,21 +48,44 @@ def chan_to_freq( ctr_freq, bandwidth, nchan ):
     return freq
 
 
+# Cache of OPW masks keyed on the profile bytes and SinglePulse keywords
+OPW_CACHE_SIZE = 256
+_opw_cache = OrderedDict()
+
 def get_1D_OPW_mask( vector, **kwargs ):
 
+    """
+    Returns a boolean mask that is False in the off-pulse window of a profile and True elsewhere.
+    Masks are cached so repeated calls with the same profile and windowsize do not recompute the window.
+    The returned mask is read-only.
+    """
+
     if vector.ndim is not 1:
         raise DimensionError( "Input data must be 1 dimensional to create an OPW mask." )
 
-    mask = []
+    try:
+        key = ( vector.dtype.str, vector.tobytes(), tuple( sorted( kwargs.items() ) ) )
+        hash( key )
+    except TypeError:
+        key = None
+
+    if key is not None and key in _opw_cache:
+        _opw_cache.move_to_end( key )
+        return _opw_cache[ key ]
+
+    # pypulse (and the matplotlib it pulls in) is only imported the first time a window is needed
+    from pypulse.singlepulse import SinglePulse
     sp_dat = SinglePulse( vector, **kwargs )
 
-    while len( mask ) < len( vector ):
-        if len( mask ) in sp_dat.opw:
-            mask.append( False )
-        else:
-            mask.append( True )
+    mask = np.ones( len( vector ), dtype = bool )
+    mask[ sp_dat.opw ] = False
+    mask.flags.writeable = False
+
+    if key is not None:
+        _opw_cache[ key ] = mask
+        if len( _opw_cache ) > OPW_CACHE_SIZE:
+            _opw_cache.popitem( last = False )
 
-    mask = np.asarray( mask )
     return mask
 
 
@@ -186,6 +208,7 @@ def plot_contour_pdf( x_val, y_val, contour_data, n_steps = 64, linecolour = 'bl
     yspan = abs( ymax - ymin )
 
 # Set up the plot:
+    import matplotlib.pyplot as plt
     fig = plt.figure( figsize = canvassize )
     ax = fig.add_axes( [xstart, ystart, xend, yend] )
     ax.xaxis.set_tick_params( labelsize = ticklabelsize, pad = 8 )
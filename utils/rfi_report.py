@@ -0,0 +1,156 @@
+# Deferred RFI mitigation diagnostics
+
+"""
+RFI mitigation only records a compact diagnostics record per file (the RMS histogram and the clipping statistics)
+in a per-pulsar JSON lines file, so no figures are made while files are being mitigated. The plots are rendered from
+these records afterwards, on demand and optionally in parallel, without a display (figures are drawn on an Agg canvas
+and never registered with pyplot, so nothing accumulates over long runs).
+
+Record format:
+{ 'FILE' : name, 'METHOD' : method, 'SHAPE' : [ nsubint, nchan ], 'ZAPPED' : profiles, 'MU' : mean, 'SIGMA' : std,
+  'COUNTS' : [ ... ], 'EDGES' : [ ... ], 'ITERATIONS' : [ { 'ITERATION', 'ZAPPED', 'TOTAL', 'CHANNELS', 'MU', 'SIGMA', 'TIME' }, ... ] }
+"""
+
+# Imports
+import os
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+DIAGNOSTICS_NAME = "{}_rfi_diagnostics.jsonl"
+
+
+def diagnostics_path( directory, psr_name ):
+    return os.path.join( directory, DIAGNOSTICS_NAME.format( psr_name ) )
+
+
+def histogram_record( file, values, mu, sigma, bins = 10, **extra ):
+
+    """
+    Returns a diagnostics record holding the histogram (bin counts and edges) of an array of RMS values and its statistics.
+    Extra keyword arguments are added to the record.
+    """
+
+    values = np.asarray( values, dtype = np.float64 )
+    values = values[ np.isfinite( values ) ]
+    counts, edges = np.histogram( values, bins = max( int( bins ), 1 ) )
+
+    record = { 'FILE' : os.path.basename( file ), 'MU' : float( mu ), 'SIGMA' : float( sigma ), 'COUNTS' : counts.tolist(), 'EDGES' : edges.tolist() }
+    record.update( extra )
+
+    return record
+
+def append_records( path, *records ):
+
+    """
+    Appends diagnostics records to a JSON lines file.
+    """
+
+    with open( path, 'a' ) as f:
+        f.write( "".join( json.dumps( record ) + "\n" for record in records ) )
+
+    return path
+
+def load_records( path ):
+
+    """
+    Returns the diagnostics records in a JSON lines file keyed by file name (the latest record of a file wins).
+    """
+
+    records = {}
+    if not os.path.isfile( path ):
+        return records
+
+    with open( path, 'r' ) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads( line )
+                records[ record[ 'FILE' ] ] = record
+
+    return records
+
+
+def render_record( record, out_dir, fmt = 'png' ):
+
+    """
+    Draws the RMS histogram of one record with its fitted normal curve (as histogram_and_curves does) and saves it to out_dir.
+    Returns the path of the saved plot.
+    """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import scipy.optimize as opt
+    import scipy.stats as spyst
+
+    counts = np.asarray( record[ 'COUNTS' ], dtype = np.float64 )
+    edges = np.asarray( record[ 'EDGES' ], dtype = np.float64 )
+    mu, sigma = record[ 'MU' ], record[ 'SIGMA' ]
+
+    # Density normalization, as with hist( density = True )
+    total = np.sum( counts * np.diff( edges ) )
+    density = counts / total if total > 0 else counts
+
+    fig = Figure( figsize = ( 6, 6 ) )
+    FigureCanvasAgg( fig )
+    ax = fig.add_subplot( 111, facecolor = 'w' )
+    ax.set_xlabel( 'Root Mean Squared' )
+    ax.set_ylabel( 'Frequency Density' )
+    ax.set_title( r'{}: $\mu={:.4g},\ \sigma={:.4g}$'.format( record[ 'FILE' ], mu, sigma ) )
+    ax.stairs( density, edges, fill = True, color = 'k' )
+
+    if np.isfinite( mu ) and np.isfinite( sigma ) and sigma > 0:
+        ax.set_xlim( mu - ( 4 * sigma ), mu + ( 4 * sigma ) )
+        t = np.linspace( mu - ( 4 * sigma ), mu + ( 4 * sigma ), 500 )
+        try:
+            params, cov = opt.curve_fit( spyst.norm.pdf, edges[1:], density, p0 = [ mu, sigma ] )
+        except ( RuntimeError, ValueError ):
+            params = [ mu, sigma ]
+        ax.plot( t, spyst.norm.pdf( t, *params ), color = 'r', linewidth = 2 )
+
+    if len( density ) > 0 and np.amax( density ) > 0:
+        ax.set_ylim( 0, 1.2 * np.amax( density ) )
+
+    out = os.path.join( out_dir, "{}_rfi_histogram.{}".format( os.path.splitext( record[ 'FILE' ] )[0], fmt ) )
+    fig.savefig( out )
+
+    return out
+
+def render_report( path, out_dir, files = None, workers = 1, fmt = 'png' ):
+
+    """
+    Renders the plots of every record in a diagnostics file (or only those of the given files) into out_dir.
+    Plots are rendered across workers processes if workers is more than 1. Returns the paths of the saved plots.
+    """
+
+    records = load_records( path )
+    if files is not None:
+        names = set( os.path.basename( f ) for f in files )
+        records = { name : record for name, record in records.items() if name in names }
+
+    if not os.path.exists( out_dir ):
+        os.makedirs( out_dir )
+
+    todo = [ records[ name ] for name in sorted( records ) ]
+    if workers > 1 and len( todo ) > 1:
+        with ProcessPoolExecutor( max_workers = workers ) as pool:
+            return list( pool.map( render_record, todo, [ out_dir ] * len( todo ), [ fmt ] * len( todo ) ) )
+
+    return [ render_record( record, out_dir, fmt ) for record in todo ]
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser( description = "Renders the RFI mitigation diagnostics recorded for a pulsar." )
+    parser.add_argument( "psr_name", help = "Pulsar name as given in the PSRFITS files" )
+    parser.add_argument( "-o", "--out", default = None, help = "Directory to save the plots to (default is [psr_name]/diagnostics)" )
+    parser.add_argument( "-f", "--files", nargs = '+', default = None, help = "Only render the plots of these files" )
+    parser.add_argument( "-w", "--workers", type = int, default = 1, help = "Number of processes to render plots with" )
+    args = parser.parse_args()
+
+    out_dir = args.out if args.out is not None else os.path.join( file_root, args.psr_name, 'diagnostics' )
+    path = diagnostics_path( os.path.join( file_root, args.psr_name, 'pickle_dumps' ), args.psr_name )
+    for plot in render_report( path, out_dir, files = args.files, workers = args.workers ):
+        print( plot )
@@ -1,15 +1,123 @@
 # Saving utilities
 
 import os
+import shutil
 import pickle
 import numpy as np
 try:
     import astropy.io.fits as pyfits
 except:
     import pyfits
-from pypulse.archive import Archive
+from utils.journal import SessionJournal
 
-def save_psrfits( save_filename, ar ):
+SAVE_MODES = ( 'full', 'weights', 'stream' )
+
+def save_psrfits( save_filename, ar, mode = 'full' ):
+
+      """
+      Saves an Archive as a PSRFITS file.
+
+      mode 'weights' copies the archive's original file and overwrites only its DAT_WTS column in place (all that changes when RFI is zapped).
+      mode 'stream' copies the original file and overwrites DAT_FREQ, DAT_WTS, DAT_OFFS, DAT_SCL and DATA one subintegration at a time.
+      mode 'full' rebuilds every table in memory. The other modes fall back to it if the archive no longer has the shape of its file (e.g. after scrunching).
+      """
+
+      if mode not in SAVE_MODES:
+          raise ValueError( "Save mode must be one of {}".format( SAVE_MODES ) )
+
+      if mode != 'full' and _matches_file( ar ):
+          if mode == 'weights':
+              return save_psrfits_weights( save_filename, ar )
+          return save_psrfits_stream( save_filename, ar )
+
+      return save_psrfits_full( save_filename, ar )
+
+
+def _subint_records( filename, readonly = True ):
+
+      """
+      Memory-maps the rows of a file's SUBINT table as a record array, so single columns can be read or written without loading the table.
+      """
+
+      with pyfits.open( filename, memmap = True, ignore_missing_end = True ) as hdul:
+          subint = hdul[ 'SUBINT' ]
+          dtype = subint.data.dtype
+          offset = subint.fileinfo()[ 'datLoc' ]
+          nrows = subint.header[ 'NAXIS2' ]
+
+      return np.memmap( filename, dtype = dtype, mode = 'r' if readonly else 'r+', offset = offset, shape = ( nrows, ) )
+
+
+def _matches_file( ar ):
+
+      """
+      Returns True if the archive's weights still have the (nsubint, nchan) shape of the file it was loaded from.
+      """
+
+      if not os.path.isfile( str( ar.filename ) ):
+          return False
+
+      rows = _subint_records( ar.filename )
+      shape = ( len( rows ), ) + rows.dtype[ 'DAT_WTS' ].shape
+      del rows
+
+      return np.shape( ar.weights ) == shape
+
+
+def _copy_and_patch( save_filename, source, patch ):
+
+      """
+      Copies source to a temporary file next to save_filename, applies patch to its memory-mapped SUBINT rows and moves it into place.
+      """
+
+      tmp = save_filename + ".tmp"
+      shutil.copyfile( source, tmp )
+
+      try:
+          rows = _subint_records( tmp, readonly = False )
+          patch( rows )
+          rows.flush()
+          del rows
+          os.replace( tmp, save_filename )
+      except BaseException:
+          if os.path.exists( tmp ):
+              os.remove( tmp )
+          raise
+
+      return save_filename
+
+
+def save_psrfits_weights( save_filename, ar ):
+
+      """
+      Saves an archive whose only change is its channel weights by patching DAT_WTS in a copy of the original file.
+      """
+
+      def patch( rows ):
+          rows[ 'DAT_WTS' ] = np.reshape( ar.weights, rows[ 'DAT_WTS' ].shape )
+
+      return _copy_and_patch( save_filename, ar.filename, patch )
+
+
+def save_psrfits_stream( save_filename, ar ):
+
+      """
+      Saves an archive by writing its SUBINT columns into a copy of the original file one row at a time.
+      Only one row of each column is converted at once, rather than building a second copy of DATA for new FITS columns.
+      """
+
+      saveDATA = ar.data_beforeanything
+
+      def patch( rows ):
+          columns = { name : rows[ name ] for name in ( 'DAT_FREQ', 'DAT_WTS', 'DAT_OFFS', 'DAT_SCL', 'DATA' ) }
+          for i in range( len( rows ) ):
+              for name, array in ( ( 'DAT_FREQ', ar.freq ), ( 'DAT_WTS', ar.weights ), ( 'DAT_OFFS', ar.data_offset ), ( 'DAT_SCL', ar.data_scale ), ( 'DATA', saveDATA ) ):
+                  columns[ name ][i] = np.reshape( array[i], columns[ name ].shape[1:] )
+
+      return _copy_and_patch( save_filename, ar.filename, patch )
+
+
+def save_psrfits_full( save_filename, ar ):
 
       primaryhdu = pyfits.PrimaryHDU(header=ar.header) #need to make alterations to header
       hdulist = pyfits.HDUList(primaryhdu)
@@ -109,11 +217,24 @@ def save_session( bin_file, *args, mode = None ):
             return save_session_calibration_pickle( bin_file, *args )
         else:
             return 0
+    elif ext == '.jnl':
+        return save_session_journal( bin_file, *args, mode = mode )
     elif ext == '.json':
         raise TypeError( "Need to figure out how JSON works..." )
     else:
         return 0
 
+def save_session_journal( bin_file, *args, mode = None ):
+
+    if mode not in ( 'm', 'r', 'c' ):
+        return 0
+
+    journal = SessionJournal( bin_file, mode )
+    save_dict = journal.save( *args )
+    journal.close()
+
+    return save_dict
+
 def save_session_template_pickle( bin_file, temp_data, ignore_list ):
 
     temp_dict = { 'DATA': temp_data, 'IG_LIST': ignore_list }
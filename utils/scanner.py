@@ -0,0 +1,149 @@
+# Single sweep directory scanner
+
+"""
+Walks each directory tree once with os.scandir, recursively and concurrently (see utils.discovery). Symlinked directories
+are followed, but every directory is identified by its ( st_dev, st_ino ) and entered at most once, so symlink loops
+cannot recurse forever. The walk also brings the header index up to date and classifies every PSRFITS file by pulsar,
+frontend and observation mode. One scan can therefore serve every pulsar: each pipeline stage takes its pulsar's share
+of the catalog as files= instead of walking the directories again.
+"""
+
+# Imports
+import os
+from utils.header_index import HeaderIndex
+from utils.discovery import walk, WORKERS
+
+
+def matches( record, psr_name = None, frontend = None, obs_mode = None ):
+    return all( value is None or record[ key ] == value for key, value in ( ( 'SRC_NAME', psr_name ), ( 'FRONTEND', frontend ), ( 'OBS_MODE', obs_mode ) ) )
+
+
+def select_records( index, dirs, files = None, **query ):
+
+    """
+    Returns the header records a stage should process, sorted by path within each directory.
+    If files is given (e.g. from Catalog.files) only those files are used and no directory is walked;
+    otherwise the index of each existing directory in dirs is queried. Keyword arguments are as for HeaderIndex.query.
+    """
+
+    if files is not None:
+        records = ( index.lookup( file ) for file in files )
+        return [ record for record in records if record is not None and matches( record, **query ) ]
+
+    return [ record for directory in dirs if os.path.isdir( directory ) for record in index.query( directory, **query ) ]
+
+
+class Catalog:
+
+    """
+    PSRFITS files found by a scan, classified by pulsar, frontend and observation mode
+
+    Parameters
+    ----------
+    records       : list
+        Header records (as returned by HeaderIndex) of the files found
+    """
+
+    def __init__( self, records = () ):
+
+        self.records = sorted( records, key = lambda record: record[ 'PATH' ] )
+        self.groups = {}
+        for record in self.records:
+            self.groups.setdefault( record[ 'SRC_NAME' ], {} ).setdefault( ( record[ 'FRONTEND' ], record[ 'OBS_MODE' ] ), [] ).append( record )
+
+    def __repr__( self ):
+        return "Catalog( {} files, {} pulsars )".format( len( self ), len( self.groups ) )
+
+    def __len__( self ):
+        return len( self.records )
+
+    @property
+    def pulsars( self ):
+        return sorted( self.groups )
+
+    def select( self, psr_name = None, frontend = None, obs_mode = None ):
+
+        """
+        Returns the records of the files matching the given pulsar, frontend and observation mode, sorted by path.
+        """
+
+        if psr_name is not None:
+            groups = [ self.groups.get( psr_name, {} ) ]
+        else:
+            groups = self.groups.values()
+
+        records = [ record for group in groups for ( fe, mode ), recs in group.items() for record in recs
+                    if ( frontend is None or fe == frontend ) and ( obs_mode is None or mode == obs_mode ) ]
+
+        return sorted( records, key = lambda record: record[ 'PATH' ] )
+
+    def files( self, **query ):
+
+        """
+        Returns the paths of the files matching the query (as for select), to be given to a stage as files=.
+        """
+
+        return [ record[ 'PATH' ] for record in self.select( **query ) ]
+
+    def summary( self ):
+
+        """
+        Returns the number of files of each pulsar for every ( frontend, obs_mode ) pair.
+        """
+
+        return { psr : { key : len( recs ) for key, recs in group.items() } for psr, group in self.groups.items() }
+
+
+class Scanner:
+
+    """
+    Single sweep scanner over many directory trees
+
+    Parameters
+    ----------
+    index         : HeaderIndex, optional
+        Header index to bring up to date and classify files with (default is the shared index)
+    recursive     : bool, optional
+        Also walks subdirectories
+    follow_symlinks: bool, optional
+        Walks into symlinked directories (each directory is still walked only once)
+    patterns      : str, [str, ..., str], optional
+        Glob patterns file names must match (default is every file)
+    magic         : bool, optional
+        Only indexes files starting with the FITS magic bytes, so other files are never opened by astropy
+    workers       : int, optional
+        Number of threads listing directories
+    verbose       : bool, optional
+        Displays more information to the console
+    """
+
+    def __init__( self, index = None, recursive = True, follow_symlinks = True, patterns = None, magic = True, workers = WORKERS, verbose = False ):
+
+        self.index = index if index is not None else HeaderIndex()
+        self.recursive = recursive
+        self.follow_symlinks = follow_symlinks
+        self.patterns = patterns
+        self.magic = magic
+        self.workers = workers
+        self.verbose = verbose
+
+    def __repr__( self ):
+        return "Scanner( recursive = {} )".format( self.recursive )
+
+    def scan( self, *dirs ):
+
+        """
+        Walks the directories once and returns a Catalog of every PSRFITS file found in them.
+        """
+
+        records, ndirs = [], 0
+        for directory, entries, total in walk( *dirs, patterns = self.patterns, magic = self.magic, recursive = self.recursive,
+                                               follow_symlinks = self.follow_symlinks, workers = self.workers ):
+            ndirs += 1
+            records.extend( self.index.sync( directory, entries ) )
+
+        catalog = Catalog( records )
+        if self.verbose:
+            print( "Scanned {} directories: {} PSRFITS files of {} pulsars".format( ndirs, len( catalog ), len( catalog.groups ) ) )
+
+        return catalog
@@ -0,0 +1,67 @@
+# Startup profiling
+
+"""
+Measures what importing each PulseBlast stage costs. Every stage is imported in a fresh interpreter, so the times do
+not depend on what has already been imported, and the heavy dependencies each stage pulls in are listed.
+"""
+
+# Imports
+import os
+import sys
+import json
+import subprocess
+
+file_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+HEAVY = ( 'matplotlib', 'scipy.stats', 'scipy.optimize', 'scipy.interpolate', 'astropy.io.fits', 'astropy.coordinates', 'pypulse' )
+STAGES = ( ( 'Template builder (-m)', 'template_builder' ), ( 'RFI mitigation (-r)', 'rfi_mitigation' ),
+           ( 'Flux calibration (-c)', 'flux_calibrator' ), ( 'Timing (-t)', 'timing' ) )
+
+_PROBE = """
+import sys, time, json
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print( json.dumps( {{ 'TIME' : t, 'MODULES' : len( sys.modules ), 'HEAVY' : [ h for h in {heavy!r} if h in sys.modules ] }} ) )
+"""
+
+
+def loaded_heavy():
+    return [ h for h in HEAVY if h in sys.modules ]
+
+def measure_import( module ):
+
+    """
+    Imports a module in a fresh interpreter and returns its import time (s), the number of modules loaded and which heavy dependencies were loaded.
+    """
+
+    probe = subprocess.run( [ sys.executable, '-c', _PROBE.format( module = module, heavy = HEAVY ) ], cwd = file_root, capture_output = True, text = True )
+    if probe.returncode != 0:
+        return { 'MODULE' : module, 'TIME' : None, 'MODULES' : None, 'HEAVY' : [], 'ERROR' : probe.stderr.strip().splitlines()[-1:] }
+
+    result = json.loads( probe.stdout.strip().splitlines()[-1] )
+    result[ 'MODULE' ] = module
+    return result
+
+def startup_profile( startup_time, stages = STAGES ):
+
+    """
+    Prints how long the calling script took to reach its prompt, the heavy modules it has loaded,
+    and the measured import cost of every stage.
+    """
+
+    print( "Startup: {:.3f} s, {} modules loaded".format( startup_time, len( sys.modules ) ) )
+    print( "Heavy dependencies loaded at startup: {}".format( ", ".join( loaded_heavy() ) or "none" ) )
+    print( "" )
+    print( "{:<26}{:>10}{:>10}   {}".format( "Stage", "Import (s)", "Modules", "Heavy dependencies" ) )
+
+    rows = []
+    for label, module in stages:
+        result = measure_import( module )
+        rows.append( result )
+        if result[ 'TIME' ] is None:
+            print( "{:<26}{:>10}{:>10}   {}".format( label, "failed", "-", " ".join( result[ 'ERROR' ] ) ) )
+        else:
+            print( "{:<26}{:>10.3f}{:>10d}   {}".format( label, result[ 'TIME' ], result[ 'MODULES' ], ", ".join( result[ 'HEAVY' ] ) or "none" ) )
+
+    return rows
@@ -0,0 +1,99 @@
+# Vectorized template matching for TOA generation
+
+"""
+Fourier-domain template matching (Taylor 1992) for many profiles at once.
+
+Fits P_k = b * T_k * exp( -2 pi i k tau / nbin ) for k = 1 ... nbin/2 - 1, the same model pypulse fits one profile
+at a time in utils.get_toa. A coarse lag comes from the maximum of the FFT cross-correlation and is refined by
+Newton iterations on the cross-correlation phase, all as array operations over every profile.
+Errors follow the additive noise formulae used by pypulse (utils.toa_errors_additive).
+"""
+
+# Imports
+import numpy as np
+import utils.pulsarUtilities as pu
+from custom_exceptions import DimensionError
+
+
+def off_pulse_std( profiles, opw, tau ):
+
+    """
+    Returns the standard deviation of each profile over the template's off-pulse window moved by the profile's lag tau (bins).
+    """
+
+    nbin = profiles.shape[-1]
+    shift = np.rint( np.nan_to_num( tau ) ).astype( int )
+    profiles = np.broadcast_to( profiles, shift.shape + ( nbin, ) )
+
+    bins = np.mod( np.flatnonzero( opw ) + shift[ ..., np.newaxis ], nbin )
+    return np.std( np.take_along_axis( profiles, bins, axis = -1 ), axis = -1 )
+
+
+def fit_toas( template, profiles, opw = None, niter = 20, tol = 1e-10 ):
+
+    """
+    Fits the template to every profile in an array of shape (..., nbin).
+    The template may be 1D or any shape that broadcasts against the profiles.
+    opw is a boolean array that is True in the off-pulse window of the template; by default it is found from the template.
+    The noise of each profile is measured in that window moved by the fitted lag, so it never includes the pulse
+    however far the profile is from the template's phase.
+
+    Returns tauhat (bins), bhat, sigma_tau (bins), sigma_b and S/N, each of shape profiles.shape[:-1].
+    Profiles that cannot be fit (e.g. zero-weighted) are NaN.
+    """
+
+    template = np.asarray( template, dtype = np.float64 )
+    profiles = np.asarray( profiles, dtype = np.float64 )
+    nbin = profiles.shape[-1]
+
+    if template.shape[-1] != nbin:
+        raise DimensionError( "Template has {} bins but the profiles have {}.".format( template.shape[-1], nbin ) )
+
+    template = template / np.max( template, axis = -1, keepdims = True )
+
+    if opw is None:
+        opw = np.logical_not( pu.get_1D_OPW_mask( np.reshape( template, ( -1, nbin ) ).mean( axis = 0 ), windowsize = nbin // 8 ) )
+
+    nsum = nbin // 2
+    k = np.arange( 1, nsum )
+    w = 2 * np.pi * k / nbin
+
+    tfft = np.fft.rfft( template, axis = -1 )[ ..., 1:nsum ]
+    pfft = np.fft.rfft( profiles, axis = -1 )[ ..., 1:nsum ]
+    cross = pfft * np.conj( tfft )
+
+    # Coarse lag from the cross-correlation maximum
+    spec = np.zeros( cross.shape[:-1] + ( nbin // 2 + 1, ), dtype = np.complex128 )
+    spec[ ..., 1:nsum ] = cross
+    tau = np.argmax( np.fft.irfft( spec, n = nbin, axis = -1 ), axis = -1 ).astype( np.float64 )
+
+    # Newton refinement of the maximum of Re( sum cross * exp( i w tau ) )
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+        for _ in range( niter ):
+            phased = cross * np.exp( 1j * w * tau[ ..., np.newaxis ] )
+            d1 = -np.sum( w * phased.imag, axis = -1 )
+            d2 = -np.sum( w**2 * phased.real, axis = -1 )
+            step = np.where( d2 < 0, np.clip( d1 / d2, -1, 1 ), 0 )
+            tau -= step
+            if np.all( np.abs( step ) < tol ):
+                break
+
+        # The noise is measured once the lag is known (the baseline only affects k = 0, which is not fit)
+        sigma = off_pulse_std( profiles, opw, tau )
+
+        tnorm = np.sum( np.abs( tfft )**2, axis = -1 )
+        knorm = np.sum( k**2 * np.abs( tfft )**2, axis = -1 )
+        bhat = np.sum( ( cross * np.exp( 1j * w * tau[ ..., np.newaxis ] ) ).real, axis = -1 ) / tnorm
+
+        sigma_b = sigma * np.sqrt( nbin / ( 2 * tnorm ) )
+        sigma_tau = ( sigma * nbin / ( 2 * np.pi * np.abs( bhat ) ) ) * np.sqrt( nbin / ( 2 * knorm ) )
+        snr = bhat / sigma
+
+    tau = np.mod( tau + nbin / 2, nbin ) - nbin / 2
+
+    bad = np.logical_not( sigma > 0 )
+    fit = tuple( np.array( np.broadcast_to( arr, bad.shape ), dtype = np.float64 ) for arr in ( tau, bhat, sigma_tau, sigma_b, snr ) )
+    for arr in fit:
+        arr[ bad ] = np.nan
+
+    return fit
@@ -0,0 +1,206 @@
+# Compact store of RFI zap masks
+
+"""
+Keeps the result of RFI mitigation as a bit-packed zap mask per file instead of a full copy of every archive.
+Each pulsar has one store directory holding, for every mitigated file, a MEMBER.npz (readable with np.load) with the
+np.packbits mask (True where the channel weight was zapped) as MASK and its provenance, as JSON, as PROVENANCE:
+{ 'FILE' : path, 'MEMBER' : name, 'SHAPE' : [ nsubint, nchan ], 'METHOD' : method, 'ZAPPED' : count, 'HASH' : digest, 'SIZE' : bytes, 'MTIME' : time, 'CREATED' : time }
+FILE is the absolute path of the file, as a recursive scan can find files with the same name in different directories,
+and MEMBER is the file name followed by a hash of that path.
+
+Every mask is written to a temporary file that then atomically replaces the file's member, so storing a mask costs the
+same however many the store holds and a crash part way through never corrupts the masks already stored.
+A mask is only applied to a file whose size and modification time (or content digest) still match its provenance.
+"""
+
+# Imports
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from utils.ignore_index import file_digest
+
+STORE_NAME = "{}_rfi_weights"
+
+
+def weights_store_path( directory, psr_name ):
+    return os.path.join( directory, STORE_NAME.format( psr_name ) )
+
+def member_name( path ):
+    return "{}_{}".format( os.path.basename( path ), hashlib.blake2b( path.encode(), digest_size = 8 ).hexdigest() )
+
+
+class WeightsStore:
+
+    """
+    Per-pulsar store of zap masks and their provenance
+
+    Parameters
+    ----------
+    path          : str, os.Path
+        Directory of the store (created on the first put)
+    verbose       : bool, optional
+        Displays more information to the console
+    """
+
+    def __init__( self, path, verbose = False ):
+
+        self.path = str( path )
+        self.verbose = verbose
+        self._index = None
+
+    def __repr__( self ):
+        return "WeightsStore( path = {} )".format( self.path )
+
+    def __len__( self ):
+        return len( self.index )
+
+    def __contains__( self, file ):
+        return self.entry( file ) is not None
+
+    @property
+    def index( self ):
+
+        """
+        Provenance of every stored mask, keyed by absolute path. Only the small PROVENANCE members are read.
+        """
+
+        if self._index is None:
+            self._index = {}
+            if os.path.isdir( self.path ):
+                for entry in os.scandir( self.path ):
+                    if entry.name.endswith( ".npz" ):
+                        with np.load( entry.path ) as member:
+                            prov = json.loads( str( member[ 'PROVENANCE' ] ) )
+                        self._index[ prov[ 'FILE' ] ] = prov
+
+        return self._index
+
+    def entry( self, file ):
+
+        """
+        Returns the provenance of the mask stored for a file, or None if there is none.
+        """
+
+        return self.index.get( os.path.abspath( file ) )
+
+    def member_path( self, entry ):
+        return os.path.join( self.path, entry[ 'MEMBER' ] + ".npz" )
+
+
+    def make_record( self, file, weights, method, **provenance ):
+
+        """
+        Returns a record of the zapped channels of a file, given its weights of shape (nsubint, nchan).
+        Extra keyword arguments are kept in the provenance.
+        """
+
+        mask = np.asarray( weights ) == 0
+        path = os.path.abspath( file )
+        st = os.stat( path )
+        entry = { 'FILE' : path, 'MEMBER' : member_name( path ), 'SHAPE' : list( mask.shape ), 'METHOD' : method, 'ZAPPED' : int( np.count_nonzero( mask ) ),
+                  'HASH' : file_digest( path ), 'SIZE' : st.st_size, 'MTIME' : st.st_mtime, 'CREATED' : time.time() }
+        entry.update( provenance )
+
+        return entry, np.packbits( mask, axis = None )
+
+    def put( self, record ):
+
+        """
+        Stores a record made by make_record, replacing any earlier mask of the same file.
+        """
+
+        entry, packed = record
+        os.makedirs( self.path, exist_ok = True )
+
+        path = self.member_path( entry )
+        tmp = path + ".tmp"
+        with open( tmp, 'wb' ) as f:
+            np.savez_compressed( f, MASK = packed, PROVENANCE = np.array( json.dumps( entry ) ) )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( tmp, path )
+
+        self.index[ entry[ 'FILE' ] ] = entry
+        if self.verbose:
+            print( "Stored zap mask of {} ({} channels zapped)".format( os.path.basename( entry[ 'FILE' ] ), entry[ 'ZAPPED' ] ) )
+
+        return entry
+
+    def is_current( self, file ):
+
+        """
+        Returns True if a mask is stored for the file and the file has not changed since.
+        """
+
+        entry = self.entry( file )
+        if entry is None:
+            return False
+
+        try:
+            st = os.stat( file )
+        except OSError:
+            return False
+        if ( entry[ 'SIZE' ], entry[ 'MTIME' ] ) == ( st.st_size, st.st_mtime ):
+            return True
+
+        return file_digest( file ) == entry[ 'HASH' ]
+
+    def mask( self, file, shape = None ):
+
+        """
+        Returns the boolean zap mask of a file, of shape (nsubint, nchan), or None if there is no current mask for it.
+        If shape is given the mask is broadcast to it (a mask made from epoch averaged data zaps a channel in every subintegration),
+        and None is returned if it cannot be.
+        """
+
+        if not self.is_current( file ):
+            return None
+
+        entry = self.entry( file )
+        with np.load( self.member_path( entry ) ) as member:
+            packed = member[ 'MASK' ]
+
+        mask = np.unpackbits( packed, count = int( np.prod( entry[ 'SHAPE' ] ) ) ).astype( bool ).reshape( entry[ 'SHAPE' ] )
+        if shape is None:
+            return mask
+
+        try:
+            return np.broadcast_to( mask, shape )
+        except ValueError:
+            if self.verbose:
+                print( "Zap mask of {} has shape {} but the weights have shape {}. Not applied.".format( os.path.basename( entry[ 'FILE' ] ), mask.shape, shape ) )
+            return None
+
+    def apply( self, file, weights ):
+
+        """
+        Returns the weights with the file's zapped channels set to zero (unchanged if there is no current mask).
+        """
+
+        mask = self.mask( file, np.shape( weights ) )
+        if mask is None:
+            return weights
+
+        return np.where( mask, 0, weights )
+
+    def apply_archive( self, file, archive ):
+
+        """
+        Zaps the file's masked profiles in a pypulse Archive the way RFIBlaster.zap_mask does, and also zeroes their data
+        so that the unweighted data ( getData( weight = False ) ) excludes them too. Returns the archive.
+        """
+
+        mask = self.mask( file, np.shape( archive.weights ) )
+        if mask is None:
+            return archive
+
+        archive.weights = np.where( mask, 0.0, archive.weights )
+        subints, chans = np.nonzero( mask )
+        archive.data[ subints, :, chans, : ] = 0
+
+        # Setting the data again makes pypulse recompute the weighted data with the new weights
+        archive.data = archive.data
+
+        return archive